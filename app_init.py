@@ -29,6 +29,17 @@ def create_app():
     app.config['SQLALCHEMY_DATABASE_URI'] = f'sqlite:///{db_path}'
     app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
     
+    # Background exports: concurrent builds per process and hours a finished file is kept
+    app.config['EXPORT_WORKERS'] = int(os.environ.get('EXPORT_WORKERS', 2))
+    app.config['EXPORT_RETENTION_HOURS'] = float(os.environ.get('EXPORT_RETENTION_HOURS', 24))
+    app.config['EXPORT_DIR'] = os.path.join(app.instance_path, 'exports')
+    
+    # Background vehicle uploads: concurrent imports per process, spool directory, and
+    # hours the file of a cancelled or failed job is kept for resuming
+    app.config['UPLOAD_WORKERS'] = int(os.environ.get('UPLOAD_WORKERS', 1))
+    app.config['UPLOAD_RETENTION_HOURS'] = float(os.environ.get('UPLOAD_RETENTION_HOURS', 24))
+    app.config['UPLOAD_DIR'] = os.path.join(app.instance_path, 'uploads')
+    
     # Initialize CSRF protection
     csrf.init_app(app)
     
@@ -0,0 +1,39 @@
+"""Helpers for running work outside the request cycle."""
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from extensions import db
+
+logger = logging.getLogger(__name__)
+
+
+def _run_in_context(app, target, args, name):
+    with app.app_context():
+        try:
+            target(*args)
+        except Exception:
+            logger.exception(f"Background task {name or target.__name__} failed")
+        finally:
+            db.session.remove()
+
+
+def spawn(app, target, *args, name=None):
+    """Run target(*args) in a daemon thread inside an application context"""
+    thread = threading.Thread(
+        target=_run_in_context, args=(app, target, args, name), name=name, daemon=True
+    )
+    thread.start()
+    return thread
+
+
+class WorkerPool:
+    """Runs at most ``max_workers`` tasks at once; the rest wait in a queue"""
+
+    def __init__(self, max_workers, name):
+        self.max_workers = max_workers
+        self._executor = ThreadPoolExecutor(max_workers=max_workers, thread_name_prefix=name)
+
+    def submit(self, app, target, *args, name=None):
+        """Queue target(*args) to run inside an application context"""
+        return self._executor.submit(_run_in_context, app, target, args, name)
@@ -0,0 +1,549 @@
+"""Bulk import of vehicles from a CSV registry file.
+
+The file is decoded and parsed as a stream, CHUNK_SIZE rows at a time. Each
+chunk is validated in Python, checked for plates repeated earlier in the file
+and, with one IN lookup, for plates already registered; the rows that pass
+are written with a single executemany INSERT on the DBAPI cursor, skipping
+SQLAlchemy's per-row parameter processing. Two modes:
+
+- ``all``: nothing is saved unless every row is valid (one transaction)
+- ``partial``: valid rows are saved, committing after every chunk, and the
+  invalid ones are reported and skipped
+
+Large files can instead be spooled to disk and imported by a background
+UploadJob. The job commits each chunk together with its progress, so it can
+be cancelled between chunks and resumed from the last committed one. An
+``all`` job first validates the whole file and only then inserts; a plate
+registered by someone else between the two passes is still rejected.
+"""
+import codecs
+import csv
+import itertools
+import json
+import logging
+import os
+import threading
+import time
+import uuid
+from datetime import datetime, timedelta
+
+from flask import current_app
+from sqlalchemy import exc
+
+import caching
+import changelog
+import dictionaries
+import search
+from background import WorkerPool
+from extensions import db
+from models import RESERVED_PLATE_KEYS, Kendaraan, UploadJob, normalize_plate
+
+logger = logging.getLogger(__name__)
+
+REQUIRED_FIELDS = ['jenis', 'plat_nomor', 'merek', 'tipe', 'tahun', 'fuel_type', 'load_category']
+
+VALID_CATEGORIES = {
+    'bensin': ['kendaraan_muatan', 'kendaraan_penumpang'],
+    'solar': ['<3.5ton', '>=3.5ton']
+}
+
+MODES = ('all', 'partial')
+
+INSERT_COLUMNS = [
+    'jenis', 'plat_nomor', 'plat_key', 'merek', 'tipe', 'tahun', 'fuel_type', 'nama_instansi',
+    'load_category', 'created_at', 'updated_at'
+]
+
+INSERT_SQL = (
+    f"INSERT INTO kendaraan ({', '.join(INSERT_COLUMNS)}) "
+    f"VALUES ({', '.join('?' for _ in INSERT_COLUMNS)})"
+)
+
+# Rows validated, looked up and inserted together; stays well under
+# SQLite's bound-parameter limit for the IN lookup
+CHUNK_SIZE = 1000
+
+# Error rows returned in full; the rest are only counted
+MAX_ERRORS = 1000
+
+# Error rows kept on a background job
+JOB_ERRORS = 100
+
+# Defaults for the UPLOAD_WORKERS and UPLOAD_RETENTION_HOURS settings
+DEFAULT_WORKERS = 1
+DEFAULT_RETENTION_HOURS = 24
+
+# Pause between chunks of a job so interactive writers can take the lock
+PAUSE_SECONDS = 0.05
+
+# An active job that has not reported progress for this long is orphaned
+STALE_SECONDS = 120
+
+# Attempts per chunk when the database is locked by another writer
+MAX_RETRIES = 5
+
+ACTIVE_STATUSES = ('pending', 'running')
+
+_pool = None
+_pool_lock = threading.Lock()
+
+
+def read_csv(stream):
+    """(row number, row dict) for each line of a binary CSV stream"""
+    lines = codecs.iterdecode(stream, 'utf-8-sig')
+    # Row 1 is the header
+    for row_num, row in enumerate(csv.DictReader(lines), start=2):
+        yield row_num, row
+
+
+def chunked(rows, size=CHUNK_SIZE):
+    chunk = []
+    for row in rows:
+        chunk.append(row)
+        if len(chunk) == size:
+            yield chunk
+            chunk = []
+    if chunk:
+        yield chunk
+
+
+def validate_row(row):
+    """Cleaned column values of one CSV row; raises ValueError with the reason"""
+    missing = [f for f in REQUIRED_FIELDS if not (row.get(f) or '').strip()]
+    if missing:
+        raise ValueError(f'Missing required fields: {", ".join(missing)}')
+
+    plat = row['plat_nomor'].strip().upper()
+    if len(plat) < 4 or not normalize_plate(plat) or normalize_plate(plat) in RESERVED_PLATE_KEYS:
+        raise ValueError('Invalid plate number format')
+
+    try:
+        tahun = int(row['tahun'])
+    except ValueError:
+        raise ValueError('Year must be a valid number')
+    if tahun < 1900 or tahun > 2100:
+        raise ValueError('Invalid year (must be between 1900-2100)')
+
+    jenis = row['jenis'].strip().lower()
+    if jenis not in ['umum', 'dinas']:
+        raise ValueError("Invalid vehicle type (must be 'umum' or 'dinas')")
+
+    fuel_type = row['fuel_type'].strip().lower()
+    if fuel_type not in ['bensin', 'solar']:
+        raise ValueError("Invalid fuel type (must be 'bensin' or 'solar')")
+
+    load_category = row['load_category'].strip()
+    if load_category not in VALID_CATEGORIES[fuel_type]:
+        raise ValueError(
+            f'Invalid load category for {fuel_type}. Valid options are: {", ".join(VALID_CATEGORIES[fuel_type])}'
+        )
+
+    nama_instansi = (row.get('nama_instansi') or '').strip()
+    if jenis != 'dinas' or not nama_instansi:
+        nama_instansi = '-'
+
+    return {
+        'jenis': jenis,
+        'plat_nomor': plat,
+        'plat_key': normalize_plate(plat),
+        'merek': row['merek'].strip(),
+        'tipe': row['tipe'].strip(),
+        'tahun': tahun,
+        'fuel_type': fuel_type,
+        'nama_instansi': nama_instansi,
+        'load_category': load_category
+    }
+
+
+def existing_plates(keys):
+    """The subset of plate keys already registered"""
+    if not keys:
+        return set()
+    return {key for key, in db.session.query(Kendaraan.plat_key).filter(Kendaraan.plat_key.in_(keys))}
+
+
+def check_chunk(chunk, seen):
+    """Split a chunk into (valid rows, errors).
+
+    ``seen`` maps the key of every plate accepted so far in this file to its
+    row number and is updated with the plates of this chunk; plates spelled
+    differently but with the same key count as duplicates.
+    """
+    valid, errors = [], []
+    for row_num, row in chunk:
+        try:
+            values = validate_row(row)
+        except ValueError as e:
+            errors.append({'row': row_num, 'error': str(e)})
+            continue
+        key = values['plat_key']
+        if key in seen:
+            errors.append({'row': row_num, 'error': f"Plat nomor {values['plat_nomor']} duplicates row {seen[key]}"})
+            continue
+        seen[key] = row_num
+        valid.append((row_num, values))
+
+    taken = existing_plates([values['plat_key'] for _, values in valid])
+    if taken:
+        errors.extend(
+            {'row': row_num, 'error': f"Plat nomor {values['plat_nomor']} already exists"}
+            for row_num, values in valid if values['plat_key'] in taken
+        )
+        errors.sort(key=lambda error: error['row'])
+        valid = [(row_num, values) for row_num, values in valid if values['plat_key'] not in taken]
+    return valid, errors
+
+
+def insert_rows(valid):
+    """Insert checked rows with one executemany statement"""
+    if not valid:
+        return 0
+    # Same text format SQLAlchemy stores DateTime values in
+    now = datetime.utcnow().strftime('%Y-%m-%d %H:%M:%S.%f')
+    params = [
+        tuple(values[name] for name in INSERT_COLUMNS[:-2]) + (now, now)
+        for _, values in valid
+    ]
+    with changelog.bulk_inserts('kendaraan') as before:
+        db.session.connection().exec_driver_sql(INSERT_SQL, params)
+        search.index_inserted(before)
+        dictionaries.count_inserted(before)
+    caching.mark_written(db.session(), 'kendaraan')
+    return len(valid)
+
+
+def insert_chunk(valid, errors):
+    """Insert a checked chunk without committing; returns the rows inserted.
+
+    A plate registered by another writer since the lookup makes the INSERT
+    fail. The transaction is then rolled back, so this must be the first
+    write of it, and the chunk is checked once more before inserting the rest.
+    """
+    try:
+        return insert_rows(valid)
+    except exc.IntegrityError:
+        db.session.rollback()
+    taken = existing_plates([values['plat_key'] for _, values in valid])
+    errors.extend(
+        {'row': row_num, 'error': f"Plat nomor {values['plat_nomor']} already exists"}
+        for row_num, values in valid if values['plat_key'] in taken
+    )
+    errors.sort(key=lambda error: error['row'])
+    return insert_rows([(row_num, values) for row_num, values in valid if values['plat_key'] not in taken])
+
+
+def import_rows(rows, mode='all'):
+    """Validate and insert (row number, row dict) pairs; returns a summary.
+
+    In ``all`` mode the caller's transaction is committed only if every row
+    is valid and rolled back otherwise; an IntegrityError from a concurrent
+    insert propagates after rollback.
+    """
+    if mode not in MODES:
+        raise ValueError(f"mode must be one of: {', '.join(MODES)}")
+
+    seen = {}
+    errors = []
+    rejected = 0
+    total = 0
+    successes = 0
+
+    try:
+        for chunk in chunked(rows):
+            total += len(chunk)
+            valid, chunk_errors = check_chunk(chunk, seen)
+            if mode == 'partial':
+                successes += insert_chunk(valid, chunk_errors)
+                db.session.commit()
+            elif not rejected and not chunk_errors:
+                # Once a row fails nothing will be kept; only keep validating
+                successes += insert_rows(valid)
+            rejected += len(chunk_errors)
+            errors.extend(chunk_errors[:MAX_ERRORS - len(errors)])
+
+        if mode == 'all':
+            if rejected:
+                db.session.rollback()
+                successes = 0
+            else:
+                db.session.commit()
+    except Exception:
+        db.session.rollback()
+        raise
+
+    return {
+        'mode': mode,
+        'total_rows': total,
+        'successes': successes,
+        'rejected': rejected,
+        'errors': errors
+    }
+
+
+def _worker_pool(app):
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            _pool = WorkerPool(app.config.get('UPLOAD_WORKERS', DEFAULT_WORKERS), 'upload')
+        return _pool
+
+
+def upload_dir(app):
+    """Directory holding spooled upload files"""
+    path = app.config.get('UPLOAD_DIR') or os.path.join(app.instance_path, 'uploads')
+    os.makedirs(path, exist_ok=True)
+    return path
+
+
+def submit_upload(app, file, mode='all', user_id=None):
+    """Spool an uploaded CSV to disk and queue its import; returns the job"""
+    if mode not in MODES:
+        raise ValueError(f"mode must be one of: {', '.join(MODES)}")
+    purge_expired()
+    path = os.path.join(upload_dir(app), f'{uuid.uuid4().hex}.csv')
+    file.save(path)
+    job = UploadJob(
+        mode=mode,
+        phase='validate' if mode == 'all' else 'insert',
+        user_id=user_id,
+        file_path=path,
+        file_name=file.filename
+    )
+    db.session.add(job)
+    db.session.commit()
+    _worker_pool(app).submit(app, _run, job.id, name=f'upload-{job.id}')
+    return job
+
+
+def cancel_upload(job):
+    """Stop an active job after its current chunk; committed rows are kept"""
+    if job.status not in ACTIVE_STATUSES:
+        return False
+    now = datetime.utcnow()
+    retention = _retention()
+    cancelled = UploadJob.query.filter(
+        UploadJob.id == job.id,
+        UploadJob.status.in_(ACTIVE_STATUSES)
+    ).update(
+        {'status': 'cancelled', 'finished_at': now, 'expires_at': now + retention},
+        synchronize_session=False
+    )
+    db.session.commit()
+    return cancelled == 1
+
+
+def restart_upload(app, job):
+    """Queue a cancelled or failed job again from its last committed chunk"""
+    if job.status not in ('cancelled', 'failed') or not job.file_path or not os.path.exists(job.file_path):
+        return False
+    restarted = UploadJob.query.filter(
+        UploadJob.id == job.id,
+        UploadJob.status.in_(('cancelled', 'failed'))
+    ).update(
+        {'status': 'pending', 'error': None, 'finished_at': None, 'expires_at': None},
+        synchronize_session=False
+    )
+    db.session.commit()
+    if restarted:
+        _worker_pool(app).submit(app, _run, job.id, name=f'upload-{job.id}')
+    return restarted == 1
+
+
+def resume_uploads(app):
+    """Queue again the active jobs whose worker stopped; returns how many"""
+    cutoff = datetime.utcnow() - timedelta(seconds=STALE_SECONDS)
+    job_ids = [job_id for job_id, in db.session.query(UploadJob.id).filter(
+        UploadJob.status.in_(ACTIVE_STATUSES),
+        UploadJob.updated_at < cutoff
+    ).order_by(UploadJob.id)]
+    for job_id in job_ids:
+        logger.info(f"Resuming upload job {job_id}")
+        _worker_pool(app).submit(app, _run, job_id, name=f'upload-{job_id}')
+    return len(job_ids)
+
+
+def purge_expired():
+    """Delete the spooled files of stopped jobs past their retention; returns how many"""
+    jobs = UploadJob.query.filter(
+        UploadJob.status.in_(('cancelled', 'failed')),
+        UploadJob.expires_at <= datetime.utcnow()
+    ).all()
+    for job in jobs:
+        _remove(job.file_path)
+        job.status = 'expired'
+        job.file_path = None
+    if jobs:
+        db.session.commit()
+    return len(jobs)
+
+
+def job_progress(job):
+    """Serialize a job with the completion percentage of its current phase"""
+    percent = 0.0
+    if job.status == 'completed':
+        percent = 100.0
+    elif job.total:
+        percent = min(100.0, job.processed / job.total * 100)
+
+    return {
+        'id': job.id,
+        'status': job.status,
+        'mode': job.mode,
+        'phase': job.phase,
+        'file_name': job.file_name,
+        'total_rows': job.total,
+        'processed': job.processed,
+        'percent': round(percent, 1),
+        'successes': job.successes,
+        'rejected': job.rejected,
+        'errors': json.loads(job.errors or '[]'),
+        'error': job.error,
+        'created_at': job.created_at.isoformat() if job.created_at else None,
+        'updated_at': job.updated_at.isoformat() if job.updated_at else None,
+        'finished_at': job.finished_at.isoformat() if job.finished_at else None,
+        'expires_at': job.expires_at.isoformat() if job.expires_at else None
+    }
+
+
+def _retention():
+    return timedelta(hours=current_app.config.get('UPLOAD_RETENTION_HOURS', DEFAULT_RETENTION_HOURS))
+
+
+def _remove(path):
+    if path:
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+
+
+def _claim(job_id):
+    """Mark the job running unless another worker holds it"""
+    table = UploadJob.__table__
+    now = datetime.utcnow()
+    cutoff = now - timedelta(seconds=STALE_SECONDS)
+    claimed = db.session.execute(
+        table.update().where(
+            table.c.id == job_id,
+            (table.c.status == 'pending') |
+            ((table.c.status == 'running') & (table.c.updated_at < cutoff))
+        ).values(status='running', updated_at=now)
+    ).rowcount
+    db.session.commit()
+    return claimed == 1
+
+
+def _replay(rows, seen):
+    """Rebuild ``seen`` from rows an earlier run already committed"""
+    for row_num, row in rows:
+        try:
+            key = validate_row(row)['plat_key']
+        except ValueError:
+            continue
+        seen.setdefault(key, row_num)
+
+
+def _forget(seen, first_row):
+    """Drop plate keys recorded from first_row on, before a chunk is retried"""
+    for key in [key for key, row_num in seen.items() if row_num >= first_row]:
+        del seen[key]
+
+
+def _process(job_id, insert):
+    """Run the current phase over the rest of the file.
+
+    Returns False if the job was cancelled or taken over meanwhile.
+    """
+    job = UploadJob.query.get(job_id)
+    path, skip = job.file_path, job.processed
+    errors = json.loads(job.errors or '[]')
+    # End the read transaction; an open one keeps other writers from committing
+    db.session.commit()
+
+    seen = {}
+    with open(path, 'rb') as f:
+        rows = read_csv(f)
+        _replay(itertools.islice(rows, skip), seen)
+
+        for chunk in chunked(rows):
+            retries = 0
+            while True:
+                try:
+                    valid, chunk_errors = check_chunk(chunk, seen)
+                    inserted = insert_chunk(valid, chunk_errors) if insert else 0
+                    values = {
+                        'processed': UploadJob.processed + len(chunk),
+                        'successes': UploadJob.successes + inserted,
+                        'rejected': UploadJob.rejected + len(chunk_errors),
+                        'updated_at': datetime.utcnow()
+                    }
+                    if chunk_errors and len(errors) < JOB_ERRORS:
+                        errors.extend(chunk_errors[:JOB_ERRORS - len(errors)])
+                        values['errors'] = json.dumps(errors)
+                    # The chunk's rows and the job's progress commit together;
+                    # a cancelled job matches nothing and the chunk is dropped
+                    updated = UploadJob.query.filter_by(id=job_id, status='running').update(
+                        values, synchronize_session=False
+                    )
+                    if not updated:
+                        db.session.rollback()
+                        return False
+                    db.session.commit()
+                    break
+                except exc.OperationalError:
+                    db.session.rollback()
+                    _forget(seen, chunk[0][0])
+                    retries += 1
+                    if retries > MAX_RETRIES:
+                        raise
+                    time.sleep(PAUSE_SECONDS * 2 ** retries)
+            time.sleep(PAUSE_SECONDS)
+    return True
+
+
+def _finish(job_id, **values):
+    values.setdefault('finished_at', datetime.utcnow())
+    finished = UploadJob.query.filter_by(id=job_id, status='running').update(values, synchronize_session=False)
+    db.session.commit()
+    return finished == 1
+
+
+def _run(job_id):
+    if not _claim(job_id):
+        return
+
+    job = UploadJob.query.get(job_id)
+    path = job.file_path
+    try:
+        if job.total is None:
+            db.session.commit()
+            with open(path, 'rb') as f:
+                total = sum(1 for _ in read_csv(f))
+            UploadJob.query.filter_by(id=job_id).update({'total': total}, synchronize_session=False)
+            db.session.commit()
+
+        if job.phase == 'validate':
+            if not _process(job_id, insert=False):
+                return
+            if job.rejected:
+                # Nothing is inserted when an all-or-nothing file has bad rows
+                if _finish(job_id, status='completed', file_path=None):
+                    _remove(path)
+                logger.info(f"Upload job {job_id} rejected: {job.rejected} invalid rows")
+                return
+            UploadJob.query.filter_by(id=job_id).update(
+                {'phase': 'insert', 'processed': 0}, synchronize_session=False
+            )
+            db.session.commit()
+
+        if not _process(job_id, insert=True):
+            return
+    except Exception as e:
+        db.session.rollback()
+        _finish(job_id, status='failed', error=str(e), expires_at=datetime.utcnow() + _retention())
+        logger.error(f"Upload job {job_id} failed: {str(e)}")
+        return
+
+    if _finish(job_id, status='completed', file_path=None):
+        _remove(path)
+        logger.info(f"Upload job {job_id} completed: {job.successes} saved, {job.rejected} rejected")
@@ -0,0 +1,77 @@
+"""Micro-benchmark for the emission evaluator.
+
+Grades synthetic readings with the vectorized batch path, checks a sample
+against the scalar path and prints throughput for both.
+
+    python bench_evaluate.py [rows]
+"""
+import sys
+import time
+
+import numpy as np
+
+from evaluate import Thresholds, LOAD_CATEGORIES, parameter_documents, scalar_limits
+
+
+def default_thresholds():
+    """Compile the model defaults without touching the database"""
+    return Thresholds.compile(*parameter_documents(), scalar_limits())
+
+
+def synthetic_readings(rows, seed=2007):
+    rng = np.random.default_rng(seed)
+    fuel_type = np.where(rng.random(rows) < 0.7, 'bensin', 'solar').astype(object)
+    is_bensin = fuel_type == 'bensin'
+    load_category = np.where(
+        is_bensin,
+        rng.choice(LOAD_CATEGORIES['bensin'], rows),
+        rng.choice(LOAD_CATEGORIES['solar'], rows),
+    ).astype(object)
+    return {
+        'co': np.where(is_bensin, rng.gamma(2.0, 0.4, rows), 0.0),
+        'co2': np.where(is_bensin, rng.normal(10.0, 2.0, rows), 0.0),
+        'hc': np.where(is_bensin, rng.gamma(2.0, 80.0, rows), 0.0),
+        'o2': np.where(is_bensin, rng.gamma(2.0, 0.4, rows), 0.0),
+        'lambda_val': np.where(is_bensin, rng.normal(1.0, 0.05, rows), 0.0),
+        'opacity': np.where(is_bensin, np.nan, rng.gamma(3.0, 12.0, rows)),
+        'tahun': rng.integers(1995, 2026, rows),
+        'fuel_type': fuel_type,
+        'load_category': load_category,
+    }
+
+
+def check_parity(thresholds, readings, result, sample=20000):
+    for i in range(min(sample, len(result.lulus))):
+        opacity = readings['opacity'][i]
+        expected = thresholds.evaluate(
+            readings['fuel_type'][i], readings['load_category'][i], int(readings['tahun'][i]),
+            co=readings['co'][i], co2=readings['co2'][i], hc=readings['hc'][i],
+            o2=readings['o2'][i], lambda_val=readings['lambda_val'][i],
+            opacity=None if np.isnan(opacity) else opacity,
+        )
+        if expected.lulus != bool(result.lulus[i]):
+            raise AssertionError(f'Batch and scalar results differ at row {i}')
+
+
+def main(rows):
+    thresholds = default_thresholds()
+    readings = synthetic_readings(rows)
+
+    started = time.perf_counter()
+    result = thresholds.evaluate_batch(**readings)
+    batch_seconds = time.perf_counter() - started
+
+    sample = min(rows, 20000)
+    started = time.perf_counter()
+    check_parity(thresholds, readings, result, sample)
+    scalar_seconds = time.perf_counter() - started
+
+    print(f'rows:           {rows:,}')
+    print(f'pass rate:      {result.lulus.mean() * 100:.1f}%')
+    print(f'batch:          {batch_seconds:.3f}s ({rows / batch_seconds:,.0f} readings/s)')
+    print(f'scalar sample:  {scalar_seconds:.3f}s ({sample / scalar_seconds:,.0f} readings/s)')
+    print('parity:         ok')
+
+
+if __name__ == '__main__':
+    main(int(sys.argv[1]) if len(sys.argv) > 1 else 1000000)
@@ -1,12 +1,67 @@
-from flask import Blueprint, jsonify, request, current_app, render_template
+from flask import Blueprint, jsonify, request, current_app, render_template, send_file, url_for
 from flask_login import login_required, current_user
 from extensions import db, csrf
-from models import Config
+from models import Config, ExportJob, UploadJob
+from evaluate import Thresholds, refresh_thresholds
+from simulation import proposed_thresholds, simulate
+from regrade import start_regrade, resume_regrade, latest_job, job_progress
+import exports
+import batch_upload
+import changelog
+import pagination
+from background import spawn
 import json
 import datetime
+import threading
+import time
 
 api = Blueprint('api', __name__, url_prefix='/api/v1')
 
+# Seconds between sweeps for jobs whose worker stopped
+RESUME_INTERVAL = 30
+
+_last_resume = None
+_resume_lock = threading.Lock()
+
+@api.before_app_request
+def resume_interrupted_regrade():
+    """Pick up re-grade, export and upload jobs whose worker stopped.
+    
+    Runs every RESUME_INTERVAL seconds, not once per process: a job left
+    'running' by a restart only counts as stale STALE_SECONDS after its last
+    progress, which may well be after this process's first request.
+    """
+    global _last_resume
+    now = time.monotonic()
+    if _last_resume is not None and now - _last_resume < RESUME_INTERVAL:
+        return
+    if not _resume_lock.acquire(blocking=False):
+        return
+    try:
+        _last_resume = now
+        _resume_jobs()
+    finally:
+        _resume_lock.release()
+
+def _resume_jobs():
+    try:
+        resume_regrade(current_app._get_current_object())
+    except Exception as e:
+        db.session.rollback()
+        current_app.logger.error(f"Could not resume regrade job: {str(e)}")
+    try:
+        exports.resume_exports(current_app._get_current_object())
+        exports.purge_expired()
+    except Exception as e:
+        db.session.rollback()
+        current_app.logger.error(f"Could not resume export jobs: {str(e)}")
+    try:
+        batch_upload.resume_uploads(current_app._get_current_object())
+        batch_upload.purge_expired()
+    except Exception as e:
+        db.session.rollback()
+        current_app.logger.error(f"Could not resume upload jobs: {str(e)}")
+
 @api.route('/config', methods=['GET'])
 @login_required
 def get_config():
@@ -41,6 +96,7 @@ def update_config():
             return redirect(url_for('api.get_config'))
             
         config = Config.get_config()
+        previous = Thresholds.from_config(config)
         
         # Update basic parameters
         if 'co_max' in form_data:
@@ -88,6 +144,13 @@ def update_config():
         
         db.session.commit()
         
+        # Swap the compiled thresholds used for grading in this worker
+        thresholds = refresh_thresholds(config)
+        
+        # Re-grade stored results in the background, only if a limit changed
+        if not thresholds.same_limits(previous):
+            start_regrade(current_app._get_current_object(), current_user.id)
+        
         # Log the update
         current_app.logger.info(f"Configuration updated by user: {current_user.username}")
         
@@ -102,6 +165,236 @@ def update_config():
         flash(f'Error: {str(e)}', 'error')
         return redirect(url_for('api.get_config'))
 
+@api.route('/config/simulate', methods=['POST'])
+@login_required
+@csrf.exempt
+def simulate_config():
+    """Pass rates stored results would have under proposed limits.
+    
+    Read-only: the JSON body holds bensin_parameters, solar_parameters
+    and/or scalar limits overriding the current configuration, plus an
+    optional start_date/end_date (YYYY-MM-DD) range.
+    """
+    data = request.get_json(silent=True)
+    if not isinstance(data, dict):
+        return jsonify({'error': 'A JSON threshold document is required'}), 400
+        
+    try:
+        start = end = None
+        if data.get('start_date'):
+            start = datetime.datetime.strptime(data['start_date'], '%Y-%m-%d')
+        if data.get('end_date'):
+            end = datetime.datetime.strptime(data['end_date'], '%Y-%m-%d').replace(hour=23, minute=59, second=59)
+    except (TypeError, ValueError):
+        return jsonify({'error': 'Invalid date format. Use YYYY-MM-DD.'}), 400
+        
+    try:
+        thresholds = proposed_thresholds(data, Config.query.first())
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+        
+    try:
+        return jsonify(simulate(thresholds, start, end))
+    except Exception as e:
+        current_app.logger.error(str(e))
+        return jsonify({'error': 'Error running simulation'}), 500
+    finally:
+        db.session.rollback()
+
+@api.route('/regrade', methods=['GET'])
+@login_required
+def regrade_status():
+    """Progress and ETA of the latest re-grade job"""
+    job = latest_job()
+    if not job:
+        return jsonify({'error': 'No regrade job found'}), 404
+    return jsonify(job_progress(job))
+
+@api.route('/regrade', methods=['POST'])
+@login_required
+@csrf.exempt
+def start_regrade_job():
+    """Re-grade all stored results against the current configuration"""
+    if not current_user.is_admin():
+        return jsonify({'error': 'Admin privileges required'}), 403
+    try:
+        job = start_regrade(current_app._get_current_object(), current_user.id)
+        current_app.logger.info(f"Regrade job {job.id} started by user: {current_user.username}")
+        return jsonify(job_progress(job)), 202
+    except Exception as e:
+        db.session.rollback()
+        current_app.logger.error(str(e))
+        return jsonify({'error': 'Error starting regrade job'}), 500
+
+def _export_payload(job, reused=False):
+    payload = exports.job_progress(job)
+    payload['reused'] = reused
+    payload['status_url'] = url_for('api.export_status', job_id=job.id)
+    if job.status == 'completed':
+        payload['download_url'] = url_for('api.download_export', job_id=job.id)
+    return payload
+
+def _own_export_job(job_id):
+    """The export job if it belongs to the current user (or the user is an admin)"""
+    job = ExportJob.query.get(job_id)
+    if job and (job.user_id == current_user.id or current_user.is_admin()):
+        return job
+    return None
+
+@api.route('/exports', methods=['POST'])
+@login_required
+@csrf.exempt
+def start_export():
+    """Queue an export of results (kind=hasil_uji) or vehicles (kind=kendaraan)"""
+    values = request.get_json(silent=True) or request.form.to_dict() or request.args.to_dict()
+    try:
+        job, reused = exports.submit_export(
+            current_app._get_current_object(), values.get('kind', ''), values, current_user.id
+        )
+        if not reused:
+            current_app.logger.info(f"Export job {job.id} ({job.kind}) queued by user: {current_user.username}")
+        return jsonify(_export_payload(job, reused)), 200 if reused else 202
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    except Exception as e:
+        db.session.rollback()
+        current_app.logger.error(str(e))
+        return jsonify({'error': 'Error starting export job'}), 500
+
+@api.route('/exports/<int:job_id>', methods=['GET'])
+@login_required
+def export_status(job_id):
+    """Progress of an export job"""
+    job = _own_export_job(job_id)
+    if not job:
+        return jsonify({'error': 'Export job not found'}), 404
+    return jsonify(_export_payload(job))
+
+@api.route('/exports/<int:job_id>/download', methods=['GET'])
+@login_required
+def download_export(job_id):
+    """Download the file of a finished export job"""
+    job = _own_export_job(job_id)
+    if not job:
+        return jsonify({'error': 'Export job not found'}), 404
+    if job.status == 'expired':
+        return jsonify({'error': 'Export file has expired'}), 410
+    if job.status != 'completed' or not job.file_path:
+        return jsonify({'error': 'Export is not finished yet', 'status': job.status}), 409
+    try:
+        return send_file(
+            job.file_path,
+            as_attachment=True,
+            download_name=job.file_name,
+            mimetype=exports.EXPORT_KINDS[job.kind]['mimetype']
+        )
+    except FileNotFoundError:
+        return jsonify({'error': 'Export file has expired'}), 410
+
+def _upload_payload(job):
+    payload = batch_upload.job_progress(job)
+    payload['status_url'] = url_for('api.upload_status', job_id=job.id)
+    return payload
+
+def _own_upload_job(job_id):
+    """The upload job if it belongs to the current user (or the user is an admin)"""
+    job = UploadJob.query.get(job_id)
+    if job and (job.user_id == current_user.id or current_user.is_admin()):
+        return job
+    return None
+
+@api.route('/uploads/<int:job_id>', methods=['GET'])
+@login_required
+def upload_status(job_id):
+    """Progress of a vehicle upload job, with the first rejected rows"""
+    job = _own_upload_job(job_id)
+    if not job:
+        return jsonify({'error': 'Upload job not found'}), 404
+    return jsonify(_upload_payload(job))
+
+@api.route('/uploads/<int:job_id>/cancel', methods=['POST'])
+@login_required
+@csrf.exempt
+def cancel_upload(job_id):
+    """Stop an upload job after its current chunk; rows already committed stay"""
+    job = _own_upload_job(job_id)
+    if not job:
+        return jsonify({'error': 'Upload job not found'}), 404
+    try:
+        if not batch_upload.cancel_upload(job):
+            return jsonify({'error': 'Upload job is not running', 'status': job.status}), 409
+        db.session.refresh(job)
+        current_app.logger.info(f"Upload job {job.id} cancelled by user: {current_user.username}")
+        return jsonify(_upload_payload(job))
+    except Exception as e:
+        db.session.rollback()
+        current_app.logger.error(str(e))
+        return jsonify({'error': 'Error cancelling upload job'}), 500
+
+@api.route('/uploads/<int:job_id>/resume', methods=['POST'])
+@login_required
+@csrf.exempt
+def resume_upload(job_id):
+    """Continue a cancelled or failed upload job from its last committed chunk"""
+    job = _own_upload_job(job_id)
+    if not job:
+        return jsonify({'error': 'Upload job not found'}), 404
+    if job.status == 'expired':
+        return jsonify({'error': 'Upload file has expired'}), 410
+    try:
+        if not batch_upload.restart_upload(current_app._get_current_object(), job):
+            return jsonify({'error': 'Upload job cannot be resumed', 'status': job.status}), 409
+        db.session.refresh(job)
+        current_app.logger.info(f"Upload job {job.id} resumed by user: {current_user.username}")
+        return jsonify(_upload_payload(job)), 202
+    except Exception as e:
+        db.session.rollback()
+        current_app.logger.error(str(e))
+        return jsonify({'error': 'Error resuming upload job'}), 500
+
+@api.route('/changes', methods=['GET'])
+@login_required
+def changes():
+    """Inserts, updates and deletes of kendaraan and hasil_uji after a cursor, in commit order"""
+    since = request.args.get('since', '')
+    limit = request.args.get('limit', changelog.DEFAULT_PAGE_SIZE, type=int)
+    limit = max(1, min(limit, changelog.MAX_PAGE_SIZE))
+    tables = [t for t in request.args.get('table', '').split(',') if t]
+    if any(t not in changelog.TRACKED_COLUMNS for t in tables):
+        return jsonify({'error': f"table must be one of: {', '.join(changelog.TRACKED_COLUMNS)}"}), 400
+    
+    try:
+        if since == 'latest':
+            after_id = changelog.head()
+        elif since:
+            after_id = pagination.decode_cursor(since, 1)[0][0]
+            if not isinstance(after_id, int):
+                raise ValueError('Invalid cursor')
+        else:
+            after_id = 0
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    
+    try:
+        horizon = changelog.horizon()
+        if after_id and after_id < horizon:
+            return jsonify({
+                'error': 'Cursor is older than the compacted change log; resync from a full export',
+                'resync_cursor': pagination.encode_cursor([changelog.head()])
+            }), 410
+        
+        entries, last_id, has_more = changelog.changes_since(after_id, limit, tables)
+        if changelog.compaction_due():
+            spawn(current_app._get_current_object(), changelog.compact_if_due, name='changelog-compact')
+        return jsonify({
+            'changes': [changelog.serialize(entry) for entry in entries],
+            'next_cursor': pagination.encode_cursor([last_id]),
+            'has_more': has_more
+        })
+    except Exception as e:
+        current_app.logger.error(str(e))
+        return jsonify({'error': 'Error reading changes'}), 500
+
 @api.route('/health')
 def health_check():
     """API health check endpoint"""
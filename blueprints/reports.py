@@ -1,7 +1,11 @@
 from flask import Blueprint, render_template, request, jsonify, current_app, send_file, redirect, url_for, flash
-from sqlalchemy import exc, func, extract, case, distinct
+from sqlalchemy import exc, func, extract, case, distinct, true, literal
 from extensions import db
 from models import Kendaraan, HasilUji, User
+import rollups
+import pagination
+import search
+from caching import TTLCache
 from flask_login import login_required, current_user
 import tempfile
 from io import BytesIO
@@ -14,6 +18,65 @@ import os
 
 reports = Blueprint('reports', __name__)
 
+# Seconds a worker serves cached counts and statistics before recomputing them
+STATISTICS_TTL = 10
+
+# Rows fetched per round trip when streaming an export
+EXPORT_FETCH_SIZE = 2000
+
+# Every report counts each stored test, retests included, not only each
+# vehicle's latest result; payloads say so in 'basis'
+REPORT_BASIS = 'all_tests'
+
+_counts_cache = TTLCache(STATISTICS_TTL, tables=('hasil_uji', 'kendaraan'))
+_statistics_cache = TTLCache(STATISTICS_TTL, tables=('hasil_uji', 'kendaraan'))
+
+def _global_counts():
+    """Vehicle and test counts in one round trip"""
+    vehicles = db.session.query(
+        func.count(Kendaraan.id).label('total_kendaraan'),
+        func.coalesce(func.sum(case((Kendaraan.fuel_type == 'bensin', 1), else_=0)), 0).label('bensin'),
+        func.coalesce(func.sum(case((Kendaraan.fuel_type == 'solar', 1), else_=0)), 0).label('solar')
+    ).subquery()
+    tests = db.session.query(
+        func.count(HasilUji.id).label('total_results'),
+        func.coalesce(func.sum(case((HasilUji.valid == True, 1), else_=0)), 0).label('total_tests'),
+        func.coalesce(func.sum(case((HasilUji.lulus == True, 1), else_=0)), 0).label('passing_tests'),
+        func.coalesce(func.sum(case(((HasilUji.valid == True) & (HasilUji.lulus == False), 1), else_=0)), 0).label('failing_tests')
+    ).subquery()
+    return db.session.query(vehicles, tests).select_from(vehicles).join(tests, true()).one()._asdict()
+
+def global_counts():
+    """Vehicle and test counts, cached per worker"""
+    return _counts_cache.get_or_set(None, _global_counts)
+
+def result_filters(plat_nomor='', merek='', start_date='', end_date='', result=''):
+    """SQL conditions for the result filters shared by the dashboard and exports"""
+    filters = []
+    if plat_nomor:
+        filters.append(search.contains(Kendaraan.plat_nomor, plat_nomor))
+    if merek:
+        filters.append(search.contains(Kendaraan.merek, merek))
+    if start_date:
+        try:
+            start_date_obj = datetime.strptime(start_date, '%Y-%m-%d')
+            filters.append(HasilUji.tanggal >= start_date_obj)
+        except ValueError:
+            pass
+    if end_date:
+        try:
+            end_date_obj = datetime.strptime(end_date, '%Y-%m-%d')
+            # Set end_date to end of day
+            end_date_obj = datetime(end_date_obj.year, end_date_obj.month, end_date_obj.day, 23, 59, 59)
+            filters.append(HasilUji.tanggal <= end_date_obj)
+        except ValueError:
+            pass
+    if result == 'pass':
+        filters.append(HasilUji.lulus == True)
+    elif result == 'fail':
+        filters.append(HasilUji.lulus == False)
+    return filters
+
 @reports.route('/reports')
 @login_required
 def dashboard():
@@ -27,15 +90,30 @@ def dashboard():
         result = request.args.get('result', '')  # 'pass', 'fail', or ''
         
         # Pagination parameters
-        page = request.args.get('page', 1, type=int)
-        per_page = request.args.get('per_page', 20, type=int)
+        cursor = request.args.get('cursor', '')
+        per_page = pagination.parse_per_page(request.args.get('per_page', type=int), 20)
         
         # Get required data for the dashboard
-        total_kendaraan = Kendaraan.query.count()
-        total_valid = HasilUji.query.filter_by(valid=True).count()
-        total_lulus = HasilUji.query.filter_by(lulus=True).count()
+        counts = global_counts()
+        total_kendaraan = counts['total_kendaraan']
+        total_valid = counts['total_tests']
+        total_lulus = counts['passing_tests']
+        total_results = counts['total_results']
         
-        # Get combined data for vehicles and test results
+        # Apply filters
+        filters = result_filters(plat_nomor, merek, start_date, end_date, result)
+            
+        # If filters are applied, count the filtered set in one pass
+        if filters:
+            total_results, total_valid, total_lulus = db.session.query(
+                func.count(HasilUji.id),
+                func.coalesce(func.sum(case((HasilUji.valid == True, 1), else_=0)), 0),
+                func.coalesce(func.sum(case((HasilUji.lulus == True, 1), else_=0)), 0)
+            ).join(
+                Kendaraan, HasilUji.kendaraan_id == Kendaraan.id
+            ).filter(*filters).one()
+            
+        # Get combined data for vehicles and test results, newest first
         query = db.session.query(
             HasilUji, 
             Kendaraan,
@@ -44,64 +122,29 @@ def dashboard():
             Kendaraan, HasilUji.kendaraan_id == Kendaraan.id
         ).outerjoin(
             User, HasilUji.user_id == User.id
-        )
-        
-        # Apply filters
-        if plat_nomor:
-            query = query.filter(Kendaraan.plat_nomor.ilike(f'%{plat_nomor}%'))
-        if merek:
-            query = query.filter(Kendaraan.merek.ilike(f'%{merek}%'))
-        if start_date:
-            try:
-                start_date_obj = datetime.strptime(start_date, '%Y-%m-%d')
-                query = query.filter(HasilUji.tanggal >= start_date_obj)
-            except ValueError:
-                pass
-        if end_date:
-            try:
-                end_date_obj = datetime.strptime(end_date, '%Y-%m-%d')
-                # Set end_date to end of day
-                end_date_obj = datetime(end_date_obj.year, end_date_obj.month, end_date_obj.day, 23, 59, 59)
-                query = query.filter(HasilUji.tanggal <= end_date_obj)
-            except ValueError:
-                pass
-        if result == 'pass':
-            query = query.filter(HasilUji.lulus == True)
-        elif result == 'fail':
-            query = query.filter(HasilUji.lulus == False)
-            
-        # Order by date (newest first)
-        query = query.order_by(HasilUji.tanggal.desc())
-        
-        # Count total results for pagination
-        total_results = query.count()
-        
-        # Apply pagination
-        results = query.limit(per_page).offset((page - 1) * per_page).all()
+        ).filter(*filters)
+        
+        # Seek from the cursor instead of skipping rows, so deep pages stay cheap
+        try:
+            page = pagination.seek(
+                query, [HasilUji.tanggal, HasilUji.id],
+                key=lambda row: (row[0].tanggal, row[0].id),
+                cursor=cursor, per_page=per_page, descending=True
+            )
+        except ValueError:
+            flash('Cursor halaman tidak valid, menampilkan halaman pertama.', 'error')
+            args = {k: v for k, v in request.args.items() if k != 'cursor'}
+            return redirect(url_for('reports.dashboard', **args))
         
         # Format the data for template
         formatted_data = []
-        for hasil, kendaraan, user in results:
+        for hasil, kendaraan, user in page.items:
             formatted_data.append({
                 'hasil': hasil,
                 'kendaraan': kendaraan,
                 'operator': user.username if user else 'Unknown'
             })
         
-        # If filters are applied, update counts based on filtered query
-        if plat_nomor or merek or start_date or end_date or result:
-            valid_count = query.filter(HasilUji.valid == True).count()
-            pass_count = query.filter(HasilUji.lulus == True).count()
-            
-            # Override stats with filtered data
-            total_valid = valid_count
-            total_lulus = pass_count
-        
-        # Calculate pagination metadata
-        total_pages = (total_results + per_page - 1) // per_page
-        has_prev = page > 1
-        has_next = page < total_pages
-        
         return render_template(
             'halaman3.html',
             total_kendaraan=total_kendaraan,
@@ -109,12 +152,10 @@ def dashboard():
             total_lulus=total_lulus,
             data=formatted_data,
             # Pagination data
-            page=page,
             per_page=per_page,
-            total_pages=total_pages,
             total_results=total_results,
-            has_prev=has_prev,
-            has_next=has_next
+            next_cursor=page.next_cursor,
+            prev_cursor=page.prev_cursor
         )
     except Exception as e:
         current_app.logger.error(f"Error in dashboard: {str(e)}")
@@ -126,101 +167,114 @@ def dashboard():
             total_lulus=0,
             data=[],
             # Add pagination data to avoid template errors
-            page=1,
             per_page=20,
-            total_pages=0,
             total_results=0,
-            has_prev=False,
-            has_next=False
+            next_cursor=None,
+            prev_cursor=None
         )
 
+def _statistics_payload():
+    counts = global_counts()
+    
+    # Calculate pass rate
+    pass_rate = 0
+    if counts['total_tests'] > 0:
+        pass_rate = (counts['passing_tests'] / counts['total_tests']) * 100
+        
+    # Get test results by month (last 6 months)
+    today = datetime.today()
+    six_months_ago = today - timedelta(days=180)
+    
+    monthly_results = rollups.series('month', start=six_months_ago.date())
+    
+    monthly_data = []
+    for point in monthly_results:
+        month_name = datetime.strptime(point['period'], '%Y-%m').strftime('%b %Y')
+        monthly_data.append({
+            'month': month_name,
+            'passing': point['passed'],
+            'failing': point['failed'],
+            'total': point['tested']
+        })
+        
+    # Recent test results (last 10)
+    recent_tests = db.session.query(HasilUji, Kendaraan).join(
+        Kendaraan, HasilUji.kendaraan_id == Kendaraan.id
+    ).order_by(
+        HasilUji.tanggal.desc()
+    ).limit(10).all()
+    
+    recent_data = []
+    for hasil, kendaraan in recent_tests:
+        recent_data.append({
+            'id': hasil.id,
+            'plat_nomor': kendaraan.plat_nomor,
+            'merek': kendaraan.merek,
+            'tipe': kendaraan.tipe,
+            'tanggal': hasil.tanggal.strftime('%Y-%m-%d %H:%M'),
+            'lulus': hasil.lulus,
+            'fuel_type': kendaraan.fuel_type
+        })
+        
+    return {
+        'basis': REPORT_BASIS,
+        'total_kendaraan': counts['total_kendaraan'],
+        'total_tests': counts['total_tests'],
+        'passing_tests': counts['passing_tests'],
+        'failing_tests': counts['failing_tests'],
+        'pass_rate': round(pass_rate, 1),
+        'vehicle_types': {
+            'bensin': counts['bensin'],
+            'solar': counts['solar']
+        },
+        'monthly_results': monthly_data,
+        'recent_tests': recent_data
+    }
+
 @reports.route('/api/statistics')
 @login_required
 def statistics():
-    """Get global statistics for dashboard"""
+    """Get global statistics for dashboard, counting every test including retests"""
     try:
-        total_kendaraan = Kendaraan.query.count()
-        total_tests = HasilUji.query.filter_by(valid=True).count()
-        passing_tests = HasilUji.query.filter_by(lulus=True).count()
-        failing_tests = HasilUji.query.filter_by(lulus=False, valid=True).count()
-        
-        # Calculate pass rate
-        pass_rate = 0
-        if total_tests > 0:
-            pass_rate = (passing_tests / total_tests) * 100
-            
-        # Get vehicle type distribution
-        vehicle_types = db.session.query(
-            Kendaraan.fuel_type,
-            func.count(Kendaraan.id)
-        ).group_by(Kendaraan.fuel_type).all()
-        
-        vehicle_type_data = {
-            'bensin': 0,
-            'solar': 0
-        }
-        for fuel_type, count in vehicle_types:
-            vehicle_type_data[fuel_type] = count
-            
-        # Get test results by month (last 6 months)
-        today = datetime.today()
-        six_months_ago = today - timedelta(days=180)
-        
-        monthly_results = db.session.query(
-            extract('year', HasilUji.tanggal).label('year'),
-            extract('month', HasilUji.tanggal).label('month'),
-            func.count(case([(HasilUji.lulus == True, 1)])).label('passing'),
-            func.count(case([(HasilUji.lulus == False, 1)])).label('failing')
-        ).filter(
-            HasilUji.tanggal >= six_months_ago,
-            HasilUji.valid == True
-        ).group_by(
-            extract('year', HasilUji.tanggal),
-            extract('month', HasilUji.tanggal)
-        ).order_by(
-            extract('year', HasilUji.tanggal),
-            extract('month', HasilUji.tanggal)
-        ).all()
-        
-        monthly_data = []
-        for year, month, passing, failing in monthly_results:
-            month_name = datetime(int(year), int(month), 1).strftime('%b %Y')
-            monthly_data.append({
-                'month': month_name,
-                'passing': passing,
-                'failing': failing,
-                'total': passing + failing
-            })
-            
-        # Recent test results (last 10)
-        recent_tests = db.session.query(HasilUji, Kendaraan).join(
-            Kendaraan, HasilUji.kendaraan_id == Kendaraan.id
-        ).order_by(
-            HasilUji.tanggal.desc()
-        ).limit(10).all()
-        
-        recent_data = []
-        for hasil, kendaraan in recent_tests:
-            recent_data.append({
-                'id': hasil.id,
-                'plat_nomor': kendaraan.plat_nomor,
-                'merek': kendaraan.merek,
-                'tipe': kendaraan.tipe,
-                'tanggal': hasil.tanggal.strftime('%Y-%m-%d %H:%M'),
-                'lulus': hasil.lulus,
-                'fuel_type': kendaraan.fuel_type
-            })
+        return jsonify(_statistics_cache.get_or_set(None, _statistics_payload))
+    except Exception as e:
+        current_app.logger.error(str(e))
+        return jsonify({'error': str(e)}), 500
+
+@reports.route('/api/reports/time-series')
+@login_required
+def time_series():
+    """Test counts and average readings per day, week, month or year"""
+    granularity = request.args.get('granularity', 'month')
+    group_by = request.args.get('group_by') or None
+    filters = {name: request.args.get(name, '') for name in rollups.DIMENSIONS}
+    
+    dates = {}
+    for name in ('start_date', 'end_date'):
+        value = request.args.get(name, '')
+        try:
+            dates[name] = datetime.strptime(value, '%Y-%m-%d').date() if value else None
+        except ValueError:
+            return jsonify({'error': f'Invalid {name} format. Use YYYY-MM-DD.'}), 400
             
+    try:
+        points = rollups.series(
+            granularity,
+            start=dates['start_date'],
+            end=dates['end_date'],
+            filters=filters,
+            group_by=group_by
+        )
         return jsonify({
-            'total_kendaraan': total_kendaraan,
-            'total_tests': total_tests,
-            'passing_tests': passing_tests,
-            'failing_tests': failing_tests,
-            'pass_rate': round(pass_rate, 1),
-            'vehicle_types': vehicle_type_data,
-            'monthly_results': monthly_data,
-            'recent_tests': recent_data
+            'basis': REPORT_BASIS,
+            'granularity': granularity,
+            'start_date': dates['start_date'].isoformat() if dates['start_date'] else None,
+            'end_date': dates['end_date'].isoformat() if dates['end_date'] else None,
+            'group_by': group_by,
+            'series': points
         })
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
     except Exception as e:
         current_app.logger.error(str(e))
         return jsonify({'error': str(e)}), 500
@@ -228,59 +282,36 @@ def statistics():
 @reports.route('/api/reports/emissions-by-type')
 @login_required
 def emissions_by_type():
-    """Get average emissions by vehicle type"""
+    """Get average emissions by vehicle type over every test including retests"""
     try:
-        # For bensin vehicles
-        bensin_results = db.session.query(
-            Kendaraan.load_category,
-            func.avg(HasilUji.co).label('avg_co'),
-            func.avg(HasilUji.co2).label('avg_co2'),
-            func.avg(HasilUji.hc).label('avg_hc'),
-            func.avg(HasilUji.o2).label('avg_o2'),
-            func.avg(HasilUji.lambda_val).label('avg_lambda')
-        ).join(
-            HasilUji, Kendaraan.id == HasilUji.kendaraan_id
-        ).filter(
-            Kendaraan.fuel_type == 'bensin',
-            HasilUji.valid == True
-        ).group_by(
-            Kendaraan.load_category
-        ).all()
+        # Served from the running accumulators kept by rollups
+        categories = rollups.category_statistics()
         
-        bensin_data = []
-        for category, avg_co, avg_co2, avg_hc, avg_o2, avg_lambda in bensin_results:
-            display_name = 'Kendaraan Muatan' if category == 'kendaraan_muatan' else 'Kendaraan Penumpang'
-            bensin_data.append({
-                'category': display_name,
-                'avg_co': round(avg_co, 2) if avg_co else 0,
-                'avg_co2': round(avg_co2, 2) if avg_co2 else 0,
-                'avg_hc': round(avg_hc, 2) if avg_hc else 0,
-                'avg_o2': round(avg_o2, 2) if avg_o2 else 0,
-                'avg_lambda': round(avg_lambda, 2) if avg_lambda else 0
-            })
+        def rounded(value):
+            return round(value, 2) if value else 0
             
-        # For solar vehicles
-        solar_results = db.session.query(
-            Kendaraan.load_category,
-            func.avg(HasilUji.opacity).label('avg_opacity')
-        ).join(
-            HasilUji, Kendaraan.id == HasilUji.kendaraan_id
-        ).filter(
-            Kendaraan.fuel_type == 'solar',
-            HasilUji.valid == True
-        ).group_by(
-            Kendaraan.load_category
-        ).all()
-        
+        bensin_data = []
         solar_data = []
-        for category, avg_opacity in solar_results:
-            display_name = 'Kurang dari 3.5 Ton' if category == '<3.5ton' else 'Lebih dari atau sama dengan 3.5 Ton'
-            solar_data.append({
-                'category': display_name,
-                'avg_opacity': round(avg_opacity, 2) if avg_opacity else 0
-            })
-            
+        for stats in categories:
+            category = stats['load_category']
+            if stats['fuel_type'] == 'bensin':
+                display_name = 'Kendaraan Muatan' if category == 'kendaraan_muatan' else 'Kendaraan Penumpang'
+                entry = {'category': display_name, 'count': stats['count']}
+                for name, key in (('co', 'co'), ('co2', 'co2'), ('hc', 'hc'), ('o2', 'o2'), ('lambda_val', 'lambda')):
+                    entry[f'avg_{key}'] = rounded(stats[name]['mean'])
+                    entry[f'std_{key}'] = rounded(stats[name]['std'])
+                bensin_data.append(entry)
+            else:
+                display_name = 'Kurang dari 3.5 Ton' if category == '<3.5ton' else 'Lebih dari atau sama dengan 3.5 Ton'
+                solar_data.append({
+                    'category': display_name,
+                    'count': stats['count'],
+                    'avg_opacity': rounded(stats['opacity']['mean']),
+                    'std_opacity': rounded(stats['opacity']['std'])
+                })
+                
         return jsonify({
+            'basis': REPORT_BASIS,
             'bensin': bensin_data,
             'solar': solar_data
         })
@@ -288,340 +319,398 @@ def emissions_by_type():
         current_app.logger.error(str(e))
         return jsonify({'error': str(e)}), 500
 
+# Lower bounds (in years) of the default age buckets: 0-5, 6-10, 11-15, 16+
+DEFAULT_AGE_BUCKETS = (0, 6, 11, 16)
+
+# Vehicles older than this are left out of the age report
+MAX_VEHICLE_AGE = 100
+
+# One bucket per year of age, so bucket_size=1 is never cut short
+MAX_AGE_BUCKETS = MAX_VEHICLE_AGE + 1
+
+def parse_age_buckets(args):
+    """Bucket lower bounds from ?buckets=0,6,11,16 or ?bucket_size=N"""
+    if args.get('bucket_size'):
+        try:
+            size = int(args['bucket_size'])
+        except ValueError:
+            raise ValueError('bucket_size must be a whole number of years')
+        if size < 1:
+            raise ValueError('bucket_size must be at least 1')
+        bounds = list(range(0, MAX_VEHICLE_AGE + 1, size))
+    elif args.get('buckets'):
+        try:
+            bounds = [int(b) for b in args['buckets'].split(',') if b.strip()]
+        except ValueError:
+            raise ValueError('buckets must be a comma-separated list of whole years')
+        if not bounds or any(b < 0 for b in bounds) or bounds != sorted(set(bounds)):
+            raise ValueError('buckets must be ascending, distinct and not negative')
+        if len(bounds) > MAX_AGE_BUCKETS:
+            raise ValueError(f'At most {MAX_AGE_BUCKETS} buckets are allowed')
+    else:
+        bounds = list(DEFAULT_AGE_BUCKETS)
+    return bounds
+
+def age_bucket_label(bounds, index):
+    low = bounds[index]
+    if index == len(bounds) - 1:
+        return f'{low}+ tahun'
+    high = bounds[index + 1] - 1
+    return f'{low} tahun' if low == high else f'{low}-{high} tahun'
+
+def _pass_counts(passing, failing):
+    total = passing + failing
+    return {
+        'passing': passing,
+        'failing': failing,
+        'total': total,
+        'pass_rate': round(passing / total * 100, 1) if total else 0
+    }
+
 @reports.route('/api/reports/vehicle-age-performance')
 @login_required
 def vehicle_age_performance():
-    """Get pass/fail statistics by vehicle age"""
+    """Get pass/fail statistics by vehicle age over every valid test.
+    
+    A retested vehicle counts once per test, not once per vehicle. Buckets
+    default to 0-5, 6-10, 11-15 and 16+ years and can be set with
+    ?buckets=0,5,10 (lower bounds) or ?bucket_size=1. With ?breakdown=1
+    each bucket is also split by fuel_type and load_category.
+    """
     try:
-        current_year = datetime.now().year
-        
-        # Age categories: 0-5, 6-10, 11-15, 16+
-        age_categories = [
-            {'min': 0, 'max': 5, 'label': '0-5 tahun'},
-            {'min': 6, 'max': 10, 'label': '6-10 tahun'},
-            {'min': 11, 'max': 15, 'label': '11-15 tahun'},
-            {'min': 16, 'max': 100, 'label': '16+ tahun'}
+        bounds = parse_age_buckets(request.args)
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    breakdown = request.args.get('breakdown') in ('1', 'true')
+    
+    try:
+        age = datetime.now().year - Kendaraan.tahun
+        if len(bounds) > 1:
+            bucket = case(
+                *[(age < bound, i) for i, bound in enumerate(bounds[1:])],
+                else_=len(bounds) - 1
+            ).label('bucket')
+        else:
+            bucket = literal(0).label('bucket')
+        columns = [
+            bucket,
+            func.count(case([(HasilUji.lulus == True, 1)])).label('passing'),
+            func.count(case([(HasilUji.lulus == False, 1)])).label('failing')
         ]
-        
-        results = []
-        
-        for category in age_categories:
-            min_year = current_year - category['max']
-            max_year = current_year - category['min']
+        groups = [bucket]
+        if breakdown:
+            columns[1:1] = [Kendaraan.fuel_type, Kendaraan.load_category]
+            groups += [Kendaraan.fuel_type, Kendaraan.load_category]
             
-            # Get passing and failing counts
-            data = db.session.query(
-                func.count(case([(HasilUji.lulus == True, 1)])).label('passing'),
-                func.count(case([(HasilUji.lulus == False, 1)])).label('failing')
-            ).join(
-                Kendaraan, HasilUji.kendaraan_id == Kendaraan.id
-            ).filter(
-                Kendaraan.tahun >= min_year,
-                Kendaraan.tahun <= max_year,
-                HasilUji.valid == True
-            ).first()
-            
-            passing = data.passing if data else 0
-            failing = data.failing if data else 0
-            total = passing + failing
-            
-            pass_rate = 0
-            if total > 0:
-                pass_rate = (passing / total) * 100
+        # One scan over the join, bucketed in SQL
+        rows = db.session.query(*columns).join(
+            Kendaraan, HasilUji.kendaraan_id == Kendaraan.id
+        ).filter(
+            age >= bounds[0],
+            age <= MAX_VEHICLE_AGE,
+            HasilUji.valid == True
+        ).group_by(*groups).order_by(*groups).all()
+        
+        results = [
+            dict(age_range=age_bucket_label(bounds, i), basis=REPORT_BASIS, **_pass_counts(0, 0))
+            for i in range(len(bounds))
+        ]
+        if breakdown:
+            for result in results:
+                result['breakdown'] = []
+        for row in rows:
+            result = results[row.bucket]
+            result.update(_pass_counts(
+                result['passing'] + row.passing,
+                result['failing'] + row.failing
+            ))
+            if breakdown:
+                result['breakdown'].append(dict(
+                    fuel_type=row.fuel_type,
+                    load_category=row.load_category,
+                    **_pass_counts(row.passing, row.failing)
+                ))
                 
-            results.append({
-                'age_range': category['label'],
-                'passing': passing,
-                'failing': failing,
-                'total': total,
-                'pass_rate': round(pass_rate, 1)
-            })
-            
         return jsonify(results)
     except Exception as e:
         current_app.logger.error(str(e))
         return jsonify({'error': str(e)}), 500
 
-@reports.route('/export-excel')
-@login_required
-def export_excel():
-    """Export detailed test results to Excel"""
-    try:
-        # Filter parameters
-        plat_nomor = request.args.get('plat_nomor', '')
-        merek = request.args.get('merek', '')
-        start_date = request.args.get('start_date', '')
-        end_date = request.args.get('end_date', '')
-        result = request.args.get('result', '')  # 'pass', 'fail', or ''
-        
-        # Base query joining all tables
-        query = db.session.query(HasilUji, Kendaraan, User).join(
-            Kendaraan, HasilUji.kendaraan_id == Kendaraan.id
-        ).outerjoin(
-            User, HasilUji.user_id == User.id
+def iter_result_chunks(filters):
+    """Export columns for the filtered results, newest first, one chunk per query.
+    
+    Each chunk is its own short SELECT seeking past the previous one, so no
+    read stays open on the database between chunks.
+    """
+    query = db.session.query(
+        HasilUji.tanggal,
+        Kendaraan.plat_nomor,
+        Kendaraan.merek,
+        Kendaraan.tipe,
+        Kendaraan.tahun,
+        Kendaraan.fuel_type,
+        Kendaraan.load_category,
+        HasilUji.co,
+        HasilUji.co2,
+        HasilUji.hc,
+        HasilUji.o2,
+        HasilUji.lambda_val,
+        HasilUji.opacity,
+        HasilUji.lulus,
+        User.username,
+        HasilUji.id
+    ).join(
+        Kendaraan, HasilUji.kendaraan_id == Kendaraan.id
+    ).outerjoin(
+        User, HasilUji.user_id == User.id
+    ).filter(*filters)
+    cursor = None
+    while True:
+        page = pagination.seek(
+            query, [HasilUji.tanggal, HasilUji.id],
+            key=lambda row: (row.tanggal, row.id),
+            cursor=cursor, per_page=EXPORT_FETCH_SIZE, descending=True
         )
-        
-        # Apply filters
-        if plat_nomor:
-            query = query.filter(Kendaraan.plat_nomor.ilike(f'%{plat_nomor}%'))
-        if merek:
-            query = query.filter(Kendaraan.merek.ilike(f'%{merek}%'))
-        if start_date:
-            try:
-                start_date_obj = datetime.strptime(start_date, '%Y-%m-%d')
-                query = query.filter(HasilUji.tanggal >= start_date_obj)
-            except ValueError:
-                pass
-        if end_date:
-            try:
-                end_date_obj = datetime.strptime(end_date, '%Y-%m-%d')
-                end_date_obj = datetime(end_date_obj.year, end_date_obj.month, end_date_obj.day, 23, 59, 59)
-                query = query.filter(HasilUji.tanggal <= end_date_obj)
-            except ValueError:
-                pass
-        if result == 'pass':
-            query = query.filter(HasilUji.lulus == True)
-        elif result == 'fail':
-            query = query.filter(HasilUji.lulus == False)
-            
-        # Order by date
-        query = query.order_by(HasilUji.tanggal.desc())
-        
-        # Get results
-        results = query.all()
-        
-        # Create Excel file in memory
-        output = BytesIO()
-        workbook = xlsxwriter.Workbook(output)
-        worksheet = workbook.add_worksheet('Test Results')
-        
-        # Add header row with formatting
-        header_format = workbook.add_format({
-            'bold': True,
-            'bg_color': '#4472C4',
-            'font_color': 'white',
-            'border': 1
-        })
-        
-        # Define data formats
-        date_format = workbook.add_format({'num_format': 'yyyy-mm-dd hh:mm:ss'})
-        
-        pass_format = workbook.add_format({
-            'bg_color': '#C6EFCE',
-            'font_color': '#006100'
-        })
-        
-        fail_format = workbook.add_format({
-            'bg_color': '#FFC7CE',
-            'font_color': '#9C0006'
-        })
-        
-        # Set up header row
-        headers = [
-            'Tanggal Uji', 'Plat Nomor', 'Merek', 'Tipe', 'Tahun',
-            'Bahan Bakar', 'Kategori Beban', 'CO (%)', 'CO2 (%)',
-            'HC (ppm)', 'O2 (%)', 'Lambda', 'Opacity (%)', 'Hasil',
-            'Operator'
-        ]
-        
-        for col, header in enumerate(headers):
-            worksheet.write(0, col, header, header_format)
-            
-        # Set column widths
-        worksheet.set_column('A:A', 20)  # Date
-        worksheet.set_column('B:B', 15)  # Plate
-        worksheet.set_column('C:D', 15)  # Make/Model
-        worksheet.set_column('E:G', 15)  # Year/Fuel/Category
-        worksheet.set_column('H:M', 12)  # Test values
-        worksheet.set_column('N:N', 10)  # Result
-        worksheet.set_column('O:O', 15)  # Operator
-        
-        # Write data rows
-        for i, (hasil, kendaraan, user) in enumerate(results, start=1):
-            row = [
-                hasil.tanggal,
-                kendaraan.plat_nomor,
-                kendaraan.merek,
-                kendaraan.tipe,
-                kendaraan.tahun,
-                'Bensin' if kendaraan.fuel_type == 'bensin' else 'Solar',
-                display_load_category(kendaraan.load_category),
-                hasil.co,
-                hasil.co2,
-                hasil.hc,
-                hasil.o2,
-                hasil.lambda_val,
-                hasil.opacity,
-                'LULUS' if hasil.lulus else 'GAGAL',
-                user.username if user else 'Unknown'
-            ]
-            
-            # Apply formatting
-            result_format = pass_format if hasil.lulus else fail_format
-            
-            # Write each cell with appropriate formatting
-            for col, value in enumerate(row):
-                if col == 0:  # Date column
-                    worksheet.write_datetime(i, col, value, date_format)
-                elif col == 13:  # Result column
-                    worksheet.write(i, col, value, result_format)
-                else:
-                    worksheet.write(i, col, value)
-                    
-        # Add auto-filter
-        worksheet.autofilter(0, 0, len(results), len(headers) - 1)
-        
-        # Add second worksheet for summary
-        summary_sheet = workbook.add_worksheet('Summary')
-        
-        # Add title with formatting
-        title_format = workbook.add_format({
-            'bold': True,
-            'font_size': 14,
-            'align': 'center',
-            'valign': 'vcenter'
-        })
-        
-        section_format = workbook.add_format({
-            'bold': True,
-            'font_size': 12,
-            'bg_color': '#D9E1F2',
-            'border': 1
-        })
-        
-        # Calculate summary statistics
-        total_tests = len(results)
-        passing_tests = sum(1 for hasil, _, _ in results if hasil.lulus)
-        failing_tests = total_tests - passing_tests
-        pass_rate = (passing_tests / total_tests * 100) if total_tests > 0 else 0
-        
-        # Add title
-        summary_sheet.merge_range('A1:D1', 'Laporan Ringkasan Uji Emisi', title_format)
-        summary_sheet.set_column('A:A', 25)
-        summary_sheet.set_column('B:D', 15)
-        
-        # Basic statistics
-        summary_sheet.write(2, 0, 'Statistik Dasar', section_format)
-        summary_sheet.merge_range('B3:D3', '', section_format)
-        
-        row = 3
-        summary_sheet.write(row, 0, 'Total Pengujian')
-        summary_sheet.write(row, 1, total_tests)
-        
-        row += 1
-        summary_sheet.write(row, 0, 'Pengujian Lulus')
-        summary_sheet.write(row, 1, passing_tests)
-        
-        row += 1
-        summary_sheet.write(row, 0, 'Pengujian Gagal')
-        summary_sheet.write(row, 1, failing_tests)
-        
-        row += 1
-        summary_sheet.write(row, 0, 'Tingkat Kelulusan')
-        summary_sheet.write(row, 1, f'{pass_rate:.1f}%')
-        
-        # By fuel type
-        row += 2
-        summary_sheet.write(row, 0, 'Berdasarkan Bahan Bakar', section_format)
-        summary_sheet.merge_range(f'B{row+1}:D{row+1}', '', section_format)
-        
-        # Bensin statistics
-        bensin_tests = [(hasil, kendaraan) for hasil, kendaraan, _ in results if kendaraan.fuel_type == 'bensin']
-        bensin_total = len(bensin_tests)
-        bensin_passing = sum(1 for hasil, _ in bensin_tests if hasil.lulus)
-        bensin_rate = (bensin_passing / bensin_total * 100) if bensin_total > 0 else 0
-        
-        row += 1
-        summary_sheet.write(row, 0, 'Total Bensin')
-        summary_sheet.write(row, 1, bensin_total)
-        
-        row += 1
-        summary_sheet.write(row, 0, 'Lulus (Bensin)')
-        summary_sheet.write(row, 1, bensin_passing)
-        
-        row += 1
-        summary_sheet.write(row, 0, 'Tingkat Kelulusan (Bensin)')
-        summary_sheet.write(row, 1, f'{bensin_rate:.1f}%')
-        
-        # Solar statistics
-        solar_tests = [(hasil, kendaraan) for hasil, kendaraan, _ in results if kendaraan.fuel_type == 'solar']
-        solar_total = len(solar_tests)
-        solar_passing = sum(1 for hasil, _ in solar_tests if hasil.lulus)
-        solar_rate = (solar_passing / solar_total * 100) if solar_total > 0 else 0
+        if page.items:
+            yield page.items
+        if not page.has_next:
+            return
+        cursor = page.next_cursor
+
+def count_results(filter_values):
+    return db.session.query(func.count(HasilUji.id)).join(
+        Kendaraan, HasilUji.kendaraan_id == Kendaraan.id
+    ).filter(*result_filters(**filter_values)).scalar()
+
+def _export_summary(filters):
+    """Test and pass counts per fuel type for the filtered results"""
+    rows = db.session.query(
+        Kendaraan.fuel_type,
+        func.count(HasilUji.id),
+        func.coalesce(func.sum(case((HasilUji.lulus == True, 1), else_=0)), 0)
+    ).join(
+        Kendaraan, HasilUji.kendaraan_id == Kendaraan.id
+    ).filter(*filters).group_by(Kendaraan.fuel_type).all()
+    return {fuel_type: (total, passing) for fuel_type, total, passing in rows}
+
+def write_results_workbook(target, filter_values, username, progress=None):
+    """Write the detailed results workbook to a path or binary file.
+    
+    Rows are streamed from the database in chunks into xlsxwriter's
+    constant-memory mode, so memory use does not grow with the number of
+    results. ``progress`` is called with the running row count after each
+    chunk. Returns the number of result rows written.
+    """
+    filters = result_filters(**filter_values)
+    workbook = xlsxwriter.Workbook(target, {'constant_memory': True})
+    worksheet = workbook.add_worksheet('Test Results')
+    
+    # Add header row with formatting
+    header_format = workbook.add_format({
+        'bold': True,
+        'bg_color': '#4472C4',
+        'font_color': 'white',
+        'border': 1
+    })
+    
+    # Define data formats
+    date_format = workbook.add_format({'num_format': 'yyyy-mm-dd hh:mm:ss'})
+    
+    pass_format = workbook.add_format({
+        'bg_color': '#C6EFCE',
+        'font_color': '#006100'
+    })
+    
+    fail_format = workbook.add_format({
+        'bg_color': '#FFC7CE',
+        'font_color': '#9C0006'
+    })
+    
+    # Set up header row
+    headers = [
+        'Tanggal Uji', 'Plat Nomor', 'Merek', 'Tipe', 'Tahun',
+        'Bahan Bakar', 'Kategori Beban', 'CO (%)', 'CO2 (%)',
+        'HC (ppm)', 'O2 (%)', 'Lambda', 'Opacity (%)', 'Hasil',
+        'Operator'
+    ]
+    
+    # Set column widths
+    worksheet.set_column('A:A', 20)  # Date
+    worksheet.set_column('B:B', 15)  # Plate
+    worksheet.set_column('C:D', 15)  # Make/Model
+    worksheet.set_column('E:G', 15)  # Year/Fuel/Category
+    worksheet.set_column('H:M', 12)  # Test values
+    worksheet.set_column('N:N', 10)  # Result
+    worksheet.set_column('O:O', 15)  # Operator
+    
+    for col, header in enumerate(headers):
+        worksheet.write(0, col, header, header_format)
+    
+    # Write data rows; constant-memory mode needs them strictly in row order
+    written = 0
+    for rows in iter_result_chunks(filters):
+        for (tanggal, plat, merek, tipe, tahun, fuel_type, load_category,
+             co, co2, hc, o2, lambda_val, opacity, lulus, operator, _) in rows:
+            written += 1
+            worksheet.write(written, 0, tanggal, date_format)
+            worksheet.write_row(written, 1, [
+                plat,
+                merek,
+                tipe,
+                tahun,
+                'Bensin' if fuel_type == 'bensin' else 'Solar',
+                display_load_category(load_category),
+                co,
+                co2,
+                hc,
+                o2,
+                lambda_val,
+                opacity
+            ])
+            worksheet.write(written, 13, 'LULUS' if lulus else 'GAGAL', pass_format if lulus else fail_format)
+            worksheet.write(written, 14, operator or 'Unknown')
+        if progress:
+            progress(written)
+    
+    # Add auto-filter
+    worksheet.autofilter(0, 0, written, len(headers) - 1)
+    
+    # Add second worksheet for summary
+    summary_sheet = workbook.add_worksheet('Summary')
+    
+    # Add title with formatting
+    title_format = workbook.add_format({
+        'bold': True,
+        'font_size': 14,
+        'align': 'center',
+        'valign': 'vcenter'
+    })
+    
+    section_format = workbook.add_format({
+        'bold': True,
+        'font_size': 12,
+        'bg_color': '#D9E1F2',
+        'border': 1
+    })
+    
+    # Calculate summary statistics
+    by_fuel = _export_summary(filters)
+    total_tests = sum(total for total, _ in by_fuel.values())
+    passing_tests = sum(passing for _, passing in by_fuel.values())
+    failing_tests = total_tests - passing_tests
+    pass_rate = (passing_tests / total_tests * 100) if total_tests > 0 else 0
+    
+    # Add title
+    summary_sheet.set_column('A:A', 25)
+    summary_sheet.set_column('B:D', 15)
+    summary_sheet.merge_range('A1:D1', 'Laporan Ringkasan Uji Emisi', title_format)
+    
+    # Basic statistics
+    summary_sheet.write(2, 0, 'Statistik Dasar', section_format)
+    summary_sheet.merge_range('B3:D3', '', section_format)
+    
+    row = 3
+    summary_sheet.write(row, 0, 'Total Pengujian')
+    summary_sheet.write(row, 1, total_tests)
+    
+    row += 1
+    summary_sheet.write(row, 0, 'Pengujian Lulus')
+    summary_sheet.write(row, 1, passing_tests)
+    
+    row += 1
+    summary_sheet.write(row, 0, 'Pengujian Gagal')
+    summary_sheet.write(row, 1, failing_tests)
+    
+    row += 1
+    summary_sheet.write(row, 0, 'Tingkat Kelulusan')
+    summary_sheet.write(row, 1, f'{pass_rate:.1f}%')
+    
+    # By fuel type
+    row += 2
+    summary_sheet.write(row, 0, 'Berdasarkan Bahan Bakar', section_format)
+    summary_sheet.merge_range(f'B{row+1}:D{row+1}', '', section_format)
+    
+    for fuel_type, label in (('bensin', 'Bensin'), ('solar', 'Solar')):
+        fuel_total, fuel_passing = by_fuel.get(fuel_type, (0, 0))
+        fuel_rate = (fuel_passing / fuel_total * 100) if fuel_total > 0 else 0
         
         row += 1
-        summary_sheet.write(row, 0, 'Total Solar')
-        summary_sheet.write(row, 1, solar_total)
+        summary_sheet.write(row, 0, f'Total {label}')
+        summary_sheet.write(row, 1, fuel_total)
         
         row += 1
-        summary_sheet.write(row, 0, 'Lulus (Solar)')
-        summary_sheet.write(row, 1, solar_passing)
+        summary_sheet.write(row, 0, f'Lulus ({label})')
+        summary_sheet.write(row, 1, fuel_passing)
         
         row += 1
-        summary_sheet.write(row, 0, 'Tingkat Kelulusan (Solar)')
-        summary_sheet.write(row, 1, f'{solar_rate:.1f}%')
-        
-        # Report metadata
+        summary_sheet.write(row, 0, f'Tingkat Kelulusan ({label})')
+        summary_sheet.write(row, 1, f'{fuel_rate:.1f}%')
+    
+    # Report metadata
+    row += 2
+    summary_sheet.write(row, 0, 'Informasi Laporan', section_format)
+    summary_sheet.merge_range(f'B{row+1}:D{row+1}', '', section_format)
+    
+    row += 1
+    summary_sheet.write(row, 0, 'Laporan Dibuat Oleh')
+    summary_sheet.write(row, 1, username)
+    
+    row += 1
+    summary_sheet.write(row, 0, 'Tanggal Laporan')
+    summary_sheet.write_datetime(row, 1, datetime.now(), date_format)
+    
+    # Filter details
+    labels = (
+        ('plat_nomor', 'Plat Nomor'),
+        ('merek', 'Merek'),
+        ('start_date', 'Dari Tanggal'),
+        ('end_date', 'Sampai Tanggal'),
+        ('result', 'Hasil Uji')
+    )
+    if any(filter_values.get(name) for name, _ in labels):
         row += 2
-        summary_sheet.write(row, 0, 'Informasi Laporan', section_format)
+        summary_sheet.write(row, 0, 'Filter yang Digunakan', section_format)
         summary_sheet.merge_range(f'B{row+1}:D{row+1}', '', section_format)
         
-        row += 1
-        summary_sheet.write(row, 0, 'Laporan Dibuat Oleh')
-        summary_sheet.write(row, 1, current_user.username)
-        
-        row += 1
-        summary_sheet.write(row, 0, 'Tanggal Laporan')
-        summary_sheet.write_datetime(row, 1, datetime.now(), date_format)
-        
-        # Filter details
-        if any([plat_nomor, merek, start_date, end_date, result]):
-            row += 2
-            summary_sheet.write(row, 0, 'Filter yang Digunakan', section_format)
-            summary_sheet.merge_range(f'B{row+1}:D{row+1}', '', section_format)
-            
-            if plat_nomor:
-                row += 1
-                summary_sheet.write(row, 0, 'Plat Nomor')
-                summary_sheet.write(row, 1, plat_nomor)
-                
-            if merek:
-                row += 1
-                summary_sheet.write(row, 0, 'Merek')
-                summary_sheet.write(row, 1, merek)
-                
-            if start_date:
-                row += 1
-                summary_sheet.write(row, 0, 'Dari Tanggal')
-                summary_sheet.write(row, 1, start_date)
-                
-            if end_date:
-                row += 1
-                summary_sheet.write(row, 0, 'Sampai Tanggal')
-                summary_sheet.write(row, 1, end_date)
-                
-            if result:
+        for name, label in labels:
+            value = filter_values.get(name)
+            if value:
+                if name == 'result':
+                    value = 'LULUS' if value == 'pass' else 'GAGAL'
                 row += 1
-                summary_sheet.write(row, 0, 'Hasil Uji')
-                summary_sheet.write(row, 1, 'LULUS' if result == 'pass' else 'GAGAL')
-        
-        # Close workbook
-        workbook.close()
+                summary_sheet.write(row, 0, label)
+                summary_sheet.write(row, 1, value)
+    
+    workbook.close()
+    return written
+
+@reports.route('/export-excel')
+@login_required
+def export_excel():
+    """Export detailed test results to Excel"""
+    try:
+        # Filter parameters
+        filter_values = {
+            name: request.args.get(name, '')
+            for name in ('plat_nomor', 'merek', 'start_date', 'end_date', 'result')
+        }
         
-        # Reset file pointer
-        output.seek(0)
+        # Build the workbook in an anonymous temp file that is removed when
+        # the response closes it
+        output = tempfile.TemporaryFile(suffix='.xlsx')
+        try:
+            write_results_workbook(output, filter_values, current_user.username)
+            output.seek(0)
+        except Exception:
+            output.close()
+            raise
         
         # Generate filename with timestamp
         timestamp = time.strftime("%Y%m%d-%H%M%S")
         filename = f'laporan_uji_emisi_{timestamp}.xlsx'
         
-        # Create temporary file
-        with tempfile.NamedTemporaryFile(delete=False, suffix='.xlsx') as tmp:
-            tmp.write(output.read())
-            tmp_path = tmp.name
-            
         return send_file(
-            tmp_path,
+            output,
             as_attachment=True,
             download_name=filename,
             mimetype='application/vnd.openxmlformats-officedocument.spreadsheetml.sheet'
@@ -1,14 +1,136 @@
 from flask import Blueprint, render_template, request, jsonify, current_app, redirect, url_for, flash
-from sqlalchemy import exc
+from sqlalchemy import exc, bindparam, select
 from extensions import db, csrf
-from models import Kendaraan, HasilUji, Config
+from models import Kendaraan, HasilUji, SesiUji, SampelUjiBlok, User, normalize_plate
+from evaluate import evaluate, evaluate_batch, get_thresholds, READING_COLUMNS
+import sampling
+import rollups
+import pagination
+import search
 from flask_login import login_required, current_user
 import time
+import math
 from datetime import datetime
 import json
 
 tests = Blueprint('tests', __name__)
 
+# Upper bound on readings accepted by one batch request
+MAX_BATCH_READINGS = 10000
+
+# Keeps IN (...) lists under SQLite's bound-parameter limit
+SQL_IN_CHUNK = 500
+
+# Upper bound on results returned by one history request
+MAX_HISTORY_RESULTS = 500
+
+# Upper bound on plates resolved by one lookup request
+MAX_LOOKUP_PLATES = 100
+
+# Upper bound on sample blocks returned by one read
+MAX_SAMPLE_BLOCKS = 10
+
+def parse_reading(fuel_type, data):
+    """Validate submitted emission values for a vehicle's fuel type.
+    
+    Returns (values, error): values maps every READING_COLUMNS entry to a
+    float (opacity is None for bensin), error is a message or None.
+    """
+    if fuel_type == 'bensin':
+        required = ['co', 'co2', 'hc', 'o2', 'lambda_val']
+        missing = [f for f in required if not data.get(f)]
+        if missing:
+            return None, f'Missing required fields for bensin: {", ".join(missing)}'
+        try:
+            values = {f: float(data.get(f, 0)) for f in required}
+        except (TypeError, ValueError):
+            return None, 'All values must be valid numbers'
+        values['opacity'] = None  # Not applicable for bensin
+    else:  # Solar/diesel
+        if 'opacity' not in data:
+            return None, 'Opacity value is required for solar vehicles'
+        try:
+            opacity = float(data.get('opacity', 0))
+        except (TypeError, ValueError):
+            return None, 'Opacity must be a valid number'
+        # Default values for other fields (not used for solar)
+        values = {'co': 0, 'co2': 0, 'hc': 0, 'o2': 0, 'lambda_val': 0, 'opacity': opacity}
+        
+    # Reject what the hasil_uji CHECK constraints would, before any insert
+    for name, value in values.items():
+        if value is None:
+            continue
+        if not math.isfinite(value):
+            return None, f'{name} must be a finite number'
+        if value < 0:
+            return None, f'{name} must be non-negative'
+    return values, None
+
+def refresh_latest_results(kendaraan_ids):
+    """Point each vehicle's hasil_terakhir_id at its newest result.
+    
+    One lookup on the (kendaraan_id, tanggal) index per vehicle; the caller
+    commits.
+    """
+    kendaraan_ids = list(kendaraan_ids)
+    if not kendaraan_ids:
+        return
+    kendaraan = Kendaraan.__table__
+    hasil = HasilUji.__table__
+    latest = select(hasil.c.id).where(
+        hasil.c.kendaraan_id == kendaraan.c.id
+    ).order_by(hasil.c.tanggal.desc(), hasil.c.id.desc()).limit(1).scalar_subquery()
+    db.session.execute(
+        kendaraan.update().where(kendaraan.c.id == bindparam('kendaraan_key')).values(
+            hasil_terakhir_id=latest,
+            updated_at=kendaraan.c.updated_at
+        ),
+        [{'kendaraan_key': kendaraan_id} for kendaraan_id in kendaraan_ids]
+    )
+    
+def record_result(kendaraan, values, tanggal=None):
+    """Grade a reading and append it to the vehicle's test history.
+    
+    The caller commits. Returns (hasil, evaluation).
+    """
+    evaluation = evaluate(kendaraan, **values)
+    hasil = HasilUji(
+        kendaraan_id=kendaraan.id,
+        lulus=evaluation.lulus,
+        valid=True,
+        user_id=current_user.id,
+        tanggal=tanggal or datetime.now(),
+        **values
+    )
+    db.session.add(hasil)
+    db.session.flush()
+    refresh_latest_results([kendaraan.id])
+    rollups.apply_rows([dict(
+        values,
+        tanggal=hasil.tanggal,
+        valid=True,
+        lulus=evaluation.lulus,
+        fuel_type=kendaraan.fuel_type,
+        load_category=kendaraan.load_category,
+        jenis=kendaraan.jenis
+    )])
+    db.session.expire(kendaraan, ['hasil_terakhir_id', 'hasil_terakhir'])
+    return hasil, evaluation
+
+def result_response(kendaraan, evaluation):
+    """Response body for a freshly recorded result"""
+    return {
+        'success': True,
+        'lulus': evaluation.lulus,
+        'limits': evaluation.limits,
+        'vehicle_info': {
+            'fuel_type': kendaraan.fuel_type,
+            'load_category': kendaraan.load_category,
+            'tahun': kendaraan.tahun,
+            'age_category': evaluation.age_category
+        }
+    }
+
 @tests.route('/test')
 @login_required
 def test_page():
@@ -20,24 +142,257 @@ def test_page():
 def tested_plats():
     try:
         # Get all plate numbers that have test results
-        results = db.session.query(Kendaraan.plat_nomor).join(HasilUji).distinct().all()
+        results = db.session.query(Kendaraan.plat_nomor).filter(
+            Kendaraan.hasil_terakhir_id.isnot(None)
+        ).all()
         plats = [p[0] for p in results]
         return jsonify(plats)
     except exc.SQLAlchemyError as e:
         current_app.logger.error(str(e))
         return jsonify([])
 
+def lookup_vehicles(keys):
+    """Vehicle, latest result and operator for each plate key, from one joined query.
+    
+    Returns {plat_key: row}; rows of untested vehicles have NULL result columns.
+    """
+    kendaraan = Kendaraan.__table__
+    hasil = HasilUji.__table__
+    users = User.__table__
+    query = select(
+        kendaraan.c.id, kendaraan.c.plat_key, kendaraan.c.jenis, kendaraan.c.plat_nomor,
+        kendaraan.c.merek, kendaraan.c.tipe, kendaraan.c.tahun, kendaraan.c.nama_instansi,
+        kendaraan.c.fuel_type, kendaraan.c.load_category,
+        hasil.c.id.label('hasil_id'), hasil.c.co, hasil.c.co2, hasil.c.hc, hasil.c.o2,
+        hasil.c.lambda_val, hasil.c.opacity, hasil.c.lulus, hasil.c.valid, hasil.c.user_id,
+        hasil.c.tanggal, users.c.username.label('operator')
+    ).select_from(
+        kendaraan.outerjoin(hasil, hasil.c.id == kendaraan.c.hasil_terakhir_id)
+        .outerjoin(users, users.c.id == hasil.c.user_id)
+    ).where(kendaraan.c.plat_key.in_(keys))
+    return {row.plat_key: row for row in db.session.execute(query)}
+
+def lookup_response(row, thresholds):
+    """Lookup entry: the vehicle, its latest result or None, and the limits it is graded against"""
+    age, limits = thresholds.limits(row.fuel_type, row.load_category, row.tahun)
+    hasil = None
+    if row.hasil_id is not None:
+        hasil = {
+            'id': row.hasil_id,
+            'co': row.co,
+            'co2': row.co2,
+            'hc': row.hc,
+            'o2': row.o2,
+            'lambda_val': row.lambda_val,
+            'opacity': row.opacity,
+            'lulus': bool(row.lulus),
+            'valid': bool(row.valid),
+            'user_id': row.user_id,
+            'tanggal': row.tanggal.isoformat() if row.tanggal else None,
+            'operator': row.operator
+        }
+    return {
+        'kendaraan': {
+            'id': row.id,
+            'jenis': row.jenis,
+            'plat_nomor': row.plat_nomor,
+            'merek': row.merek,
+            'tipe': row.tipe,
+            'tahun': row.tahun,
+            'nama_instansi': row.nama_instansi,
+            'fuel_type': row.fuel_type,
+            'load_category': row.load_category
+        },
+        'hasil_terakhir': hasil,
+        'age_category': age,
+        'limits': dict(limits)
+    }
+
+@tests.route('/api/hasil-uji/lookup')
+@login_required
+def lookup_hasil():
+    """Vehicles with their latest result and limits, for one or many plates.
+    
+    Plates come as repeated or comma-separated ``plat`` parameters and match
+    in any spelling; items follow the request order.
+    """
+    plats = [
+        plat.strip() for value in request.args.getlist('plat') for plat in value.split(',')
+        if normalize_plate(plat)
+    ]
+    if not plats:
+        return jsonify({'error': 'Parameter plat wajib diisi'}), 400
+    if len(plats) > MAX_LOOKUP_PLATES:
+        return jsonify({'error': f'A lookup may contain at most {MAX_LOOKUP_PLATES} plates'}), 413
+        
+    try:
+        rows = lookup_vehicles({normalize_plate(plat) for plat in plats})
+        thresholds = get_thresholds()
+        items, missing, listed = [], [], set()
+        for plat in plats:
+            key = normalize_plate(plat)
+            row = rows.get(key)
+            if row is None:
+                missing.append(plat)
+            elif key not in listed:
+                listed.add(key)
+                items.append(lookup_response(row, thresholds))
+        return jsonify({'items': items, 'missing': missing})
+    except exc.SQLAlchemyError as e:
+        current_app.logger.error(str(e))
+        return jsonify({'error': 'Error looking up vehicles'}), 500
+
+def _read_batch_payload(limit=None):
+    """Parse a JSON array or NDJSON request body into a list of readings.
+    
+    NDJSON parsing stops after limit + 1 records, enough for the caller to
+    reject an oversized batch without decoding the rest of it.
+    """
+    body = request.get_data(as_text=True)
+    if request.mimetype != 'application/json' and not body.lstrip().startswith('['):
+        readings = []
+        for line_num, line in enumerate(body.splitlines(), start=1):
+            if limit is not None and len(readings) > limit:
+                break
+            if not line.strip():
+                continue
+            try:
+                readings.append(json.loads(line))
+            except ValueError:
+                raise ValueError(f'line {line_num} is not valid JSON')
+        return readings
+    readings = json.loads(body)
+    if not isinstance(readings, list):
+        raise ValueError('expected a JSON array of readings')
+    return readings
+
+@tests.route('/api/hasil-uji/batch', methods=['POST'])
+@login_required
+@csrf.exempt
+def batch_hasil():
+    """Record many test results in a single transaction.
+    
+    Accepts a JSON array or an NDJSON body of readings keyed by plat_nomor,
+    with an optional ISO 8601 tanggal for results captured offline, and
+    returns a status for every row. Every valid reading is appended to the
+    vehicle's history.
+    """
+    try:
+        readings = _read_batch_payload(limit=MAX_BATCH_READINGS)
+    except ValueError as e:
+        return jsonify({'error': f'Invalid batch payload: {e}'}), 400
+        
+    if not readings:
+        return jsonify({'error': 'No readings provided'}), 400
+    if len(readings) > MAX_BATCH_READINGS:
+        return jsonify({'error': f'A batch may contain at most {MAX_BATCH_READINGS} readings'}), 413
+        
+    try:
+        results = [{'row': i, 'plat_nomor': None, 'status': 'error'} for i in range(len(readings))]
+        
+        # Resolve every plate with set-based lookups
+        keys = sorted({
+            normalize_plate(str(r.get('plat_nomor') or '')) for r in readings if isinstance(r, dict)
+        } - {''})
+        vehicles = {}
+        for i in range(0, len(keys), SQL_IN_CHUNK):
+            rows = db.session.query(
+                Kendaraan.id, Kendaraan.plat_key, Kendaraan.fuel_type,
+                Kendaraan.load_category, Kendaraan.jenis, Kendaraan.tahun
+            ).filter(Kendaraan.plat_key.in_(keys[i:i + SQL_IN_CHUNK])).all()
+            vehicles.update((row.plat_key, row) for row in rows)
+            
+        # Validate rows
+        entries = []
+        now = datetime.now()
+        for i, data in enumerate(readings):
+            if not isinstance(data, dict):
+                results[i]['error'] = 'Reading must be a JSON object'
+                continue
+            plat = str(data.get('plat_nomor') or '').strip()
+            results[i]['plat_nomor'] = plat
+            kendaraan = vehicles.get(normalize_plate(plat))
+            if not kendaraan:
+                results[i]['error'] = 'Kendaraan tidak ditemukan'
+                continue
+            values, error = parse_reading(kendaraan.fuel_type, data)
+            if error:
+                results[i]['error'] = error
+                continue
+            tanggal = now
+            if data.get('tanggal'):
+                try:
+                    tanggal = datetime.fromisoformat(str(data['tanggal']))
+                except ValueError:
+                    results[i]['error'] = 'tanggal must be an ISO 8601 datetime'
+                    continue
+                # Stored times are naive server-local, as written by datetime.now()
+                if tanggal.tzinfo is not None:
+                    tanggal = tanggal.astimezone().replace(tzinfo=None)
+            entries.append((i, kendaraan, values, tanggal))
+            
+        created = 0
+        if entries:
+            # Grade all accepted readings at once
+            columns = {f: [values[f] for _, _, values, _ in entries] for f in READING_COLUMNS}
+            graded = evaluate_batch(
+                tahun=[k.tahun for _, k, _, _ in entries],
+                fuel_type=[k.fuel_type for _, k, _, _ in entries],
+                load_category=[k.load_category for _, k, _, _ in entries],
+                **columns
+            )
+            
+            inserts = []
+            for (row, kendaraan, values, tanggal), lulus in zip(entries, graded.lulus):
+                inserts.append(dict(
+                    values,
+                    kendaraan_id=kendaraan.id,
+                    lulus=bool(lulus),
+                    valid=True,
+                    user_id=current_user.id,
+                    tanggal=tanggal
+                ))
+                results[row]['status'] = 'created'
+                results[row]['lulus'] = bool(lulus)
+                results[row].pop('error', None)
+                
+            db.session.execute(HasilUji.__table__.insert(), inserts)
+            refresh_latest_results({k.id for _, k, _, _ in entries})
+            rollups.apply_rows([
+                dict(record, fuel_type=k.fuel_type, load_category=k.load_category, jenis=k.jenis)
+                for record, (_, k, _, _) in zip(inserts, entries)
+            ])
+            db.session.commit()
+            created = len(inserts)
+            
+        current_app.logger.info(
+            f"Batch test results recorded by user: {current_user.username}. "
+            f"Created: {created}, rows: {len(readings)}"
+        )
+        
+        return jsonify({
+            'success': True,
+            'total': len(readings),
+            'created': created,
+            'errors': sum(1 for r in results if r['status'] == 'error'),
+            'results': results
+        })
+    except Exception as e:
+        db.session.rollback()
+        current_app.logger.error(str(e))
+        return jsonify({'error': str(e)}), 500
+
 @tests.route('/api/hasil-uji/<string:plat_nomor>', methods=['GET', 'POST', 'DELETE'])
 @login_required
 @csrf.exempt
 def manage_hasil(plat_nomor):
-    kendaraan = Kendaraan.query.filter_by(plat_nomor=plat_nomor).first()
+    kendaraan = Kendaraan.with_plat(plat_nomor).first()
     if not kendaraan:
         return jsonify({'error': 'Kendaraan tidak ditemukan'}), 404
 
     if request.method == 'GET':
         try:
-            hasil = HasilUji.query.filter_by(kendaraan_id=kendaraan.id).first()
+            hasil = kendaraan.hasil_terakhir
             if not hasil:
                 return jsonify({'error': 'Data uji tidak ditemukan'}), 404
                 
@@ -68,14 +423,19 @@ def manage_hasil(plat_nomor):
             current_app.logger.error(str(e))
             return jsonify({'error': 'Error retrieving test data'}), 500
 
-    # DELETE: clear test data
+    # DELETE: remove the latest result, or the whole history with ?all=1
     if request.method == 'DELETE':
         try:
-            hasil = HasilUji.query.filter_by(kendaraan_id=kendaraan.id).first()
-            if not hasil:
+            if not kendaraan.hasil_terakhir_id:
                 return jsonify({'error': 'No test data found'}), 404
                 
-            db.session.delete(hasil)
+            if request.args.get('all') in ('1', 'true'):
+                rollups.apply_vehicle(kendaraan.id, -1)
+                HasilUji.query.filter_by(kendaraan_id=kendaraan.id).delete(synchronize_session=False)
+            else:
+                rollups.apply_results([kendaraan.hasil_terakhir_id], -1)
+                HasilUji.query.filter_by(id=kendaraan.hasil_terakhir_id).delete(synchronize_session=False)
+            refresh_latest_results([kendaraan.id])
             db.session.commit()
             
             # Log the deletion
@@ -90,182 +450,299 @@ def manage_hasil(plat_nomor):
     # POST: create new test data
     elif request.method == 'POST':
         try:
-            data = request.json
+            data = request.json or {}
             
             # Validate input based on fuel type
-            if kendaraan.fuel_type == 'bensin':
-                required = ['co', 'co2', 'hc', 'o2', 'lambda_val']
-                missing = [f for f in required if not data.get(f)]
-                if missing:
-                    return jsonify({'error': f'Missing required fields for bensin: {", ".join(missing)}'}), 400
-                    
-                # Convert values to float
-                try:
-                    co = float(data.get('co', 0))
-                    co2 = float(data.get('co2', 0))
-                    hc = float(data.get('hc', 0))
-                    o2 = float(data.get('o2', 0))
-                    lambda_val = float(data.get('lambda_val', 0))
-                    opacity = None  # Not applicable for bensin
-                except ValueError:
-                    return jsonify({'error': 'All values must be valid numbers'}), 400
-                    
-                # Get config to determine pass/fail
-                config = Config.get_config()
-                
-                # Determine vehicle age category
-                current_year = datetime.now().year
-                vehicle_age = current_year - kendaraan.tahun
-                
-                age_category = None
-                if kendaraan.tahun < 2007:
-                    age_category = '<2007'
-                elif 2007 <= kendaraan.tahun <= 2018:
-                    age_category = '2007-2018'
-                else:
-                    age_category = '>2018'
-                    
-                # Get parameters for this vehicle type
-                load_category = kendaraan.load_category
-                vehicle_params = config.bensin_parameters.get(load_category, {}).get(age_category, {})
-                
-                if not vehicle_params:
-                    # Fallback to default values if category not found
-                    vehicle_params = {
-                        'co_max': config.bensin_co_max,
-                        'hc_max': config.bensin_hc_max,
-                        'co2_min': config.co2_min,
-                        'lambda_min': config.lambda_min,
-                        'lambda_max': config.lambda_max
-                    }
-                
-                # Determine if the vehicle passes the test
-                lulus = (
-                    co <= vehicle_params.get('co_max', config.bensin_co_max) and
-                    hc <= vehicle_params.get('hc_max', config.bensin_hc_max) and
-                    co2 >= vehicle_params.get('co2_min', config.co2_min) and
-                    o2 <= config.o2_max and
-                    lambda_val >= vehicle_params.get('lambda_min', config.lambda_min) and
-                    lambda_val <= vehicle_params.get('lambda_max', config.lambda_max)
-                )
-                
-            else:  # Solar/diesel
-                if 'opacity' not in data:
-                    return jsonify({'error': 'Opacity value is required for solar vehicles'}), 400
-                    
-                try:
-                    opacity = float(data.get('opacity', 0))
-                    # Default values for other fields (not used for solar)
-                    co = 0
-                    co2 = 0
-                    hc = 0
-                    o2 = 0
-                    lambda_val = 0
-                except ValueError:
-                    return jsonify({'error': 'Opacity must be a valid number'}), 400
-                    
-                # Get config to determine pass/fail
-                config = Config.get_config()
-                
-                # Determine vehicle age category
-                current_year = datetime.now().year
-                vehicle_age = current_year - kendaraan.tahun
-                
-                age_category = None
-                if kendaraan.tahun < 2010:
-                    age_category = '<2010'
-                elif 2010 <= kendaraan.tahun <= 2021:
-                    age_category = '2010-2021'
-                else:
-                    age_category = '>2021'
-                    
-                # Get parameters for this vehicle type
-                load_category = kendaraan.load_category
-                vehicle_params = config.solar_parameters.get(load_category, {}).get(age_category, {})
-                
-                if not vehicle_params:
-                    # Fallback to default values if category not found
-                    vehicle_params = {
-                        'opacity_max': config.solar_opacity_max
-                    }
-                
-                # Determine if the vehicle passes the test
-                lulus = opacity <= vehicle_params.get('opacity_max', config.solar_opacity_max)
-            
-            # Create or update HasilUji record
-            existing = HasilUji.query.filter_by(kendaraan_id=kendaraan.id).first()
-            
-            if existing:
-                existing.co = co
-                existing.co2 = co2
-                existing.hc = hc
-                existing.o2 = o2
-                existing.lambda_val = lambda_val
-                existing.opacity = opacity
-                existing.lulus = lulus
-                existing.valid = True
-                existing.user_id = current_user.id
-                existing.tanggal = datetime.now()
-            else:
-                hasil_uji = HasilUji(
-                    kendaraan_id=kendaraan.id,
-                    co=co,
-                    co2=co2,
-                    hc=hc,
-                    o2=o2,
-                    lambda_val=lambda_val,
-                    opacity=opacity,
-                    lulus=lulus,
-                    valid=True,
-                    user_id=current_user.id,
-                    tanggal=datetime.now()
-                )
-                db.session.add(hasil_uji)
+            values, error = parse_reading(kendaraan.fuel_type, data)
+            if error:
+                return jsonify({'error': error}), 400
                 
+            # Grade against the compiled thresholds cached in this worker
+            hasil, evaluation = record_result(kendaraan, values)
+            lulus = evaluation.lulus
             db.session.commit()
             
             # Log the test
             current_app.logger.info(f"Test result recorded for {plat_nomor} by user: {current_user.username}. Result: {'PASS' if lulus else 'FAIL'}")
             
-            # Include limit values in response to display to user
-            limits = {}
-            if kendaraan.fuel_type == 'bensin':
-                limits = {
-                    'co_max': vehicle_params.get('co_max', config.bensin_co_max),
-                    'hc_max': vehicle_params.get('hc_max', config.bensin_hc_max),
-                    'co2_min': vehicle_params.get('co2_min', config.co2_min),
-                    'o2_max': config.o2_max,
-                    'lambda_min': vehicle_params.get('lambda_min', config.lambda_min),
-                    'lambda_max': vehicle_params.get('lambda_max', config.lambda_max)
-                }
-            else:
-                limits = {
-                    'opacity_max': vehicle_params.get('opacity_max', config.solar_opacity_max)
-                }
-            
-            return jsonify({
-                'success': True,
-                'lulus': lulus,
-                'limits': limits,
-                'vehicle_info': {
-                    'fuel_type': kendaraan.fuel_type,
-                    'load_category': kendaraan.load_category,
-                    'tahun': kendaraan.tahun,
-                    'age_category': age_category
-                }
-            })
+            return jsonify(result_response(kendaraan, evaluation))
         except Exception as e:
             db.session.rollback()
             current_app.logger.error(str(e))
             return jsonify({'error': str(e)}), 500
 
+@tests.route('/api/hasil-uji/<string:plat_nomor>/history')
+@login_required
+def hasil_history(plat_nomor):
+    """Test history of a vehicle, newest first"""
+    kendaraan = Kendaraan.with_plat(plat_nomor).first()
+    if not kendaraan:
+        return jsonify({'error': 'Kendaraan tidak ditemukan'}), 404
+        
+    try:
+        limit = min(max(request.args.get('limit', 50, type=int), 1), MAX_HISTORY_RESULTS)
+        rows = HasilUji.query.filter_by(kendaraan_id=kendaraan.id).order_by(
+            HasilUji.tanggal.desc(), HasilUji.id.desc()
+        ).limit(limit).all()
+        
+        return jsonify({
+            'plat_nomor': kendaraan.plat_nomor,
+            'hasil_terakhir_id': kendaraan.hasil_terakhir_id,
+            'results': [{
+                'id': hasil.id,
+                'co': hasil.co,
+                'co2': hasil.co2,
+                'hc': hasil.hc,
+                'o2': hasil.o2,
+                'lambda_val': hasil.lambda_val,
+                'opacity': hasil.opacity,
+                'lulus': hasil.lulus,
+                'valid': hasil.valid,
+                'tanggal': hasil.tanggal.isoformat() if hasil.tanggal else None,
+                'operator': hasil.user.username if hasil.user else None
+            } for hasil in rows]
+        })
+    except Exception as e:
+        current_app.logger.error(str(e))
+        return jsonify({'error': 'Error retrieving test history'}), 500
+
+def _session_summary(sesi):
+    stats = sampling.cached_stats(sesi)
+    return {
+        'id': sesi.id,
+        'plat_nomor': sesi.kendaraan.plat_nomor,
+        'status': sesi.status,
+        'channels': sesi.channels.split(','),
+        'sample_count': sesi.sample_count,
+        'block_count': sesi.block_count,
+        'statistics': {name: s.summary() for name, s in stats.items()},
+        'hasil_uji_id': sesi.hasil_uji_id,
+        'created_at': sesi.created_at.isoformat() if sesi.created_at else None,
+        'updated_at': sesi.updated_at.isoformat() if sesi.updated_at else None,
+        'finalized_at': sesi.finalized_at.isoformat() if sesi.finalized_at else None
+    }
+
+@tests.route('/api/sesi-uji', methods=['POST'])
+@login_required
+@csrf.exempt
+def open_session():
+    """Open a test session that collects analyzer samples for a vehicle"""
+    data = request.json or {}
+    plat_nomor = str(data.get('plat_nomor') or '').strip()
+    kendaraan = Kendaraan.with_plat(plat_nomor).first()
+    if not kendaraan:
+        return jsonify({'error': 'Kendaraan tidak ditemukan'}), 404
+        
+    try:
+        sesi = SesiUji(
+            kendaraan_id=kendaraan.id,
+            user_id=current_user.id,
+            status='open',
+            channels=','.join(sampling.session_channels(kendaraan.fuel_type)),
+            statistik={}
+        )
+        db.session.add(sesi)
+        db.session.commit()
+        
+        current_app.logger.info(f"Test session {sesi.id} opened for {plat_nomor} by user: {current_user.username}")
+        return jsonify(_session_summary(sesi)), 201
+    except Exception as e:
+        db.session.rollback()
+        current_app.logger.error(str(e))
+        return jsonify({'error': str(e)}), 500
+
+@tests.route('/api/sesi-uji/<int:sesi_id>', methods=['GET', 'DELETE'])
+@login_required
+@csrf.exempt
+def manage_session(sesi_id):
+    sesi = SesiUji.query.get(sesi_id)
+    if not sesi:
+        return jsonify({'error': 'Sesi uji tidak ditemukan'}), 404
+        
+    if request.method == 'GET':
+        return jsonify(_session_summary(sesi))
+        
+    # DELETE: cancel an open session and drop its samples
+    if sesi.status != 'open':
+        return jsonify({'error': 'Sesi uji sudah ditutup'}), 409
+    try:
+        SampelUjiBlok.query.filter_by(sesi_id=sesi.id).delete(synchronize_session=False)
+        sesi.status = 'cancelled'
+        sesi.finalized_at = datetime.utcnow()
+        db.session.commit()
+        sampling.forget_stats(sesi.id)
+        return jsonify({'message': 'Sesi uji dibatalkan'}), 200
+    except Exception as e:
+        db.session.rollback()
+        current_app.logger.error(str(e))
+        return jsonify({'error': str(e)}), 500
+
+@tests.route('/api/sesi-uji/<int:sesi_id>/samples', methods=['GET', 'POST'])
+@login_required
+@csrf.exempt
+def session_samples(sesi_id):
+    """Append a batch of analyzer samples, or read back the recorded ones.
+    
+    POST takes a JSON array or NDJSON body of sample objects holding every
+    channel of the session; ``t`` (seconds since the session opened) is
+    optional and defaults to the time the batch arrives. GET returns up to
+    ``limit`` blocks after block ``after_seq``, plus the ``after_seq`` of
+    the next page.
+    """
+    sesi = SesiUji.query.get(sesi_id)
+    if not sesi:
+        return jsonify({'error': 'Sesi uji tidak ditemukan'}), 404
+    channels = sesi.channels.split(',')
+    
+    if request.method == 'GET':
+        after_seq = request.args.get('after_seq', -1, type=int)
+        limit = min(max(request.args.get('limit', MAX_SAMPLE_BLOCKS, type=int), 1), MAX_SAMPLE_BLOCKS)
+        blocks = SampelUjiBlok.query.filter(
+            SampelUjiBlok.sesi_id == sesi.id,
+            SampelUjiBlok.seq > after_seq
+        ).order_by(SampelUjiBlok.seq).limit(limit + 1).all()
+        has_more = len(blocks) > limit
+        blocks = blocks[:limit]
+        samples = sampling.read_samples(blocks, channels)
+        return jsonify({
+            'id': sesi.id,
+            'sample_count': len(samples),
+            'samples': {name: samples[:, c].tolist() for c, name in enumerate(channels)},
+            'next_after_seq': blocks[-1].seq if has_more else None
+        })
+        
+    if sesi.status != 'open':
+        return jsonify({'error': 'Sesi uji sudah ditutup'}), 409
+    if (request.content_length or 0) > sampling.MAX_REQUEST_BYTES:
+        return jsonify({'error': f'A request may contain at most {sampling.MAX_SAMPLES_PER_REQUEST} samples'}), 413
+    try:
+        samples = _read_batch_payload(limit=sampling.MAX_SAMPLES_PER_REQUEST)
+        if len(samples) > sampling.MAX_SAMPLES_PER_REQUEST:
+            return jsonify({'error': f'A request may contain at most {sampling.MAX_SAMPLES_PER_REQUEST} samples'}), 413
+        offset = (datetime.utcnow() - sesi.created_at).total_seconds()
+        samples = sampling.parse_samples(channels, samples, offset)
+    except ValueError as e:
+        return jsonify({'error': f'Invalid samples: {e}'}), 400
+    if not len(samples):
+        return jsonify({'error': 'No samples provided'}), 400
+        
+    try:
+        stats = sampling.merge_samples(sampling.cached_stats(sesi), channels, samples)
+        sample_count = sesi.sample_count + len(samples)
+        
+        # Guard on the old count so concurrent batches cannot overwrite
+        # each other's statistics
+        table = SesiUji.__table__
+        claimed = db.session.execute(
+            table.update().where(
+                table.c.id == sesi.id,
+                table.c.status == 'open',
+                table.c.sample_count == sesi.sample_count
+            ).values(
+                sample_count=sample_count,
+                block_count=table.c.block_count + 1,
+                statistik=sampling.dump_stats(stats),
+                updated_at=datetime.utcnow()
+            )
+        ).rowcount
+        if claimed != 1:
+            db.session.rollback()
+            return jsonify({'error': 'Sesi uji sedang diperbarui, kirim ulang sampel'}), 409
+            
+        db.session.execute(SampelUjiBlok.__table__.insert().values(
+            sesi_id=sesi.id,
+            seq=sesi.block_count,
+            count=len(samples),
+            data=sampling.pack(samples),
+            created_at=datetime.utcnow()
+        ))
+        db.session.commit()
+        sampling.remember_stats(sesi.id, sample_count, stats)
+        
+        return jsonify({
+            'id': sesi.id,
+            'accepted': len(samples),
+            'sample_count': sample_count,
+            'statistics': {name: s.summary() for name, s in stats.items()}
+        })
+    except Exception as e:
+        db.session.rollback()
+        current_app.logger.error(str(e))
+        return jsonify({'error': str(e)}), 500
+
+@tests.route('/api/sesi-uji/<int:sesi_id>/finalize', methods=['POST'])
+@login_required
+@csrf.exempt
+def finalize_session(sesi_id):
+    """Close a session and record its stabilized reading as the test result.
+    
+    The reading is the mean of every sample, or of the last
+    ``window_seconds`` when given.
+    """
+    sesi = SesiUji.query.get(sesi_id)
+    if not sesi:
+        return jsonify({'error': 'Sesi uji tidak ditemukan'}), 404
+    if sesi.status != 'open':
+        return jsonify({'error': 'Sesi uji sudah ditutup'}), 409
+    if not sesi.sample_count:
+        return jsonify({'error': 'Sesi uji belum memiliki sampel'}), 400
+        
+    data = request.get_json(silent=True) or {}
+    window_seconds = data.get('window_seconds')
+    if window_seconds is not None:
+        try:
+            window_seconds = float(window_seconds)
+        except (TypeError, ValueError):
+            return jsonify({'error': 'window_seconds must be a number'}), 400
+        if window_seconds <= 0:
+            return jsonify({'error': 'window_seconds must be positive'}), 400
+            
+    try:
+        kendaraan = sesi.kendaraan
+        channels = sesi.channels.split(',')
+        if window_seconds is None:
+            means = {name: s.mean for name, s in sampling.cached_stats(sesi).items()}
+        else:
+            newest_first = SampelUjiBlok.query.filter_by(sesi_id=sesi.id).order_by(SampelUjiBlok.seq.desc())
+            means = sampling.window_means(newest_first.yield_per(4), channels, window_seconds)
+            
+        values = {name: means.get(name, 0) for name in READING_COLUMNS}
+        if kendaraan.fuel_type == 'bensin':
+            values['opacity'] = None  # Not applicable for bensin
+            
+        hasil, evaluation = record_result(kendaraan, values)
+        closed = SesiUji.query.filter_by(id=sesi.id, status='open').update({
+            'status': 'finalized',
+            'hasil_uji_id': hasil.id,
+            'finalized_at': datetime.utcnow()
+        }, synchronize_session=False)
+        if closed != 1:
+            db.session.rollback()
+            return jsonify({'error': 'Sesi uji sudah ditutup'}), 409
+        db.session.commit()
+        sampling.forget_stats(sesi.id)
+        
+        current_app.logger.info(
+            f"Test session {sesi.id} finalized for {kendaraan.plat_nomor} by user: {current_user.username}. "
+            f"Result: {'PASS' if evaluation.lulus else 'FAIL'}"
+        )
+        
+        response = result_response(kendaraan, evaluation)
+        response['sesi_id'] = sesi.id
+        response['reading'] = values
+        return jsonify(response)
+    except Exception as e:
+        db.session.rollback()
+        current_app.logger.error(str(e))
+        return jsonify({'error': str(e)}), 500
+
 @tests.route('/testing-history')
 @login_required
 def testing_history():
     """View testing history for all vehicles"""
     try:
-        page = request.args.get('page', 1, type=int)
-        per_page = request.args.get('per_page', 10, type=int)
+        cursor = request.args.get('cursor', '')
+        per_page = pagination.parse_per_page(request.args.get('per_page', type=int), 10)
         
         # Optional filters
         plat_nomor = request.args.get('plat_nomor', '')
@@ -281,9 +758,9 @@ def testing_history():
         
         # Apply filters
         if plat_nomor:
-            query = query.filter(Kendaraan.plat_nomor.ilike(f'%{plat_nomor}%'))
+            query = query.filter(search.contains(Kendaraan.plat_nomor, plat_nomor))
         if merek:
-            query = query.filter(Kendaraan.merek.ilike(f'%{merek}%'))
+            query = query.filter(search.contains(Kendaraan.merek, merek))
         if start_date:
             try:
                 start_date_obj = datetime.strptime(start_date, '%Y-%m-%d')
@@ -303,15 +780,21 @@ def testing_history():
         elif result == 'fail':
             query = query.filter(HasilUji.lulus == False)
             
-        # Order by most recent tests
-        query = query.order_by(HasilUji.tanggal.desc())
-        
-        # Paginate results
-        pagination = query.paginate(page=page, per_page=per_page, error_out=False)
+        # Most recent tests first, seeking from the cursor
+        try:
+            page = pagination.seek(
+                query, [HasilUji.tanggal, HasilUji.id],
+                key=lambda row: (row[0].tanggal, row[0].id),
+                cursor=cursor, per_page=per_page, descending=True
+            )
+        except ValueError:
+            flash('Invalid page cursor, showing the most recent tests.', 'error')
+            args = {k: v for k, v in request.args.items() if k != 'cursor'}
+            return redirect(url_for('tests.testing_history', **args))
         
         return render_template(
             'testing_history.html',
-            pagination=pagination,
+            pagination=page,
             filters={
                 'plat_nomor': plat_nomor,
                 'merek': merek,
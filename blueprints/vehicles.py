@@ -1,7 +1,15 @@
 from flask import Blueprint, render_template, request, jsonify, current_app, redirect, url_for, flash, send_file
-from sqlalchemy import exc
+from sqlalchemy import exc, func
+from sqlalchemy.orm import joinedload
 from extensions import db, csrf
-from models import Kendaraan
+from models import RESERVED_PLATE_KEYS, Kendaraan, normalize_plate
+import rollups
+import pagination
+import search
+import plates
+import dictionaries
+import exports
+import batch_upload
 from flask_login import login_required, current_user
 import csv
 import tempfile
@@ -10,6 +18,74 @@ import time
 
 vehicles = Blueprint('vehicles', __name__)
 
+# Rows fetched per round trip when streaming an export
+EXPORT_FETCH_SIZE = 2000
+
+EXPORT_COLUMNS = ['jenis', 'plat_nomor', 'merek', 'tipe', 'tahun', 'fuel_type', 'nama_instansi', 'load_category']
+
+# Values of the tested filter and whether they select vehicles with a result
+TESTED_FILTERS = {'yes': True, 'no': False}
+
+def vehicle_filters(plat_nomor='', merek='', tipe='', jenis='', fuel_type='', tested=''):
+    """SQL conditions for the vehicle filters shared by the list and exports"""
+    filters = []
+    if plat_nomor:
+        filters.append(search.contains(Kendaraan.plat_nomor, plat_nomor))
+    if merek:
+        filters.append(search.contains(Kendaraan.merek, merek))
+    if tipe:
+        filters.append(search.contains(Kendaraan.tipe, tipe))
+    if jenis:
+        filters.append(Kendaraan.jenis == jenis)
+    if fuel_type:
+        filters.append(Kendaraan.fuel_type == fuel_type)
+    # hasil_terakhir_id is indexed and set exactly when a vehicle has results
+    if tested in TESTED_FILTERS:
+        if TESTED_FILTERS[tested]:
+            filters.append(Kendaraan.hasil_terakhir_id.isnot(None))
+        else:
+            filters.append(Kendaraan.hasil_terakhir_id.is_(None))
+    return filters
+
+def count_vehicles(filter_values):
+    return db.session.query(func.count(Kendaraan.id)).filter(*vehicle_filters(**filter_values)).scalar()
+
+def iter_vehicle_chunks(filters):
+    """Export columns for the filtered vehicles in plate order, one chunk per query.
+    
+    Each chunk is its own short SELECT seeking past the previous one, so no
+    read stays open on the database between chunks.
+    """
+    query = db.session.query(*[getattr(Kendaraan, name) for name in EXPORT_COLUMNS]).filter(*filters)
+    cursor = None
+    while True:
+        page = pagination.seek(
+            query, [Kendaraan.plat_nomor],
+            key=lambda row: (row.plat_nomor,),
+            cursor=cursor, per_page=EXPORT_FETCH_SIZE
+        )
+        if page.items:
+            yield page.items
+        if not page.has_next:
+            return
+        cursor = page.next_cursor
+
+def write_vehicles_csv(target, filter_values, progress=None):
+    """Write the filtered vehicles as CSV to a text file.
+    
+    ``progress`` is called with the running row count after each chunk.
+    Returns the number of rows written.
+    """
+    writer = csv.writer(target)
+    writer.writerow(EXPORT_COLUMNS)
+    written = 0
+    for rows in iter_vehicle_chunks(vehicle_filters(**filter_values)):
+        writer.writerows(rows)
+        written += len(rows)
+        if progress:
+            progress(written)
+    return written
+
 @vehicles.route('/')
 @login_required
 def dashboard():
@@ -21,8 +97,9 @@ def dashboard():
 def get_kendaraan_list():
     try:
         # Get pagination parameters
-        page = request.args.get('page', 1, type=int)
-        per_page = request.args.get('per_page', 10, type=int)
+        cursor = request.args.get('cursor', '')
+        per_page = pagination.parse_per_page(request.args.get('per_page', type=int), 10)
+        with_total = request.args.get('with_total') in ('1', 'true')
         
         # Get filtering parameters
         plat_nomor = request.args.get('plat_nomor', '')
@@ -30,23 +107,24 @@ def get_kendaraan_list():
         tipe = request.args.get('tipe', '')
         jenis = request.args.get('jenis', '')
         fuel_type = request.args.get('fuel_type', '')
+        tested = request.args.get('tested', '')
+        if tested and tested not in TESTED_FILTERS:
+            return jsonify({'error': "tested must be 'yes' or 'no'"}), 400
         
-        # Build query with filters
-        query = Kendaraan.query
-        
-        if plat_nomor:
-            query = query.filter(Kendaraan.plat_nomor.ilike(f'%{plat_nomor}%'))
-        if merek:
-            query = query.filter(Kendaraan.merek.ilike(f'%{merek}%'))
-        if tipe:
-            query = query.filter(Kendaraan.tipe.ilike(f'%{tipe}%'))
-        if jenis:
-            query = query.filter(Kendaraan.jenis == jenis)
-        if fuel_type:
-            query = query.filter(Kendaraan.fuel_type == fuel_type)
+        # Build query with filters; the latest result comes with each row
+        query = Kendaraan.query.filter(
+            *vehicle_filters(plat_nomor, merek, tipe, jenis, fuel_type, tested)
+        ).options(joinedload(Kendaraan.hasil_terakhir))
             
-        # Paginate results
-        pagination = query.paginate(page=page, per_page=per_page, error_out=False)
+        # Seek by plate number from the cursor; counting is opt-in
+        try:
+            page = pagination.seek(
+                query, [Kendaraan.plat_nomor],
+                key=lambda k: (k.plat_nomor,),
+                cursor=cursor, per_page=per_page
+            )
+        except ValueError as e:
+            return jsonify({'error': str(e)}), 400
         
         # Format response
         items = [{
@@ -58,25 +136,47 @@ def get_kendaraan_list():
             'tahun': k.tahun,
             'nama_instansi': k.nama_instansi,
             'fuel_type': k.fuel_type,
-            'load_category': k.load_category
-        } for k in pagination.items]
+            'load_category': k.load_category,
+            'tested': k.hasil_terakhir is not None,
+            'hasil_terakhir': {
+                'id': k.hasil_terakhir.id,
+                'tanggal': k.hasil_terakhir.tanggal.isoformat() if k.hasil_terakhir.tanggal else None,
+                'lulus': k.hasil_terakhir.lulus,
+                'valid': k.hasil_terakhir.valid
+            } if k.hasil_terakhir else None
+        } for k in page.items]
         
-        return jsonify({
+        response = {
             'items': items,
-            'total': pagination.total,
-            'page': page,
             'per_page': per_page,
-            'pages': pagination.pages
-        })
+            'next_cursor': page.next_cursor,
+            'prev_cursor': page.prev_cursor
+        }
+        if with_total:
+            response['total'] = query.order_by(None).count()
+        return jsonify(response)
     except exc.SQLAlchemyError as e:
         current_app.logger.error(f'Database error: {str(e)}')
         return jsonify({'error': 'Database error occurred'}), 500
 
+@vehicles.route('/api/kendaraan/suggest')
+@login_required
+def suggest_kendaraan():
+    """Typeahead: plates starting with q, from the in-memory plate index"""
+    query = request.args.get('q', '')
+    limit = request.args.get('limit', plates.DEFAULT_SUGGESTIONS, type=int)
+    try:
+        return jsonify({'query': query, 'items': plates.suggest(query, limit)})
+    except Exception as e:
+        db.session.rollback()
+        current_app.logger.error(str(e))
+        return jsonify({'error': 'Error looking up plates'}), 500
+
 @vehicles.route('/api/kendaraan/<plat_nomor>')
 @login_required
 def get_kendaraan(plat_nomor):
     try:
-        kendaraan = Kendaraan.query.filter_by(plat_nomor=plat_nomor).first()
+        kendaraan = Kendaraan.with_plat(plat_nomor).first()
         if kendaraan:
             return jsonify({
                 'id': kendaraan.id,
@@ -109,7 +209,7 @@ def tambah_kendaraan():
             
         # Input validation
         plat = data['plat_nomor'].strip().upper()
-        if len(plat) < 4:
+        if len(plat) < 4 or not normalize_plate(plat) or normalize_plate(plat) in RESERVED_PLATE_KEYS:
             return jsonify({'error': 'Invalid plate number format'}), 400
             
         try:
@@ -186,11 +286,12 @@ def tambah_kendaraan():
 def modify_kendaraan(plat_nomor):
     if request.method == 'DELETE':
         try:
-            kendaraan = Kendaraan.query.filter_by(plat_nomor=plat_nomor).first_or_404()
+            kendaraan = Kendaraan.with_plat(plat_nomor).first_or_404()
             
             # Log the deletion
             current_app.logger.info(f"Vehicle deleted: {plat_nomor} by user: {current_user.username}")
             
+            rollups.apply_vehicle(kendaraan.id, -1)
             db.session.delete(kendaraan)
             db.session.commit()
             return jsonify({'success': True})
@@ -201,7 +302,8 @@ def modify_kendaraan(plat_nomor):
     elif request.method == 'PUT':
         try:
             data = request.json or {}
-            kendaraan = Kendaraan.query.filter_by(plat_nomor=plat_nomor).first_or_404()
+            kendaraan = Kendaraan.with_plat(plat_nomor).first_or_404()
+            rollup_key = (kendaraan.fuel_type, kendaraan.load_category, kendaraan.jenis)
             
             # Update fields
             if 'merek' in data:
@@ -266,6 +368,12 @@ def modify_kendaraan(plat_nomor):
                     
                 kendaraan.load_category = data['load_category']
                 
+            # Move the vehicle's results to their new rollup key
+            new_key = (kendaraan.fuel_type, kendaraan.load_category, kendaraan.jenis)
+            if new_key != rollup_key:
+                rollups.apply_vehicle(kendaraan.id, -1, key=rollup_key)
+                rollups.apply_vehicle(kendaraan.id, key=new_key)
+                
             db.session.commit()
             
             # Log the update
@@ -284,12 +392,21 @@ def modify_kendaraan(plat_nomor):
             current_app.logger.error(str(e))
             return jsonify({'error': 'Unexpected error occurred'}), 500
 
+def dictionary_response(payload):
+    """JSON response for a cached (body, ETag) pair, 304 if the client has it"""
+    body, etag = payload
+    response = current_app.response_class(body, mimetype='application/json')
+    response.set_etag(etag)
+    # Let browsers keep it between page loads but revalidate every time
+    response.cache_control.private = True
+    response.cache_control.no_cache = True
+    return response.make_conditional(request)
+
 @vehicles.route('/api/kendaraan-mereks')
 @login_required
 def kendaraan_mereks():
     try:
-        mereks = db.session.query(Kendaraan.merek).distinct().all()
-        return jsonify([merek[0] for merek in mereks])
+        return dictionary_response(dictionaries.cached_mereks())
     except Exception as e:
         current_app.logger.error(str(e))
         return jsonify([])
@@ -298,8 +415,8 @@ def kendaraan_mereks():
 @login_required
 def kendaraan_tipes():
     try:
-        tipes = db.session.query(Kendaraan.tipe).distinct().all()
-        return jsonify([tipe[0] for tipe in tipes])
+        merek = request.args.get('merek', '').strip()
+        return dictionary_response(dictionaries.cached_tipes(merek))
     except Exception as e:
         current_app.logger.error(str(e))
         return jsonify([])
@@ -345,133 +462,35 @@ def batch_upload_kendaraan():
     if not file.filename.endswith('.csv'):
         return jsonify({'error': 'File must be CSV format'}), 400
         
-    try:
-        # Read CSV
-        csv_content = file.read().decode('utf-8')
-        csv_reader = csv.DictReader(StringIO(csv_content))
-        
-        # Tracking variables
-        successes = 0
-        errors = []
-        row_num = 1  # Starting after header row
+    # 'all' keeps nothing unless every row is valid; 'partial' keeps the valid rows
+    mode = request.form.get('mode', 'all')
+    if mode not in batch_upload.MODES:
+        return jsonify({'error': f"Mode must be one of: {', '.join(batch_upload.MODES)}"}), 400
         
-        for row in csv_reader:
-            row_num += 1
-            try:
-                # Validate row data
-                required_fields = ['jenis', 'plat_nomor', 'merek', 'tipe', 'tahun', 'fuel_type', 'load_category']
-                missing = [f for f in required_fields if f not in row or not row.get(f)]
-                
-                if missing:
-                    errors.append({
-                        'row': row_num,
-                        'error': f'Missing required fields: {", ".join(missing)}'
-                    })
-                    continue
-                    
-                # Clean and validate data
-                plat = row['plat_nomor'].strip().upper()
-                if len(plat) < 4:
-                    errors.append({
-                        'row': row_num,
-                        'error': 'Invalid plate number format'
-                    })
-                    continue
-                    
-                try:
-                    tahun = int(row['tahun'])
-                    if tahun < 1900 or tahun > 2100:
-                        errors.append({
-                            'row': row_num,
-                            'error': 'Invalid year (must be between 1900-2100)'
-                        })
-                        continue
-                except ValueError:
-                    errors.append({
-                        'row': row_num,
-                        'error': 'Year must be a valid number'
-                    })
-                    continue
-                    
-                jenis = row['jenis'].strip().lower()
-                if jenis not in ['umum', 'dinas']:
-                    errors.append({
-                        'row': row_num,
-                        'error': "Invalid vehicle type (must be 'umum' or 'dinas')"
-                    })
-                    continue
-                    
-                fuel_type = row['fuel_type'].strip().lower()
-                if fuel_type not in ['bensin', 'solar']:
-                    errors.append({
-                        'row': row_num,
-                        'error': "Invalid fuel type (must be 'bensin' or 'solar')"
-                    })
-                    continue
-                    
-                load_category = row['load_category'].strip()
-                valid_categories = {
-                    'bensin': ['kendaraan_muatan', 'kendaraan_penumpang'],
-                    'solar': ['<3.5ton', '>=3.5ton']
-                }
-                
-                if load_category not in valid_categories[fuel_type]:
-                    errors.append({
-                        'row': row_num,
-                        'error': f'Invalid load category for {fuel_type}. Valid options are: {", ".join(valid_categories[fuel_type])}'
-                    })
-                    continue
-                    
-                # Handle nama_instansi
-                nama_instansi = row.get('nama_instansi', '').strip()
-                if jenis != 'dinas' or not nama_instansi:
-                    nama_instansi = '-'
-                    
-                # Check if vehicle with this plate already exists
-                existing = Kendaraan.query.filter_by(plat_nomor=plat).first()
-                if existing:
-                    errors.append({
-                        'row': row_num,
-                        'error': f'Plat nomor {plat} already exists'
-                    })
-                    continue
-                    
-                # Create new vehicle
-                new_vehicle = Kendaraan(
-                    jenis=jenis,
-                    plat_nomor=plat,
-                    merek=row['merek'].strip(),
-                    tipe=row['tipe'].strip(),
-                    tahun=tahun,
-                    fuel_type=fuel_type,
-                    nama_instansi=nama_instansi,
-                    load_category=load_category
-                )
-                
-                db.session.add(new_vehicle)
-                db.session.flush()  # Flush but don't commit yet
-                
-                successes += 1
-                
-            except Exception as e:
-                errors.append({
-                    'row': row_num,
-                    'error': str(e)
-                })
-                
-        # Commit all successful additions if no errors
-        if errors:
+    # Job mode: spool the file and import it in the background
+    if request.form.get('background', request.args.get('background')) in ('1', 'true'):
+        try:
+            job = batch_upload.submit_upload(current_app._get_current_object(), file, mode, current_user.id)
+            current_app.logger.info(f"Upload job {job.id} ({mode}) queued by user: {current_user.username}")
+            payload = batch_upload.job_progress(job)
+            payload['status_url'] = url_for('api.upload_status', job_id=job.id)
+            return jsonify(payload), 202
+        except Exception as e:
             db.session.rollback()
-        else:
-            db.session.commit()
-            
-        return jsonify({
-            'successes': successes,
-            'errors': errors,
-            'total_rows': row_num - 1  # Subtract header row
-        })
+            current_app.logger.error(str(e))
+            return jsonify({'error': 'Error starting upload job'}), 500
+        
+    try:
+        summary = batch_upload.import_rows(batch_upload.read_csv(file.stream), mode)
+        current_app.logger.info(
+            f"Batch upload ({mode}): {summary['successes']} of {summary['total_rows']} vehicles saved by user: {current_user.username}"
+        )
+        return jsonify(summary)
+    except UnicodeDecodeError:
+        return jsonify({'error': 'File must be UTF-8 encoded'}), 400
+    except exc.IntegrityError:
+        return jsonify({'error': 'Plat nomor sudah terdaftar'}), 409
     except Exception as e:
-        db.session.rollback()
         current_app.logger.error(str(e))
         return jsonify({'error': str(e)}), 500
 
@@ -480,63 +499,19 @@ def batch_upload_kendaraan():
 def export_csv():
     try:
         # Get filter parameters
-        plat_nomor = request.args.get('plat_nomor', '')
-        merek = request.args.get('merek', '')
-        tipe = request.args.get('tipe', '')
-        jenis = request.args.get('jenis', '')
-        fuel_type = request.args.get('fuel_type', '')
-        
-        # Build query with filters
-        query = Kendaraan.query
-        
-        if plat_nomor:
-            query = query.filter(Kendaraan.plat_nomor.ilike(f'%{plat_nomor}%'))
-        if merek:
-            query = query.filter(Kendaraan.merek.ilike(f'%{merek}%'))
-        if tipe:
-            query = query.filter(Kendaraan.tipe.ilike(f'%{tipe}%'))
-        if jenis:
-            query = query.filter(Kendaraan.jenis == jenis)
-        if fuel_type:
-            query = query.filter(Kendaraan.fuel_type == fuel_type)
-            
-        # Get all vehicles
-        vehicles = query.all()
-        
-        # Create CSV file
-        csv_data = StringIO()
-        writer = csv.writer(csv_data)
-        
-        # Write header
-        writer.writerow(['jenis', 'plat_nomor', 'merek', 'tipe', 'tahun', 'fuel_type', 'nama_instansi', 'load_category'])
-        
-        # Write data
-        for vehicle in vehicles:
-            writer.writerow([
-                vehicle.jenis,
-                vehicle.plat_nomor,
-                vehicle.merek,
-                vehicle.tipe,
-                vehicle.tahun,
-                vehicle.fuel_type,
-                vehicle.nama_instansi,
-                vehicle.load_category
-            ])
-            
-        # Reset pointer to beginning of file
-        csv_data.seek(0)
+        filter_values = {
+            name: request.args.get(name, '')
+            for name in ('plat_nomor', 'merek', 'tipe', 'jenis', 'fuel_type')
+        }
+        compress = request.args.get('gzip') in ('1', 'true')
         
-        # Create temporary file to serve
+        # Rows are written to the response chunk by chunk as they are read
         timestamp = time.strftime("%Y%m%d-%H%M%S")
-        tmp = tempfile.NamedTemporaryFile(delete=False)
-        with open(tmp.name, 'w') as f:
-            f.write(csv_data.getvalue())
-        
-        return send_file(
-            tmp.name,
-            as_attachment=True,
-            download_name=f'kendaraan_export_{timestamp}.csv',
-            mimetype='text/csv'
+        return exports.csv_response(
+            EXPORT_COLUMNS,
+            iter_vehicle_chunks(vehicle_filters(**filter_values)),
+            f'kendaraan_export_{timestamp}.csv',
+            compress=compress
         )
     except Exception as e:
         current_app.logger.error(str(e))
@@ -0,0 +1,99 @@
+"""Per-worker caches for read-heavy payloads.
+
+A TTLCache holds values for a few seconds and is also dropped as soon as this
+worker commits a write to one of the tables it depends on. Writes are seen
+both as ORM flushes and as Core/bulk statements run through the session.
+Other workers pick up the change when their TTL runs out.
+"""
+import threading
+import time
+from collections import defaultdict
+
+from sqlalchemy import event
+from sqlalchemy.orm import Session
+
+# Table name -> caches that read it
+_dependents = defaultdict(list)
+
+
+class TTLCache:
+    """Values kept for ``ttl`` seconds or until a dependent table is written"""
+
+    def __init__(self, ttl, tables=()):
+        self.ttl = ttl
+        self._values = {}
+        self._generation = 0
+        self._lock = threading.Lock()
+        subscribe(self, tables)
+
+    def get_or_set(self, key, compute):
+        """Return the cached value for key, computing and storing it if needed"""
+        now = time.monotonic()
+        with self._lock:
+            entry = self._values.get(key)
+            if entry is not None and now < entry[1]:
+                return entry[0]
+            generation = self._generation
+
+        value = compute()
+        with self._lock:
+            # Skip storing a value computed across an invalidation
+            if generation == self._generation:
+                self._values[key] = (value, time.monotonic() + self.ttl)
+        return value
+
+    def clear(self):
+        with self._lock:
+            self._values.clear()
+            self._generation += 1
+
+
+def subscribe(listener, tables):
+    """Call listener.clear() whenever this worker commits a write to one of the tables"""
+    for table in tables:
+        _dependents[table].append(listener)
+
+
+def invalidate(*tables):
+    """Drop every cache that depends on one of the tables"""
+    for table in tables:
+        for cache in _dependents.get(table, ()):
+            cache.clear()
+
+
+def _written(session):
+    return session.info.setdefault('written_tables', set())
+
+
+def mark_written(session, *tables):
+    """Record tables written with raw DBAPI statements, which no event sees"""
+    _written(session).update(tables)
+
+
+@event.listens_for(Session, 'after_flush')
+def _track_flush(session, flush_context):
+    tables = _written(session)
+    for obj in list(session.new) + list(session.dirty) + list(session.deleted):
+        table = getattr(obj, '__tablename__', None)
+        if table:
+            tables.add(table)
+
+
+@event.listens_for(Session, 'do_orm_execute')
+def _track_execute(orm_execute_state):
+    if orm_execute_state.is_insert or orm_execute_state.is_update or orm_execute_state.is_delete:
+        table = getattr(orm_execute_state.statement, 'table', None)
+        if getattr(table, 'name', None):
+            _written(orm_execute_state.session).add(table.name)
+
+
+@event.listens_for(Session, 'after_commit')
+def _invalidate_written(session):
+    tables = session.info.pop('written_tables', None)
+    if tables:
+        invalidate(*tables)
+
+
+@event.listens_for(Session, 'after_rollback')
+def _discard_written(session):
+    session.info.pop('written_tables', None)
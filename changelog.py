@@ -0,0 +1,241 @@
+"""Change-data-capture log for kendaraan and hasil_uji.
+
+SQLite triggers append one change_log row per inserted, updated or deleted
+row, with a JSON snapshot of the row, inside the writing transaction. That
+catches ORM flushes, Core bulk statements and raw SQL alike. SQLite has a
+single writer, so change ids are handed out in commit order and a consumer
+can resume from the last id it has seen. Reading a page costs an index range
+scan over the new entries only.
+
+Bulk importers wrap their executemany in bulk_inserts(), which pauses the
+insert trigger for that transaction and logs the new rows with a single
+INSERT ... SELECT instead of one trigger run per row.
+
+Compaction removes entries superseded by a later change to the same row,
+so replaying from any cursor still ends at the current state, and drops
+delete entries past the retention period. Cursors older than the last
+dropped delete must resync from a full export:
+
+    python changelog.py compact
+"""
+import json
+import sys
+import threading
+from contextlib import contextmanager
+from datetime import datetime, timedelta
+
+from sqlalchemy import func, text
+
+from extensions import db
+from models import ChangeLog, ChangeLogBulk, ChangeLogCompaction
+
+# Columns captured per table; the rest (e.g. kendaraan.hasil_terakhir_id) are
+# derived and do not produce change entries
+TRACKED_COLUMNS = {
+    'kendaraan': (
+        'id', 'jenis', 'plat_nomor', 'merek', 'tipe', 'tahun', 'fuel_type',
+        'nama_instansi', 'load_category', 'created_at', 'updated_at'
+    ),
+    'hasil_uji': (
+        'id', 'kendaraan_id', 'user_id', 'tanggal', 'co', 'co2', 'hc', 'o2',
+        'lambda_val', 'opacity', 'valid', 'lulus', 'created_at', 'updated_at'
+    ),
+}
+
+BOOLEAN_COLUMNS = {'hasil_uji': ('valid', 'lulus')}
+
+DEFAULT_PAGE_SIZE = 500
+MAX_PAGE_SIZE = 1000
+
+# Entries older than this are collapsed to the latest change per row
+COLLAPSE_AFTER = timedelta(hours=1)
+
+# Delete entries are kept this long, then dropped
+DELETE_RETENTION = timedelta(days=30)
+
+# Minimum time between automatic compactions
+COMPACT_INTERVAL = timedelta(hours=6)
+
+# UTC now in the DateTime storage format (SQLite's %f has milliseconds only)
+CHANGED_AT = "strftime('%Y-%m-%d %H:%M:%S', 'now') || substr(strftime('%f', 'now'), 3) || '000'"
+
+
+_compact_lock = threading.Lock()
+
+
+def _snapshot(columns, ref):
+    pairs = ', '.join(f"'{name}', {ref}.{name}" for name in columns)
+    return f'json_object({pairs})'
+
+
+def trigger_statements():
+    """DROP/CREATE statements for the change_log triggers"""
+    statements = []
+    for table, columns in TRACKED_COLUMNS.items():
+        data_columns = [name for name in columns if name not in ('id', 'created_at', 'updated_at')]
+        changed = ' OR '.join(f'OLD.{name} IS NOT NEW.{name}' for name in data_columns)
+        not_bulk = f"NOT EXISTS (SELECT 1 FROM change_log_bulk WHERE table_name = '{table}')"
+        triggers = (
+            ('insert', f'AFTER INSERT ON {table} WHEN {not_bulk}', 'NEW'),
+            ('update', f"AFTER UPDATE OF {', '.join(data_columns)} ON {table} WHEN {changed}", 'NEW'),
+            ('delete', f'AFTER DELETE ON {table}', 'OLD'),
+        )
+        for operation, event, ref in triggers:
+            name = f'change_log_{table}_{operation}'
+            statements.append(f'DROP TRIGGER IF EXISTS {name}')
+            statements.append(
+                f"CREATE TRIGGER {name} {event} BEGIN "
+                f"INSERT INTO change_log (table_name, row_id, operation, data, changed_at) "
+                f"VALUES ('{table}', {ref}.id, '{operation}', {_snapshot(columns, ref)}, "
+                f"{CHANGED_AT}); "
+                f"END"
+            )
+    return statements
+
+
+def install_triggers():
+    """(Re)create the triggers so they match TRACKED_COLUMNS; the caller commits"""
+    for statement in trigger_statements():
+        db.session.execute(text(statement))
+
+
+@contextmanager
+def bulk_inserts(table):
+    """Log rows inserted into table inside the block with one statement.
+
+    Must run inside the writing transaction; only inserts are covered, and
+    new rows must get ids above the current maximum, which is yielded so the
+    block can bring other trigger-maintained tables up to date the same way.
+    If the block raises, nothing is logged and the caller is expected to
+    roll back.
+    """
+    columns = TRACKED_COLUMNS[table]
+    db.session.execute(ChangeLogBulk.__table__.insert().values(table_name=table))
+    before = db.session.execute(text(f'SELECT COALESCE(MAX(id), 0) FROM {table}')).scalar()
+    yield before
+    db.session.execute(text(
+        f"INSERT INTO change_log (table_name, row_id, operation, data, changed_at) "
+        f"SELECT '{table}', NEW.id, 'insert', {_snapshot(columns, 'NEW')}, {CHANGED_AT} "
+        f"FROM {table} AS NEW WHERE NEW.id > :before ORDER BY NEW.id"
+    ), {'before': before})
+    db.session.execute(ChangeLogBulk.__table__.delete().where(ChangeLogBulk.table_name == table))
+
+
+def head():
+    """Id of the newest change, or 0; never below horizon() once the newest
+    entries have been purged"""
+    newest = db.session.query(func.coalesce(func.max(ChangeLog.id), 0)).scalar()
+    return max(newest, horizon())
+
+
+def horizon():
+    """Oldest change id a consumer may resume from without missing a delete"""
+    return db.session.query(
+        func.coalesce(func.max(ChangeLogCompaction.purged_through), 0)
+    ).scalar()
+
+
+def serialize(entry):
+    data = json.loads(entry.data) if entry.data else None
+    if data:
+        for name in BOOLEAN_COLUMNS.get(entry.table_name, ()):
+            if data.get(name) is not None:
+                data[name] = bool(data[name])
+    return {
+        'id': entry.id,
+        'table': entry.table_name,
+        'row_id': entry.row_id,
+        'operation': entry.operation,
+        'changed_at': entry.changed_at.isoformat() if entry.changed_at else None,
+        'data': data
+    }
+
+
+def changes_since(after_id, limit=DEFAULT_PAGE_SIZE, tables=None):
+    """Changes after ``after_id`` in commit order; returns (entries, last_id, has_more)"""
+    query = ChangeLog.query.filter(ChangeLog.id > after_id)
+    if tables:
+        query = query.filter(ChangeLog.table_name.in_(tables))
+    entries = query.order_by(ChangeLog.id).limit(limit + 1).all()
+    has_more = len(entries) > limit
+    entries = entries[:limit]
+    last_id = entries[-1].id if entries else max(after_id, 0)
+    return entries, last_id, has_more
+
+
+def compact(now=None, collapse_after=COLLAPSE_AFTER, delete_retention=DELETE_RETENTION):
+    """Collapse superseded entries and drop old deletes; the caller commits.
+
+    Returns the ChangeLogCompaction record of this run.
+    """
+    now = now or datetime.utcnow()
+    table = ChangeLog.__table__
+
+    collapse_through = db.session.query(func.max(ChangeLog.id)).filter(
+        ChangeLog.changed_at < now - collapse_after
+    ).scalar() or 0
+    collapsed = db.session.execute(text('''
+        DELETE FROM change_log
+        WHERE id <= :through AND EXISTS (
+            SELECT 1 FROM change_log later
+            WHERE later.table_name = change_log.table_name
+              AND later.row_id = change_log.row_id
+              AND later.id > change_log.id
+        )
+    '''), {'through': collapse_through}).rowcount
+
+    purge_before = now - delete_retention
+    purged_through = db.session.query(func.max(ChangeLog.id)).filter(
+        ChangeLog.operation == 'delete',
+        ChangeLog.changed_at < purge_before
+    ).scalar() or 0
+    purged = 0
+    if purged_through:
+        purged = db.session.execute(
+            table.delete().where(
+                table.c.operation == 'delete',
+                table.c.id <= purged_through
+            )
+        ).rowcount
+
+    run = ChangeLogCompaction(
+        ran_at=now,
+        collapsed=collapsed,
+        purged=purged,
+        purged_through=max(purged_through, horizon())
+    )
+    db.session.add(run)
+    return run
+
+
+def compaction_due(now=None):
+    last = db.session.query(func.max(ChangeLogCompaction.ran_at)).scalar()
+    return last is None or last < (now or datetime.utcnow()) - COMPACT_INTERVAL
+
+
+def compact_if_due():
+    """Background task: compact when the last run is older than COMPACT_INTERVAL"""
+    if not _compact_lock.acquire(blocking=False):
+        return None
+    try:
+        if compaction_due():
+            run = compact()
+            db.session.commit()
+            return run
+        return None
+    finally:
+        _compact_lock.release()
+
+
+if __name__ == '__main__':
+    from app_init import app
+
+    command = sys.argv[1] if len(sys.argv) > 1 else None
+    with app.app_context():
+        if command == 'compact':
+            run = compact()
+            db.session.commit()
+            print(f"Collapsed {run.collapsed} superseded changes, dropped {run.purged} old deletes")
+            print(f"Cursors before {run.purged_through} must resync")
+        else:
+            print("Please provide a command: 'compact'.")
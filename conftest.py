@@ -0,0 +1,64 @@
+"""Fixtures giving each test the app on its own SQLite database."""
+import pytest
+
+import caching
+import evaluate
+import main
+from app_init import app as flask_app
+from extensions import db
+
+
+@pytest.fixture
+def app(tmp_path):
+    flask_app.config.update(
+        TESTING=True,
+        WTF_CSRF_ENABLED=False,
+        SQLALCHEMY_DATABASE_URI=f"sqlite:///{tmp_path / 'emisi.db'}",
+        EXPORT_DIR=str(tmp_path / 'exports'),
+        UPLOAD_DIR=str(tmp_path / 'uploads'),
+    )
+    main.init_db()
+    with flask_app.app_context():
+        evaluate.refresh_thresholds()
+        caching.invalidate('kendaraan', 'hasil_uji')
+        yield flask_app
+        db.session.remove()
+
+
+@pytest.fixture
+def client(app):
+    """Test client logged in as the default admin"""
+    client = app.test_client()
+    with client.session_transaction() as session:
+        session['_user_id'] = '1'
+        session['_fresh'] = True
+    return client
+
+
+@pytest.fixture
+def add_vehicle(client):
+    """Register a vehicle through the API"""
+    def add(plat_nomor, fuel_type='bensin', load_category='kendaraan_penumpang', tahun=2015, jenis='umum'):
+        response = client.post('/api/kendaraan', json={
+            'jenis': jenis,
+            'plat_nomor': plat_nomor,
+            'merek': 'Toyota',
+            'tipe': 'Avanza',
+            'tahun': tahun,
+            'fuel_type': fuel_type,
+            'load_category': load_category
+        })
+        assert response.status_code in (200, 201), response.get_json()
+    return add
+
+
+@pytest.fixture
+def add_result(client):
+    """Record a test result through the API; bensin readings by default"""
+    def add(plat_nomor, **readings):
+        reading = {'co': 0.5, 'co2': 14, 'hc': 100, 'o2': 0.5, 'lambda_val': 1.0}
+        reading.update(readings)
+        response = client.post(f'/api/hasil-uji/{plat_nomor}', json=reading)
+        assert response.status_code == 200, response.get_json()
+        return response.get_json()
+    return add
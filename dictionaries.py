@@ -0,0 +1,158 @@
+"""Brand and type dictionaries behind the merek/tipe dropdowns.
+
+merek_kendaraan and tipe_kendaraan hold every distinct kendaraan.merek and
+(merek, tipe) pair with the number of vehicles using it. SQLite triggers
+keep the counts in step with inserts, updates and deletes from any writer,
+and a value disappears when its last vehicle goes. Listing them reads a few
+hundred rows instead of a DISTINCT scan over kendaraan.
+
+Bulk inserts inside changelog.bulk_inserts() pause the insert trigger and
+count their rows with count_inserted(). The JSON payloads are cached per
+worker and carry an ETag, so browsers revalidate them with a 304. To
+recount from kendaraan:
+
+    python dictionaries.py rebuild
+"""
+import hashlib
+import json
+import sys
+
+from sqlalchemy import text
+
+from caching import TTLCache
+from extensions import db
+from models import MerekKendaraan, TipeKendaraan
+
+# Seconds other workers' vehicle writes may take to show up in the payloads
+DICTIONARY_TTL = 60
+
+# (table, key columns) maintained from kendaraan
+DICTIONARIES = (
+    ('merek_kendaraan', ('merek',)),
+    ('tipe_kendaraan', ('merek', 'tipe')),
+)
+
+_payloads = TTLCache(DICTIONARY_TTL, tables=('kendaraan',))
+
+
+def _add(table, columns, ref):
+    names = ', '.join(columns)
+    values = ', '.join(f'{ref}.{name}' for name in columns)
+    return (
+        f'INSERT INTO {table} ({names}, jumlah) VALUES ({values}, 1) '
+        f'ON CONFLICT ({names}) DO UPDATE SET jumlah = jumlah + 1;'
+    )
+
+
+def _remove(table, columns, ref):
+    match = ' AND '.join(f'{name} = {ref}.{name}' for name in columns)
+    return (
+        f'UPDATE {table} SET jumlah = jumlah - 1 WHERE {match}; '
+        f'DELETE FROM {table} WHERE {match} AND jumlah <= 0;'
+    )
+
+
+def trigger_statements():
+    """DROP/CREATE statements for the triggers keeping the dictionaries in sync"""
+    not_bulk = "NOT EXISTS (SELECT 1 FROM change_log_bulk WHERE table_name = 'kendaraan')"
+    statements = []
+    for table, columns in DICTIONARIES:
+        changed = ' OR '.join(f'OLD.{name} IS NOT NEW.{name}' for name in columns)
+        triggers = (
+            ('insert', f'AFTER INSERT ON kendaraan WHEN {not_bulk}', _add(table, columns, 'NEW')),
+            ('delete', 'AFTER DELETE ON kendaraan', _remove(table, columns, 'OLD')),
+            (
+                'update',
+                f"AFTER UPDATE OF {', '.join(columns)} ON kendaraan WHEN {changed}",
+                f"{_remove(table, columns, 'OLD')} {_add(table, columns, 'NEW')}"
+            ),
+        )
+        for operation, event, body in triggers:
+            name = f'{table}_{operation}'
+            statements.append(f'DROP TRIGGER IF EXISTS {name}')
+            statements.append(f'CREATE TRIGGER {name} {event} BEGIN {body} END')
+    return statements
+
+
+def install():
+    """(Re)create the triggers, filling the dictionaries if they are empty; the caller commits"""
+    for statement in trigger_statements():
+        db.session.execute(text(statement))
+    empty = not db.session.execute(text('SELECT EXISTS (SELECT 1 FROM merek_kendaraan)')).scalar()
+    if empty:
+        rebuild()
+
+
+def _count(after_id=None):
+    where = 'WHERE id > :after_id' if after_id is not None else ''
+    for table, columns in DICTIONARIES:
+        names = ', '.join(columns)
+        db.session.execute(text(
+            f'INSERT INTO {table} ({names}, jumlah) '
+            f'SELECT {names}, COUNT(*) FROM kendaraan {where} GROUP BY {names} '
+            f'ON CONFLICT ({names}) DO UPDATE SET jumlah = jumlah + excluded.jumlah'
+        ), {'after_id': after_id})
+
+
+def count_inserted(after_id):
+    """Count the vehicles with ids above after_id in one statement per dictionary"""
+    _count(after_id)
+
+
+def rebuild():
+    """Recount both dictionaries from kendaraan; the caller commits"""
+    for table, _ in DICTIONARIES:
+        db.session.execute(text(f'DELETE FROM {table}'))
+    _count()
+
+
+def mereks():
+    """Every brand in use, by name"""
+    return [merek for merek, in db.session.query(MerekKendaraan.merek).order_by(MerekKendaraan.merek)]
+
+
+def tipes(merek=None):
+    """Every type in use, by name, optionally only those of one brand"""
+    query = db.session.query(TipeKendaraan.tipe)
+    if merek:
+        query = query.filter(TipeKendaraan.merek == merek)
+    return [tipe for tipe, in query.group_by(TipeKendaraan.tipe).order_by(TipeKendaraan.tipe)]
+
+
+def _payload(values):
+    body = json.dumps(values, ensure_ascii=False)
+    return body, hashlib.sha1(body.encode('utf-8')).hexdigest()
+
+
+def _tipe_payloads():
+    """Payloads of tipes() for no brand and for every brand, from one read"""
+    by_merek = {}
+    for merek, tipe in db.session.query(TipeKendaraan.merek, TipeKendaraan.tipe).order_by(TipeKendaraan.tipe):
+        by_merek.setdefault(merek, []).append(tipe)
+    payloads = {merek: _payload(values) for merek, values in by_merek.items()}
+    payloads[None] = _payload(sorted({tipe for values in by_merek.values() for tipe in values}))
+    return payloads
+
+
+def cached_mereks():
+    """(JSON body, ETag) of mereks(), cached per worker"""
+    return _payloads.get_or_set('merek', lambda: _payload(mereks()))
+
+
+def cached_tipes(merek=None):
+    """(JSON body, ETag) of tipes(merek), cached per worker"""
+    payloads = _payloads.get_or_set('tipe', _tipe_payloads)
+    return payloads.get(merek or None) or _payload([])
+
+
+if __name__ == '__main__':
+    from app_init import app
+
+    command = sys.argv[1] if len(sys.argv) > 1 else None
+    with app.app_context():
+        if command == 'rebuild':
+            rebuild()
+            db.session.commit()
+            print(f"Rebuilt {', '.join(table for table, _ in DICTIONARIES)}")
+        else:
+            print("Please provide a command: 'rebuild'.")
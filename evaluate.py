@@ -0,0 +1,295 @@
+"""Emission threshold evaluation.
+
+The Config row stores the limits as nested JSON keyed by load category and
+age range, with scalar columns as fallbacks. Resolving that on every test
+submission means a config SELECT plus JSON decoding per request, so the row
+is compiled once into a flat, read-only table keyed by
+(fuel_type, load_category, age_category) and cached per worker process.
+"""
+import threading
+import time
+from collections import namedtuple
+from types import MappingProxyType
+
+import numpy as np
+
+from extensions import db
+from models import Config
+
+# First and last model year of the middle age range for each fuel type
+AGE_BOUNDARIES = {
+    'bensin': (2007, 2018),
+    'solar': (2010, 2021),
+}
+
+LOAD_CATEGORIES = {
+    'bensin': ('kendaraan_muatan', 'kendaraan_penumpang'),
+    'solar': ('<3.5ton', '>=3.5ton'),
+}
+
+BENSIN_LIMITS = ('co_max', 'hc_max', 'co2_min', 'o2_max', 'lambda_min', 'lambda_max')
+SOLAR_LIMITS = ('opacity_max',)
+
+# Measured values stored on every HasilUji row
+READING_COLUMNS = ('co', 'co2', 'hc', 'o2', 'lambda_val', 'opacity')
+
+# Column order of the violation mask returned by evaluate_batch
+LIMIT_NAMES = BENSIN_LIMITS + SOLAR_LIMITS
+
+# Scalar fallback limits, mapped to their Config column names
+SCALAR_COLUMNS = {
+    'bensin_co_max': 'gasoline_co_max',
+    'bensin_hc_max': 'gasoline_hc_max',
+    'co2_min': 'co2_min',
+    'o2_max': 'o2_max',
+    'lambda_min': 'lambda_min',
+    'lambda_max': 'lambda_max',
+    'solar_opacity_max': 'diesel_opacity_max',
+}
+
+# Seconds a worker trusts its compiled table before checking Config.updated_at
+REVALIDATE_SECONDS = 30
+
+Evaluation = namedtuple('Evaluation', ['lulus', 'limits', 'age_category'])
+BatchEvaluation = namedtuple('BatchEvaluation', ['lulus', 'violations', 'age_index'])
+
+
+def normalize_fuel_type(fuel_type):
+    """Anything that is not bensin is graded as solar, as the test form does"""
+    return 'bensin' if fuel_type == 'bensin' else 'solar'
+
+
+def age_category(fuel_type, tahun):
+    """Return the age range label used by the limit tables"""
+    first, last = AGE_BOUNDARIES[normalize_fuel_type(fuel_type)]
+    if tahun < first:
+        return f'<{first}'
+    if tahun <= last:
+        return f'{first}-{last}'
+    return f'>{last}'
+
+
+def age_categories(fuel_type):
+    """All age range labels for a fuel type, oldest first"""
+    first, last = AGE_BOUNDARIES[normalize_fuel_type(fuel_type)]
+    return (f'<{first}', f'{first}-{last}', f'>{last}')
+
+
+def scalar_limits(config=None):
+    """Scalar fallback limits of a Config row, or the model defaults"""
+    if config is None:
+        columns = Config.__table__.c
+        return {name: columns[column].default.arg for name, column in SCALAR_COLUMNS.items()}
+    return {name: getattr(config, name) for name in SCALAR_COLUMNS}
+
+
+def parameter_documents(config=None):
+    """(bensin_parameters, solar_parameters) of a Config row, or the defaults"""
+    if config is None:
+        columns = Config.__table__.c
+        return columns.gasoline_parameters.default.arg, columns.diesel_parameters.default.arg
+    return config.bensin_parameters, config.solar_parameters
+
+
+class Thresholds:
+    """Flat, immutable lookup table of emission limits"""
+
+    def __init__(self, table, defaults, version=None):
+        self._table = MappingProxyType(dict(table))
+        self._defaults = MappingProxyType(dict(defaults))
+        self.version = version
+
+    @classmethod
+    def from_config(cls, config):
+        """Compile a Config row"""
+        return cls.compile(
+            config.bensin_parameters,
+            config.solar_parameters,
+            scalar_limits(config),
+            version=config.updated_at,
+        )
+
+    @classmethod
+    def compile(cls, bensin_parameters, solar_parameters, scalars, version=None):
+        """Compile nested parameter documents plus scalar fallbacks.
+
+        Missing categories or keys fall back to the scalar limits, and O2 is
+        always checked against the global o2_max, matching the rules the
+        test form has always applied.
+        """
+        bensin_defaults = {
+            'co_max': scalars['bensin_co_max'],
+            'hc_max': scalars['bensin_hc_max'],
+            'co2_min': scalars['co2_min'],
+            'o2_max': scalars['o2_max'],
+            'lambda_min': scalars['lambda_min'],
+            'lambda_max': scalars['lambda_max'],
+        }
+        solar_defaults = {'opacity_max': scalars['solar_opacity_max']}
+
+        table = {}
+        for fuel_type, parameters, defaults, names in (
+            ('bensin', bensin_parameters or {}, bensin_defaults, BENSIN_LIMITS),
+            ('solar', solar_parameters or {}, solar_defaults, SOLAR_LIMITS),
+        ):
+            categories = set(LOAD_CATEGORIES[fuel_type]) | set(parameters)
+            for load_category in categories:
+                by_age = parameters.get(load_category) or {}
+                for age in age_categories(fuel_type):
+                    params = by_age.get(age) or {}
+                    limits = {}
+                    for name in names:
+                        if name == 'o2_max':
+                            limits[name] = float(defaults[name])
+                        else:
+                            limits[name] = float(params.get(name, defaults[name]))
+                    table[(fuel_type, load_category, age)] = MappingProxyType(limits)
+
+        defaults = {
+            'bensin': MappingProxyType({k: float(v) for k, v in bensin_defaults.items()}),
+            'solar': MappingProxyType({k: float(v) for k, v in solar_defaults.items()}),
+        }
+        return cls(table, defaults, version=version)
+
+    def items(self):
+        """Iterate over ((fuel_type, load_category, age_category), limits)"""
+        return self._table.items()
+
+    def same_limits(self, other):
+        """Whether other grades every reading exactly as this table does"""
+        return self._table == other._table and self._defaults == other._defaults
+
+    def limits(self, fuel_type, load_category, tahun):
+        """Return (age_category, limits) for a vehicle"""
+        fuel_type = normalize_fuel_type(fuel_type)
+        age = age_category(fuel_type, tahun)
+        limits = self._table.get((fuel_type, load_category, age))
+        if limits is None:
+            limits = self._defaults[fuel_type]
+        return age, limits
+
+    def evaluate(self, fuel_type, load_category, tahun, co=0, co2=0, hc=0,
+                 o2=0, lambda_val=0, opacity=None):
+        """Grade a single reading"""
+        age, limits = self.limits(fuel_type, load_category, tahun)
+        if normalize_fuel_type(fuel_type) == 'bensin':
+            lulus = (
+                co <= limits['co_max'] and
+                hc <= limits['hc_max'] and
+                co2 >= limits['co2_min'] and
+                o2 <= limits['o2_max'] and
+                limits['lambda_min'] <= lambda_val <= limits['lambda_max']
+            )
+        else:
+            lulus = opacity is not None and opacity <= limits['opacity_max']
+        return Evaluation(bool(lulus), dict(limits), age)
+
+    def evaluate_batch(self, co, co2, hc, o2, lambda_val, opacity, tahun,
+                       fuel_type, load_category):
+        """Grade column arrays of readings at once.
+
+        Returns a BatchEvaluation whose ``violations`` is an (n, 7) boolean
+        mask in LIMIT_NAMES order and whose ``age_index`` is 0, 1 or 2 for
+        the oldest, middle and newest age range of each row's fuel type.
+        Missing readings (None/NaN) fail their limit, as in evaluate().
+        """
+        tahun = np.asarray(tahun, dtype=np.int64)
+        is_bensin = np.asarray(fuel_type, dtype=object) == 'bensin'
+        fuel_index = np.where(is_bensin, 0, 1)
+
+        first = np.where(is_bensin, AGE_BOUNDARIES['bensin'][0], AGE_BOUNDARIES['solar'][0])
+        last = np.where(is_bensin, AGE_BOUNDARIES['bensin'][1], AGE_BOUNDARIES['solar'][1])
+        age_index = np.where(tahun < first, 0, np.where(tahun <= last, 1, 2))
+
+        # Categories missing from the table use the last slot, which holds
+        # the per-fuel defaults
+        categories = sorted({category for _, category, _ in self._table})
+        load_category = np.asarray(load_category, dtype=object)
+        category_index = np.full(len(tahun), len(categories), dtype=np.intp)
+        for c, category in enumerate(categories):
+            category_index[load_category == category] = c
+
+        # Lookup table of shape (fuel, load category, age range, limit)
+        lut = np.full((2, len(categories) + 1, 3, len(LIMIT_NAMES)), np.nan)
+        for f, fuel in enumerate(('bensin', 'solar')):
+            for c, category in enumerate(categories + [None]):
+                for a, age in enumerate(age_categories(fuel)):
+                    limits = self._table.get((fuel, category, age), self._defaults[fuel])
+                    for name, value in limits.items():
+                        lut[f, c, a, LIMIT_NAMES.index(name)] = value
+        limits = lut[fuel_index, category_index, age_index]
+
+        def column(values):
+            return np.asarray(values, dtype=np.float64)
+
+        co, co2, hc, o2 = column(co), column(co2), column(hc), column(o2)
+        lambda_val, opacity = column(lambda_val), column(opacity)
+
+        # Comparisons are written as "within limit" and negated so that NaN
+        # readings count as violations
+        violations = np.empty((len(tahun), len(LIMIT_NAMES)), dtype=bool)
+        violations[:, 0] = ~(co <= limits[:, 0])
+        violations[:, 1] = ~(hc <= limits[:, 1])
+        violations[:, 2] = ~(co2 >= limits[:, 2])
+        violations[:, 3] = ~(o2 <= limits[:, 3])
+        violations[:, 4] = ~(lambda_val >= limits[:, 4])
+        violations[:, 5] = ~(lambda_val <= limits[:, 5])
+        violations[:, 6] = ~(opacity <= limits[:, 6])
+
+        bensin_columns = len(BENSIN_LIMITS)
+        violations[is_bensin, bensin_columns:] = False
+        violations[~is_bensin, :bensin_columns] = False
+
+        lulus = ~violations.any(axis=1)
+        return BatchEvaluation(lulus, violations, age_index)
+
+
+# Compiled table and the monotonic time it was last validated, swapped as a
+# single tuple so readers never see a half-updated pair
+_cached = None
+_lock = threading.Lock()
+
+
+def _config_version():
+    return db.session.query(Config.updated_at).order_by(Config.id).limit(1).scalar()
+
+
+def get_thresholds():
+    """Return this worker's compiled thresholds, recompiling when stale"""
+    global _cached
+    cached = _cached
+    now = time.monotonic()
+    if cached is not None and now - cached[1] < REVALIDATE_SECONDS:
+        return cached[0]
+
+    with _lock:
+        cached = _cached
+        if cached is not None and now - cached[1] < REVALIDATE_SECONDS:
+            return cached[0]
+        if cached is not None and _config_version() == cached[0].version:
+            _cached = (cached[0], now)
+            return cached[0]
+        thresholds = Thresholds.from_config(Config.get_config())
+        _cached = (thresholds, now)
+        return thresholds
+
+
+def refresh_thresholds(config=None):
+    """Recompile from a freshly committed Config and swap it in"""
+    global _cached
+    thresholds = Thresholds.from_config(config or Config.get_config())
+    with _lock:
+        _cached = (thresholds, time.monotonic())
+    return thresholds
+
+
+def evaluate_batch(**columns):
+    """Grade column arrays of readings using the cached thresholds"""
+    return get_thresholds().evaluate_batch(**columns)
+
+
+def evaluate(kendaraan, **readings):
+    """Grade a reading for a Kendaraan using the cached thresholds"""
+    return get_thresholds().evaluate(
+        kendaraan.fuel_type, kendaraan.load_category, kendaraan.tahun, **readings
+    )
@@ -0,0 +1,321 @@
+"""Background export jobs.
+
+An export request is stored as an ExportJob and built by a small worker pool
+into a file under the instance directory. The builder reads in short keyset
+chunks and commits its row count after each one, so any worker can report
+progress. Finished files are kept for EXPORT_RETENTION_HOURS; an identical
+request from the same user while the exported tables are unchanged gets the
+existing job back instead of a new build.
+"""
+import csv
+import hashlib
+import io
+import json
+import logging
+import os
+import threading
+import zlib
+from datetime import datetime, timedelta
+
+from flask import Response, current_app, stream_with_context
+from sqlalchemy import and_, func, or_
+
+from background import WorkerPool
+from extensions import db
+from models import ExportJob, HasilUji, Kendaraan, User
+
+logger = logging.getLogger(__name__)
+
+# Filters, download name and source tables of each export kind
+EXPORT_KINDS = {
+    'hasil_uji': {
+        'params': ('plat_nomor', 'merek', 'start_date', 'end_date', 'result'),
+        'prefix': 'laporan_uji_emisi',
+        'extension': 'xlsx',
+        'mimetype': 'application/vnd.openxmlformats-officedocument.spreadsheetml.sheet',
+        'tables': (HasilUji, Kendaraan),
+    },
+    'kendaraan': {
+        'params': ('plat_nomor', 'merek', 'tipe', 'jenis', 'fuel_type'),
+        'prefix': 'kendaraan_export',
+        'extension': 'csv',
+        'mimetype': 'text/csv',
+        'tables': (Kendaraan,),
+    },
+}
+
+# zlib window bits that produce a gzip container
+GZIP_WBITS = 31
+
+# Defaults for the EXPORT_WORKERS and EXPORT_RETENTION_HOURS settings
+DEFAULT_WORKERS = 2
+DEFAULT_RETENTION_HOURS = 24
+
+# An active job that has not reported progress for this long is orphaned
+STALE_SECONDS = 120
+
+ACTIVE_STATUSES = ('pending', 'running')
+
+_pool = None
+_pool_lock = threading.Lock()
+
+
+def _worker_pool(app):
+    global _pool
+    with _pool_lock:
+        if _pool is None:
+            _pool = WorkerPool(app.config.get('EXPORT_WORKERS', DEFAULT_WORKERS), 'export')
+        return _pool
+
+
+def export_dir(app):
+    """Directory holding finished export files"""
+    path = app.config.get('EXPORT_DIR') or os.path.join(app.instance_path, 'exports')
+    os.makedirs(path, exist_ok=True)
+    return path
+
+
+def normalize_params(kind, values):
+    """Known, non-empty filter values of a kind; raises ValueError for an unknown kind"""
+    if kind not in EXPORT_KINDS:
+        raise ValueError(f'Unknown export kind: {kind}')
+    params = {}
+    for name in EXPORT_KINDS[kind]['params']:
+        value = values.get(name)
+        if value is not None and str(value).strip():
+            params[name] = str(value).strip()
+    return params
+
+
+def iter_csv(header, chunks, compress=False):
+    """Encode a header and chunks of rows as CSV bytes, gzipped if asked.
+
+    Yields one piece per chunk, so only a single chunk is ever held in memory.
+    """
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    compressor = zlib.compressobj(6, zlib.DEFLATED, GZIP_WBITS) if compress else None
+
+    def drain():
+        data = buffer.getvalue().encode('utf-8')
+        buffer.seek(0)
+        buffer.truncate()
+        return compressor.compress(data) if compressor else data
+
+    writer.writerow(header)
+    yield drain()
+    for rows in chunks:
+        writer.writerows(rows)
+        piece = drain()
+        if piece:
+            yield piece
+    if compressor:
+        yield compressor.flush()
+
+
+def csv_response(header, chunks, filename, compress=False):
+    """Stream CSV as a download, as filename.gz when compressed"""
+    response = Response(
+        stream_with_context(iter_csv(header, chunks, compress)),
+        mimetype='application/gzip' if compress else 'text/csv'
+    )
+    if compress:
+        filename = f'{filename}.gz'
+    response.headers['Content-Disposition'] = f'attachment; filename="{filename}"'
+    # Let proxies pass chunks through as they are produced
+    response.headers['X-Accel-Buffering'] = 'no'
+    return response
+
+
+def _params_key(kind, params, user_id):
+    raw = json.dumps([kind, params, user_id], sort_keys=True, separators=(',', ':'))
+    return hashlib.sha256(raw.encode()).hexdigest()
+
+
+def data_version(kind):
+    """Row count, highest id and latest update of each table an export reads"""
+    parts = []
+    for model in EXPORT_KINDS[kind]['tables']:
+        count, max_id, updated_at = db.session.query(
+            func.count(model.id), func.max(model.id), func.max(model.updated_at)
+        ).one()
+        parts.append(f"{count}:{max_id or 0}:{updated_at.isoformat() if updated_at else '-'}")
+    return '|'.join(parts)
+
+
+def submit_export(app, kind, values, user_id=None):
+    """Queue an export, or return the job already covering the same request.
+
+    Returns (job, reused). Raises ValueError for an unknown kind.
+    """
+    params = normalize_params(kind, values)
+    purge_expired()
+    key = _params_key(kind, params, user_id)
+    version = data_version(kind)
+
+    job = ExportJob.query.filter(
+        ExportJob.params_key == key,
+        ExportJob.data_version == version,
+        or_(
+            ExportJob.status.in_(ACTIVE_STATUSES),
+            and_(ExportJob.status == 'completed', ExportJob.expires_at > datetime.utcnow())
+        )
+    ).order_by(ExportJob.id.desc()).first()
+    if job and (job.status != 'completed' or os.path.exists(job.file_path)):
+        return job, True
+
+    job = ExportJob(
+        kind=kind,
+        params=json.dumps(params, sort_keys=True),
+        params_key=key,
+        data_version=version,
+        user_id=user_id
+    )
+    db.session.add(job)
+    db.session.commit()
+    _worker_pool(app).submit(app, _run, job.id, name=f'export-{job.id}')
+    return job, False
+
+
+def resume_exports(app):
+    """Queue again the active jobs whose worker stopped; returns how many"""
+    cutoff = datetime.utcnow() - timedelta(seconds=STALE_SECONDS)
+    job_ids = [job_id for job_id, in db.session.query(ExportJob.id).filter(
+        ExportJob.status.in_(ACTIVE_STATUSES),
+        ExportJob.updated_at < cutoff
+    ).order_by(ExportJob.id)]
+    for job_id in job_ids:
+        logger.info(f"Resuming export job {job_id}")
+        _worker_pool(app).submit(app, _run, job_id, name=f'export-{job_id}')
+    return len(job_ids)
+
+
+def purge_expired():
+    """Delete the files of finished jobs past their retention; returns how many"""
+    jobs = ExportJob.query.filter(
+        ExportJob.status == 'completed',
+        ExportJob.expires_at <= datetime.utcnow()
+    ).all()
+    for job in jobs:
+        _remove(job.file_path)
+        job.status = 'expired'
+        job.file_path = None
+    if jobs:
+        db.session.commit()
+    return len(jobs)
+
+
+def job_progress(job):
+    """Serialize a job with its completion percentage"""
+    percent = 0.0
+    if job.status == 'completed':
+        percent = 100.0
+    elif job.total:
+        percent = min(100.0, job.processed / job.total * 100)
+
+    return {
+        'id': job.id,
+        'kind': job.kind,
+        'status': job.status,
+        'params': json.loads(job.params or '{}'),
+        'total': job.total,
+        'processed': job.processed,
+        'percent': round(percent, 1),
+        'file_name': job.file_name,
+        'file_size': job.file_size,
+        'error': job.error,
+        'created_at': job.created_at.isoformat() if job.created_at else None,
+        'updated_at': job.updated_at.isoformat() if job.updated_at else None,
+        'finished_at': job.finished_at.isoformat() if job.finished_at else None,
+        'expires_at': job.expires_at.isoformat() if job.expires_at else None
+    }
+
+
+def _remove(path):
+    if path:
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+
+
+def _claim(job_id):
+    """Mark the job running unless another worker holds it"""
+    table = ExportJob.__table__
+    now = datetime.utcnow()
+    cutoff = now - timedelta(seconds=STALE_SECONDS)
+    claimed = db.session.execute(
+        table.update().where(
+            table.c.id == job_id,
+            (table.c.status == 'pending') |
+            ((table.c.status == 'running') & (table.c.updated_at < cutoff))
+        ).values(status='running', processed=0, updated_at=now)
+    ).rowcount
+    db.session.commit()
+    return claimed == 1
+
+
+def _count(kind, params):
+    # Imported here because the blueprint package imports this module
+    if kind == 'hasil_uji':
+        from blueprints.reports import count_results
+        return count_results(params)
+    from blueprints.vehicles import count_vehicles
+    return count_vehicles(params)
+
+
+def _write(kind, path, params, username, progress):
+    """Write the export file; returns the number of rows written"""
+    if kind == 'hasil_uji':
+        from blueprints.reports import write_results_workbook
+        return write_results_workbook(path, params, username, progress)
+    from blueprints.vehicles import write_vehicles_csv
+    with open(path, 'w', newline='', encoding='utf-8') as f:
+        return write_vehicles_csv(f, params, progress)
+
+
+def _run(job_id):
+    if not _claim(job_id):
+        return
+
+    job = ExportJob.query.get(job_id)
+    spec = EXPORT_KINDS[job.kind]
+    params = json.loads(job.params or '{}')
+    user = User.query.get(job.user_id) if job.user_id else None
+    file_name = f"{spec['prefix']}_{job.created_at:%Y%m%d-%H%M%S}.{spec['extension']}"
+    path = os.path.join(export_dir(current_app), f"{job_id}.{spec['extension']}")
+    partial = f'{path}.part'
+
+    def progress(rows):
+        ExportJob.query.filter_by(id=job_id).update({'processed': rows}, synchronize_session=False)
+        db.session.commit()
+
+    try:
+        job.total = _count(job.kind, params)
+        db.session.commit()
+        written = _write(job.kind, partial, params, user.username if user else 'Unknown', progress)
+        os.replace(partial, path)
+    except Exception as e:
+        db.session.rollback()
+        _remove(partial)
+        ExportJob.query.filter_by(id=job_id).update(
+            {'status': 'failed', 'error': str(e), 'finished_at': datetime.utcnow()},
+            synchronize_session=False
+        )
+        db.session.commit()
+        logger.error(f"Export job {job_id} failed: {str(e)}")
+        return
+
+    finished_at = datetime.utcnow()
+    retention = current_app.config.get('EXPORT_RETENTION_HOURS', DEFAULT_RETENTION_HOURS)
+    ExportJob.query.filter_by(id=job_id).update({
+        'status': 'completed',
+        'processed': written,
+        'file_path': path,
+        'file_name': file_name,
+        'file_size': os.path.getsize(path),
+        'finished_at': finished_at,
+        'expires_at': finished_at + timedelta(hours=retention)
+    }, synchronize_session=False)
+    db.session.commit()
+    logger.info(f"Export job {job_id} completed: {written} rows")
@@ -4,6 +4,11 @@ from sqlalchemy import inspect, text
 from app_init import app, create_app
 from extensions import db
 from models import Kendaraan, HasilUji, User, Config
+import rollups
+import changelog
+import search
+import plates
+import dictionaries
 from flask import redirect, url_for
 
 # Configure logging
@@ -132,6 +137,28 @@ def update_schema():
             if 'updated_at' not in kendaraan_cols:
                 logger.info("Adding updated_at to kendaraan table")
                 db.session.execute(text('ALTER TABLE kendaraan ADD COLUMN updated_at DATETIME DEFAULT CURRENT_TIMESTAMP'))
+            if 'hasil_terakhir_id' not in kendaraan_cols:
+                logger.info("Adding hasil_terakhir_id to kendaraan table")
+                db.session.execute(text('ALTER TABLE kendaraan ADD COLUMN hasil_terakhir_id INTEGER'))
+                db.session.execute(text('''
+                    UPDATE kendaraan SET hasil_terakhir_id = (
+                        SELECT h.id FROM hasil_uji h
+                        WHERE h.kendaraan_id = kendaraan.id
+                        ORDER BY h.tanggal DESC, h.id DESC
+                        LIMIT 1
+                    )
+                '''))
+            db.session.execute(text('CREATE INDEX IF NOT EXISTS ix_kendaraan_hasil_terakhir_id ON kendaraan (hasil_terakhir_id)'))
+            if 'plat_key' not in kendaraan_cols:
+                logger.info("Adding plat_key to kendaraan table")
+                db.session.execute(text('ALTER TABLE kendaraan ADD COLUMN plat_key VARCHAR(20)'))
+            duplicates = plates.backfill_keys()
+            if duplicates:
+                logger.warning(
+                    f"{len(duplicates)} plates duplicate another after normalization and have no plat_key "
+                    f"(e.g. {', '.join(duplicates[:5])}); run 'python plates.py merge-duplicates'"
+                )
+            db.session.execute(text('CREATE UNIQUE INDEX IF NOT EXISTS ux_kendaraan_plat_key ON kendaraan (plat_key)'))
         
         # User table updates
         if 'users' in existing_tables:
@@ -161,6 +188,20 @@ def update_schema():
             if 'updated_at' not in hasiluji_cols:
                 logger.info("Adding updated_at to hasil_uji table")
                 db.session.execute(text('ALTER TABLE hasil_uji ADD COLUMN updated_at DATETIME DEFAULT CURRENT_TIMESTAMP'))
+            db.session.execute(text('CREATE INDEX IF NOT EXISTS ix_hasil_uji_kendaraan_tanggal ON hasil_uji (kendaraan_id, tanggal)'))
+            db.session.execute(text('CREATE INDEX IF NOT EXISTS ix_hasil_uji_tanggal ON hasil_uji (tanggal)'))
+        
+        # Trigram index behind the plate/merek/tipe substring filters
+        if 'kendaraan' in existing_tables and 'change_log_bulk' in existing_tables:
+            search.install()
+        
+        # Brand/type dictionaries behind the filter dropdowns
+        if all(t in existing_tables for t in ('kendaraan', 'change_log_bulk', 'merek_kendaraan', 'tipe_kendaraan')):
+            dictionaries.install()
+        
+        # Change-data-capture triggers feeding change_log
+        if all(t in existing_tables for t in ('change_log', 'change_log_bulk', 'kendaraan', 'hasil_uji')):
+            changelog.install_triggers()
             
         # Config table updates
         if 'config' in existing_tables:
@@ -172,6 +213,18 @@ def update_schema():
                 logger.info("Adding updated_at to config table")
                 db.session.execute(text('ALTER TABLE config ADD COLUMN updated_at DATETIME DEFAULT CURRENT_TIMESTAMP'))
             
+        # Seed the rollup tables for databases that predate them
+        rollup_tables = ('rekap_harian', 'akumulator_emisi')
+        if 'hasil_uji' in existing_tables and all(t in existing_tables for t in rollup_tables):
+            has_results = db.session.execute(text('SELECT EXISTS (SELECT 1 FROM hasil_uji)')).scalar()
+            missing = [
+                t for t in rollup_tables
+                if not db.session.execute(text(f'SELECT EXISTS (SELECT 1 FROM {t})')).scalar()
+            ]
+            if has_results and missing:
+                logger.info(f"Building {', '.join(missing)} from hasil_uji")
+                rollups.rebuild()
+            
         # Commit all schema changes
         db.session.commit()
 
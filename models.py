@@ -1,9 +1,21 @@
+import re
 from datetime import datetime
 from extensions import db
 from sqlalchemy import CheckConstraint
+from sqlalchemy.orm import validates
 from werkzeug.security import generate_password_hash, check_password_hash
 from flask_login import UserMixin
 
+_plate_separator = re.compile(r'[^0-9A-Z]')
+
+# Keys of the fixed endpoints under /api/kendaraan/ and /api/hasil-uji/; a plate
+# with one of these keys would be shadowed by the endpoint, so none is accepted
+RESERVED_PLATE_KEYS = frozenset({'BATCH', 'BATCHUPLOAD', 'LOOKUP', 'SUGGEST', 'TEMPLATE', 'TESTEDPLATS'})
+
+def normalize_plate(plat):
+    """Canonical plate key: upper case letters and digits only"""
+    return _plate_separator.sub('', (plat or '').upper())
+
 class Kendaraan(db.Model):
     __tablename__ = 'kendaraan'
     __table_args__ = (
@@ -11,19 +23,46 @@ class Kendaraan(db.Model):
         CheckConstraint("fuel_type IN ('bensin','solar')", name='ck_kendaraan_fuel_type'),
         CheckConstraint('tahun >= 1900 AND tahun <= 2100', name='ck_kendaraan_tahun_range'),
         CheckConstraint("load_category IN ('kendaraan_muatan', 'kendaraan_penumpang', '<3.5ton', '>=3.5ton')", name='ck_kendaraan_load_category'),
+        db.Index('ux_kendaraan_plat_key', 'plat_key', unique=True),
     )
     id = db.Column(db.Integer, primary_key=True)
     jenis = db.Column(db.String(10), nullable=False)
     plat_nomor = db.Column(db.String(20), unique=True, nullable=False)
+    
+    # normalize_plate(plat_nomor), so "B 1234 XY" and "b1234xy" are one vehicle;
+    # NULL only for legacy duplicates waiting for `python plates.py merge-duplicates`
+    plat_key = db.Column(db.String(20), nullable=True)
+    
     merek = db.Column(db.String(50), nullable=False)
     tipe = db.Column(db.String(50), nullable=False)
     tahun = db.Column(db.Integer, nullable=False)
     fuel_type = db.Column(db.String(10), nullable=False, default='bensin')
     nama_instansi = db.Column(db.String(100), nullable=True, default='-')
     load_category = db.Column(db.String(20), nullable=False, default='kendaraan_penumpang')
+    
+    # Latest HasilUji by (tanggal, id), kept in step with the append-only history
+    hasil_terakhir_id = db.Column(db.Integer, nullable=True, index=True)
+    
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
     updated_at = db.Column(db.DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
     
+    hasil_terakhir = db.relationship(
+        'HasilUji',
+        primaryjoin='foreign(Kendaraan.hasil_terakhir_id) == HasilUji.id',
+        uselist=False,
+        viewonly=True
+    )
+    
+    @validates('plat_nomor')
+    def _set_plat_key(self, key, plat_nomor):
+        self.plat_key = normalize_plate(plat_nomor)
+        return plat_nomor
+    
+    @classmethod
+    def with_plat(cls, plat_nomor):
+        """Query for the vehicle with this plate in any spelling, via the plat_key index"""
+        return cls.query.filter_by(plat_key=normalize_plate(plat_nomor))
+    
     def __repr__(self):
         return f'<Kendaraan {self.plat_nomor}>'
 
@@ -155,11 +194,12 @@ class HasilUji(db.Model):
         CheckConstraint('o2 >= 0', name='ck_o2_nonneg'),
         CheckConstraint('lambda_val >= 0', name='ck_lambda_nonneg'),
         CheckConstraint('opacity IS NULL OR opacity >= 0', name='ck_opacity_nonneg'),
+        db.Index('ix_hasil_uji_kendaraan_tanggal', 'kendaraan_id', 'tanggal'),
     )
     id = db.Column(db.Integer, primary_key=True)
     kendaraan_id = db.Column(db.Integer, db.ForeignKey('kendaraan.id', ondelete='CASCADE'), nullable=False)
     user_id = db.Column(db.Integer, db.ForeignKey('users.id'), nullable=True)
-    tanggal = db.Column(db.DateTime, default=datetime.utcnow)
+    tanggal = db.Column(db.DateTime, default=datetime.utcnow, index=True)
     
     # Emission values
     co = db.Column(db.Float, nullable=False, default=0) 
@@ -200,3 +240,266 @@ class AuditLog(db.Model):
     
     def __repr__(self):
         return f'<AuditLog id={self.id} action={self.action}>'
+
+class RegradeJob(db.Model):
+    """Progress of re-grading stored results against the current Config"""
+    __tablename__ = 'regrade_jobs'
+    __table_args__ = (
+        CheckConstraint("status IN ('pending', 'running', 'completed', 'failed', 'superseded')", name='ck_regrade_jobs_status'),
+    )
+    id = db.Column(db.Integer, primary_key=True)
+    status = db.Column(db.String(20), nullable=False, default='pending')
+    user_id = db.Column(db.Integer, db.ForeignKey('users.id'), nullable=True)
+    
+    # Keyset cursor: rows with hasil_uji.id <= last_id are done, up to max_id
+    last_id = db.Column(db.Integer, nullable=False, default=0)
+    max_id = db.Column(db.Integer, nullable=False, default=0)
+    total = db.Column(db.Integer, nullable=False, default=0)
+    processed = db.Column(db.Integer, nullable=False, default=0)
+    changed = db.Column(db.Integer, nullable=False, default=0)
+    error = db.Column(db.Text, nullable=True)
+    
+    # Rate of the current run, used for the ETA after a resume
+    run_started_at = db.Column(db.DateTime, nullable=True)
+    run_processed = db.Column(db.Integer, nullable=False, default=0)
+    
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    updated_at = db.Column(db.DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
+    finished_at = db.Column(db.DateTime, nullable=True)
+    
+    def __repr__(self):
+        return f'<RegradeJob id={self.id} status={self.status}>'
+
+class ExportJob(db.Model):
+    """An export file built in the background and kept until it expires"""
+    __tablename__ = 'export_jobs'
+    __table_args__ = (
+        CheckConstraint("status IN ('pending', 'running', 'completed', 'failed', 'expired')", name='ck_export_jobs_status'),
+    )
+    id = db.Column(db.Integer, primary_key=True)
+    kind = db.Column(db.String(20), nullable=False)
+    status = db.Column(db.String(20), nullable=False, default='pending')
+    user_id = db.Column(db.Integer, db.ForeignKey('users.id'), nullable=True)
+    
+    # Filter parameters as canonical JSON, and a hash of kind, params and user
+    # used to find a reusable artifact for an identical request
+    params = db.Column(db.Text, nullable=False, default='{}')
+    params_key = db.Column(db.String(64), nullable=False, index=True)
+    
+    # Fingerprint of the exported tables when the job was submitted
+    data_version = db.Column(db.String(100), nullable=True)
+    
+    total = db.Column(db.Integer, nullable=False, default=0)
+    processed = db.Column(db.Integer, nullable=False, default=0)
+    file_path = db.Column(db.String(255), nullable=True)
+    file_name = db.Column(db.String(100), nullable=True)
+    file_size = db.Column(db.Integer, nullable=True)
+    error = db.Column(db.Text, nullable=True)
+    
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    updated_at = db.Column(db.DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
+    finished_at = db.Column(db.DateTime, nullable=True)
+    expires_at = db.Column(db.DateTime, nullable=True, index=True)
+    
+    def __repr__(self):
+        return f'<ExportJob id={self.id} kind={self.kind} status={self.status}>'
+
+class UploadJob(db.Model):
+    """A vehicle CSV import run in the background, committed chunk by chunk"""
+    __tablename__ = 'upload_jobs'
+    __table_args__ = (
+        CheckConstraint("status IN ('pending', 'running', 'completed', 'failed', 'cancelled', 'expired')", name='ck_upload_jobs_status'),
+        CheckConstraint("mode IN ('all', 'partial')", name='ck_upload_jobs_mode'),
+        CheckConstraint("phase IN ('validate', 'insert')", name='ck_upload_jobs_phase'),
+    )
+    id = db.Column(db.Integer, primary_key=True)
+    status = db.Column(db.String(20), nullable=False, default='pending')
+    user_id = db.Column(db.Integer, db.ForeignKey('users.id'), nullable=True)
+    
+    # 'all' jobs validate the whole file before inserting anything
+    mode = db.Column(db.String(10), nullable=False, default='partial')
+    phase = db.Column(db.String(10), nullable=False, default='insert')
+    
+    # Spooled upload, kept until the job completes or expires
+    file_path = db.Column(db.String(255), nullable=True)
+    file_name = db.Column(db.String(255), nullable=True)
+    
+    # Data rows in the file, and rows of the current phase already committed
+    total = db.Column(db.Integer, nullable=True)
+    processed = db.Column(db.Integer, nullable=False, default=0)
+    successes = db.Column(db.Integer, nullable=False, default=0)
+    rejected = db.Column(db.Integer, nullable=False, default=0)
+    
+    # JSON list of the first rejected rows with their reasons
+    errors = db.Column(db.Text, nullable=False, default='[]')
+    error = db.Column(db.Text, nullable=True)
+    
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    updated_at = db.Column(db.DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
+    finished_at = db.Column(db.DateTime, nullable=True)
+    expires_at = db.Column(db.DateTime, nullable=True, index=True)
+    
+    def __repr__(self):
+        return f'<UploadJob id={self.id} mode={self.mode} status={self.status}>'
+
+class SesiUji(db.Model):
+    """A test in progress, collecting analyzer samples before the final result"""
+    __tablename__ = 'sesi_uji'
+    __table_args__ = (
+        CheckConstraint("status IN ('open', 'finalized', 'cancelled')", name='ck_sesi_uji_status'),
+    )
+    id = db.Column(db.Integer, primary_key=True)
+    kendaraan_id = db.Column(db.Integer, db.ForeignKey('kendaraan.id', ondelete='CASCADE'), nullable=False)
+    user_id = db.Column(db.Integer, db.ForeignKey('users.id'), nullable=True)
+    status = db.Column(db.String(20), nullable=False, default='open')
+    
+    # Comma-separated channel order of the packed sample blocks
+    channels = db.Column(db.String(100), nullable=False)
+    sample_count = db.Column(db.Integer, nullable=False, default=0)
+    block_count = db.Column(db.Integer, nullable=False, default=0)
+    
+    # Running count/mean/m2/min/max per channel
+    statistik = db.Column(db.JSON, nullable=False, default=dict)
+    
+    hasil_uji_id = db.Column(db.Integer, db.ForeignKey('hasil_uji.id', ondelete='SET NULL'), nullable=True)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    updated_at = db.Column(db.DateTime, default=datetime.utcnow, onupdate=datetime.utcnow)
+    finalized_at = db.Column(db.DateTime, nullable=True)
+    
+    # Relationships
+    kendaraan = db.relationship('Kendaraan', backref=db.backref('sesi_uji', lazy=True, cascade='all, delete-orphan'))
+    blocks = db.relationship('SampelUjiBlok', backref='sesi', lazy=True, cascade='all, delete-orphan', order_by='SampelUjiBlok.seq')
+    
+    def __repr__(self):
+        return f'<SesiUji id={self.id} kendaraan_id={self.kendaraan_id}>'
+
+class SampelUjiBlok(db.Model):
+    """A batch of analyzer samples packed as little-endian float64 rows"""
+    __tablename__ = 'sampel_uji_blok'
+    __table_args__ = (
+        db.UniqueConstraint('sesi_id', 'seq', name='uq_sampel_uji_blok_sesi_seq'),
+    )
+    id = db.Column(db.Integer, primary_key=True)
+    sesi_id = db.Column(db.Integer, db.ForeignKey('sesi_uji.id', ondelete='CASCADE'), nullable=False)
+    seq = db.Column(db.Integer, nullable=False)
+    count = db.Column(db.Integer, nullable=False)
+    data = db.Column(db.LargeBinary, nullable=False)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    
+    def __repr__(self):
+        return f'<SampelUjiBlok sesi_id={self.sesi_id} seq={self.seq}>'
+
+class RekapHarian(db.Model):
+    """Daily test counts and reading sums, maintained alongside hasil_uji"""
+    __tablename__ = 'rekap_harian'
+    day = db.Column(db.Date, primary_key=True)
+    fuel_type = db.Column(db.String(10), primary_key=True)
+    load_category = db.Column(db.String(20), primary_key=True)
+    jenis = db.Column(db.String(10), primary_key=True)
+    
+    # Counts of valid results
+    tested = db.Column(db.Integer, nullable=False, default=0)
+    passed = db.Column(db.Integer, nullable=False, default=0)
+    failed = db.Column(db.Integer, nullable=False, default=0)
+    
+    # Sums of the readings, for averages over any range
+    sum_co = db.Column(db.Float, nullable=False, default=0)
+    sum_co2 = db.Column(db.Float, nullable=False, default=0)
+    sum_hc = db.Column(db.Float, nullable=False, default=0)
+    sum_o2 = db.Column(db.Float, nullable=False, default=0)
+    sum_lambda_val = db.Column(db.Float, nullable=False, default=0)
+    sum_opacity = db.Column(db.Float, nullable=False, default=0)
+    
+    def __repr__(self):
+        return f'<RekapHarian {self.day} {self.fuel_type}/{self.load_category}/{self.jenis}>'
+
+class AkumulatorEmisi(db.Model):
+    """Running count, sums and sums of squares of readings per vehicle category"""
+    __tablename__ = 'akumulator_emisi'
+    fuel_type = db.Column(db.String(10), primary_key=True)
+    load_category = db.Column(db.String(20), primary_key=True)
+    
+    # Number of valid results
+    count = db.Column(db.Integer, nullable=False, default=0)
+    
+    sum_co = db.Column(db.Float, nullable=False, default=0)
+    sum_co2 = db.Column(db.Float, nullable=False, default=0)
+    sum_hc = db.Column(db.Float, nullable=False, default=0)
+    sum_o2 = db.Column(db.Float, nullable=False, default=0)
+    sum_lambda_val = db.Column(db.Float, nullable=False, default=0)
+    sum_opacity = db.Column(db.Float, nullable=False, default=0)
+    
+    # Sums of squares, for standard deviations
+    sumsq_co = db.Column(db.Float, nullable=False, default=0)
+    sumsq_co2 = db.Column(db.Float, nullable=False, default=0)
+    sumsq_hc = db.Column(db.Float, nullable=False, default=0)
+    sumsq_o2 = db.Column(db.Float, nullable=False, default=0)
+    sumsq_lambda_val = db.Column(db.Float, nullable=False, default=0)
+    sumsq_opacity = db.Column(db.Float, nullable=False, default=0)
+    
+    def __repr__(self):
+        return f'<AkumulatorEmisi {self.fuel_type}/{self.load_category}>'
+
+class ChangeLog(db.Model):
+    """Inserts, updates and deletes of kendaraan and hasil_uji, written by triggers"""
+    __tablename__ = 'change_log'
+    __table_args__ = (
+        CheckConstraint("operation IN ('insert', 'update', 'delete')", name='ck_change_log_operation'),
+        db.Index('ix_change_log_row', 'table_name', 'row_id', 'id'),
+        # Ids are never reused, so a consumer's cursor stays meaningful after compaction
+        {'sqlite_autoincrement': True},
+    )
+    id = db.Column(db.Integer, primary_key=True)
+    table_name = db.Column(db.String(30), nullable=False)
+    row_id = db.Column(db.Integer, nullable=False)
+    operation = db.Column(db.String(10), nullable=False)
+    
+    # JSON snapshot of the row after the change (before it, for deletes)
+    data = db.Column(db.Text, nullable=True)
+    changed_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow, index=True)
+    
+    def __repr__(self):
+        return f'<ChangeLog id={self.id} {self.operation} {self.table_name}/{self.row_id}>'
+
+class ChangeLogCompaction(db.Model):
+    """One compaction run over change_log"""
+    __tablename__ = 'change_log_compactions'
+    id = db.Column(db.Integer, primary_key=True)
+    ran_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+    
+    # Superseded entries removed, and delete entries dropped after retention
+    collapsed = db.Column(db.Integer, nullable=False, default=0)
+    purged = db.Column(db.Integer, nullable=False, default=0)
+    
+    # Highest change id whose delete entry was dropped; older cursors must resync
+    purged_through = db.Column(db.Integer, nullable=False, default=0)
+    
+    def __repr__(self):
+        return f'<ChangeLogCompaction id={self.id} ran_at={self.ran_at}>'
+
+class ChangeLogBulk(db.Model):
+    """Tables whose row triggers are paused by a bulk insert in the writing transaction"""
+    __tablename__ = 'change_log_bulk'
+    table_name = db.Column(db.String(30), primary_key=True)
+    
+    def __repr__(self):
+        return f'<ChangeLogBulk {self.table_name}>'
+
+class MerekKendaraan(db.Model):
+    """Distinct kendaraan.merek values with the number of vehicles using each"""
+    __tablename__ = 'merek_kendaraan'
+    merek = db.Column(db.String(50), primary_key=True)
+    jumlah = db.Column(db.Integer, nullable=False, default=0)
+    
+    def __repr__(self):
+        return f'<MerekKendaraan {self.merek} ({self.jumlah})>'
+
+class TipeKendaraan(db.Model):
+    """Distinct (merek, tipe) pairs of kendaraan with the number of vehicles using each"""
+    __tablename__ = 'tipe_kendaraan'
+    merek = db.Column(db.String(50), primary_key=True)
+    tipe = db.Column(db.String(50), primary_key=True)
+    jumlah = db.Column(db.Integer, nullable=False, default=0)
+    
+    def __repr__(self):
+        return f'<TipeKendaraan {self.merek}/{self.tipe} ({self.jumlah})>'
@@ -0,0 +1,127 @@
+"""Keyset (seek) pagination with opaque cursors.
+
+A page is fetched with a WHERE clause that starts just past the last row the
+client saw, in the listing's sort order, so deep pages cost the same as the
+first one and nothing is counted. The sort key of the boundary row travels
+between requests as a URL-safe cursor string.
+"""
+import base64
+import json
+from datetime import datetime
+
+from sqlalchemy import and_, false, or_
+
+# Upper bound on rows returned by one page
+MAX_PER_PAGE = 100
+
+
+class Page:
+    """Rows of one page plus the cursors of its neighbours (None at the ends)"""
+
+    def __init__(self, items, next_cursor=None, prev_cursor=None):
+        self.items = items
+        self.next_cursor = next_cursor
+        self.prev_cursor = prev_cursor
+
+    @property
+    def has_next(self):
+        return self.next_cursor is not None
+
+    @property
+    def has_prev(self):
+        return self.prev_cursor is not None
+
+
+def _dump(value):
+    if isinstance(value, datetime):
+        return {'dt': value.isoformat()}
+    return value
+
+
+def _load(value):
+    if isinstance(value, dict):
+        return datetime.fromisoformat(value['dt'])
+    return value
+
+
+def encode_cursor(values, backward=False):
+    """Opaque cursor for a sort key; backward cursors fetch the rows before it"""
+    payload = {'k': [_dump(v) for v in values]}
+    if backward:
+        payload['b'] = 1
+    raw = json.dumps(payload, separators=(',', ':')).encode()
+    return base64.urlsafe_b64encode(raw).decode().rstrip('=')
+
+
+def decode_cursor(cursor, size):
+    """Return (values, backward) for a cursor; raises ValueError if malformed"""
+    try:
+        raw = base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4))
+        payload = json.loads(raw)
+        values = [_load(v) for v in payload['k']]
+    except (TypeError, ValueError, KeyError, AttributeError):
+        raise ValueError('Invalid cursor')
+    if len(values) != size:
+        raise ValueError('Invalid cursor')
+    return values, bool(payload.get('b'))
+
+
+def parse_per_page(value, default=20):
+    """Clamp a requested page size to 1..MAX_PER_PAGE"""
+    if value is None:
+        return default
+    return max(1, min(value, MAX_PER_PAGE))
+
+
+def _beyond(column, value, descending):
+    """Rows strictly past value in the column's sort order (NULLs sort lowest)"""
+    if value is None:
+        return false() if descending else column.isnot(None)
+    if descending:
+        return or_(column < value, column.is_(None))
+    return column > value
+
+
+def _equal(column, value):
+    return column.is_(None) if value is None else column == value
+
+
+def _seek(columns, values, descending):
+    """Rows after the key ``values`` in (columns) order, compared lexicographically"""
+    clauses = []
+    for i, (column, value) in enumerate(zip(columns, values)):
+        prefix = [_equal(c, v) for c, v in zip(columns[:i], values[:i])]
+        clauses.append(and_(*prefix, _beyond(column, value, descending)))
+    return or_(*clauses)
+
+
+def seek(query, columns, key, cursor=None, per_page=20, descending=False):
+    """Fetch one page of query ordered by columns.
+
+    ``key`` maps a result row to its values for ``columns``, which together
+    must be unique. ``cursor`` is a value from a previous Page, or None for
+    the first page. Raises ValueError for a malformed cursor.
+    """
+    backward = False
+    if cursor:
+        values, backward = decode_cursor(cursor, len(columns))
+        # Going back means seeking the other way and flipping the rows
+        query = query.filter(_seek(columns, values, descending != backward))
+
+    ascending = descending == backward
+    query = query.order_by(*[c.asc() if ascending else c.desc() for c in columns])
+    rows = query.limit(per_page + 1).all()
+    more = len(rows) > per_page
+    rows = rows[:per_page]
+    if backward:
+        rows.reverse()
+    if not rows:
+        return Page([])
+
+    has_next = True if backward else more
+    has_prev = more if backward else bool(cursor)
+    return Page(
+        rows,
+        next_cursor=encode_cursor(key(rows[-1])) if has_next else None,
+        prev_cursor=encode_cursor(key(rows[0]), backward=True) if has_prev else None
+    )
@@ -0,0 +1,295 @@
+"""Plate keys and the per-worker plate prefix index.
+
+kendaraan.plat_key holds normalize_plate(plat_nomor) under a unique index,
+so every lookup is an exact index probe whatever spacing or case the plate
+was typed with. backfill_keys() fills it for existing rows; plates that only
+differ in spelling keep their key on the oldest registration and the rest
+stay NULL until merged into it:
+
+    python plates.py merge-duplicates
+
+PlateIndex keeps every registered plate in memory, keyed by its normalized
+form, for typeahead lookups that never touch the database. The bulk of the
+entries lives in one sorted string blob with an array of offsets (a few
+bytes per plate instead of a Python object each); recent changes sit in a
+small sorted delta plus a set of removed positions, and are merged into a
+new blob once they pile up.
+
+The index follows kendaraan through change_log: at most every
+REFRESH_SECONDS, or right after this worker commits a vehicle write, it
+applies the new kendaraan entries. If it has fallen too far behind, or
+compaction dropped entries it had not seen, it reloads.
+"""
+import bisect
+import json
+import sys
+import threading
+import time
+from array import array
+
+from sqlalchemy import text
+
+import caching
+import changelog
+from extensions import db
+from models import ChangeLog, HasilUji, Kendaraan, SesiUji, normalize_plate
+
+# Seconds between change_log polls
+REFRESH_SECONDS = 1.0
+
+# Pending changes above which the index reloads instead of catching up
+MAX_CATCH_UP = 5000
+
+# Delta entries plus removals that trigger a merge into the blob
+MERGE_AT = 10000
+
+DEFAULT_SUGGESTIONS = 10
+MAX_SUGGESTIONS = 50
+
+
+
+def backfill_keys():
+    """Fill plat_key where it is missing; returns the plates left without one.
+
+    A plate whose key is already taken keeps NULL until merge_duplicates()
+    folds it into the holder. The caller commits.
+    """
+    rows = db.session.execute(text('SELECT id, plat_nomor FROM kendaraan WHERE plat_key IS NULL ORDER BY id')).all()
+    if not rows:
+        return []
+    taken = {key for key, in db.session.execute(text('SELECT plat_key FROM kendaraan WHERE plat_key IS NOT NULL'))}
+    updates, duplicates = [], []
+    for row_id, plat in rows:
+        key = normalize_plate(plat)
+        if key in taken:
+            duplicates.append(plat)
+            continue
+        taken.add(key)
+        updates.append({'key': key, 'row_id': row_id})
+    if updates:
+        db.session.execute(text('UPDATE kendaraan SET plat_key = :key WHERE id = :row_id'), updates)
+    return duplicates
+
+
+def merge_duplicates():
+    """Fold every vehicle without a plat_key into the one holding its key.
+
+    Results and test sessions move to the holder, whose latest result and
+    rollups are brought up to date, and the duplicate row is deleted.
+    Returns (merged plate, kept plate) pairs; the caller commits.
+    """
+    import rollups
+    from blueprints.tests import refresh_latest_results
+
+    merged = []
+    for duplicate in Kendaraan.query.filter(Kendaraan.plat_key.is_(None)).order_by(Kendaraan.id).all():
+        key = normalize_plate(duplicate.plat_nomor)
+        keeper = Kendaraan.query.filter_by(plat_key=key).first()
+        if keeper is None:
+            duplicate.plat_key = key
+            db.session.flush()
+            continue
+        hasil_ids = [row_id for row_id, in db.session.query(HasilUji.id).filter_by(kendaraan_id=duplicate.id)]
+        # Rollups are keyed by vehicle attributes, so re-add under the keeper's
+        rollups.apply_results(hasil_ids, -1)
+        HasilUji.query.filter_by(kendaraan_id=duplicate.id).update(
+            {'kendaraan_id': keeper.id}, synchronize_session=False
+        )
+        SesiUji.query.filter_by(kendaraan_id=duplicate.id).update(
+            {'kendaraan_id': keeper.id}, synchronize_session=False
+        )
+        rollups.apply_results(hasil_ids, 1)
+        db.session.expunge(duplicate)
+        Kendaraan.query.filter_by(id=duplicate.id).delete(synchronize_session=False)
+        refresh_latest_results([keeper.id])
+        merged.append((duplicate.plat_nomor, keeper.plat_nomor))
+    return merged
+
+
+class _Keys:
+    """Sequence view of the normalized keys in a blob, for bisect"""
+
+    def __init__(self, blob, offsets):
+        self.blob = blob
+        self.offsets = offsets
+
+    def __len__(self):
+        return len(self.offsets) - 1
+
+    def __getitem__(self, i):
+        entry = self.blob[self.offsets[i]:self.offsets[i + 1] - 1]
+        return entry[:entry.index('\0')]
+
+
+class _Ids:
+    """Sequence view of entry ids in id order, for bisect"""
+
+    def __init__(self, ids, by_id):
+        self.ids = ids
+        self.by_id = by_id
+
+    def __len__(self):
+        return len(self.by_id)
+
+    def __getitem__(self, i):
+        return self.ids[self.by_id[i]]
+
+
+class PlateIndex:
+    """Sorted in-memory index of (normalized plate, plate, id)"""
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._loaded = False
+        self._stale = True
+        self._cursor = 0
+        self._checked_at = 0.0
+        self._build([])
+        # Refresh as soon as this worker commits a vehicle write
+        caching.subscribe(self, ['kendaraan'])
+
+    def clear(self):
+        self._stale = True
+
+    def _build(self, entries):
+        """Replace the blob with entries, a list of 'key\\0plat\\0id' strings.
+
+        NUL sorts first, so string order is (key, plat) order.
+        """
+        entries.sort()
+        offsets = array('I', [0])
+        ids = array('I')
+        parts = []
+        position = 0
+        for entry in entries:
+            end = entry.rindex('\0')
+            parts.append(entry[:end + 1])
+            ids.append(int(entry[end + 1:]))
+            position += end + 1
+            offsets.append(position)
+        self._blob = ''.join(parts)
+        self._offsets = offsets
+        self._ids = ids
+        self._by_id = array('I', sorted(range(len(ids)), key=ids.__getitem__))
+        self._keys = _Keys(self._blob, offsets)
+        self._removed = set()
+        self._delta = []
+        self._delta_ids = {}
+
+    def _entry(self, i):
+        key, plat = self._blob[self._offsets[i]:self._offsets[i + 1] - 1].split('\0')
+        return key, plat, self._ids[i]
+
+    def _entries(self):
+        """Every live entry, blob and delta, in _build's format"""
+        entries = [
+            f'{self._blob[self._offsets[i]:self._offsets[i + 1]]}{self._ids[i]}'
+            for i in range(len(self._ids)) if i not in self._removed
+        ]
+        entries.extend(f'{key}\0{plat}\0{row_id}' for key, plat, row_id in self._delta)
+        return entries
+
+    def _remove(self, row_id):
+        entry = self._delta_ids.pop(row_id, None)
+        if entry:
+            self._delta.remove(entry)
+            return
+        view = _Ids(self._ids, self._by_id)
+        i = bisect.bisect_left(view, row_id)
+        if i < len(view) and view[i] == row_id:
+            self._removed.add(self._by_id[i])
+
+    def _add(self, plat, row_id):
+        entry = (normalize_plate(plat), plat, row_id)
+        bisect.insort(self._delta, entry)
+        self._delta_ids[row_id] = entry
+
+    def _reload(self):
+        # One read transaction, so the cursor matches the rows read
+        cursor = changelog.head()
+        rows = db.session.execute(text('SELECT id, plat_nomor FROM kendaraan'))
+        entries = [f'{normalize_plate(plat)}\0{plat}\0{row_id}' for row_id, plat in rows]
+        db.session.commit()
+        self._build(entries)
+        self._cursor = cursor
+
+    def _catch_up(self):
+        """Apply new kendaraan changes; returns False if a reload is needed"""
+        if changelog.horizon() > self._cursor:
+            return False
+        changes = db.session.query(
+            ChangeLog.id, ChangeLog.row_id, ChangeLog.operation, ChangeLog.data
+        ).filter(
+            ChangeLog.id > self._cursor,
+            ChangeLog.table_name == 'kendaraan'
+        ).order_by(ChangeLog.id).limit(MAX_CATCH_UP + 1).all()
+        db.session.commit()
+        if len(changes) > MAX_CATCH_UP:
+            return False
+        for change_id, row_id, operation, data in changes:
+            self._remove(row_id)
+            if operation != 'delete':
+                self._add(json.loads(data)['plat_nomor'], row_id)
+            self._cursor = change_id
+        if len(self._delta) + len(self._removed) > MERGE_AT:
+            self._build(self._entries())
+        return True
+
+    def refresh(self, force=False):
+        """Bring the index up to date if it may be behind"""
+        now = time.monotonic()
+        if not force and self._loaded and not self._stale and now - self._checked_at < REFRESH_SECONDS:
+            return
+        with self._lock:
+            self._stale = False
+            self._checked_at = now
+            if not self._loaded or not self._catch_up():
+                self._reload()
+                self._loaded = True
+
+    def suggest(self, query, limit=DEFAULT_SUGGESTIONS):
+        """Up to ``limit`` plates whose normalized form starts with the query's"""
+        prefix = normalize_plate(query)
+        if not prefix:
+            return []
+        self.refresh()
+        with self._lock:
+            matches = []
+            i = bisect.bisect_left(self._keys, prefix)
+            while i < len(self._keys) and len(matches) < limit:
+                key, plat, row_id = self._entry(i)
+                if not key.startswith(prefix):
+                    break
+                if i not in self._removed:
+                    matches.append((key, plat, row_id))
+                i += 1
+            j = bisect.bisect_left(self._delta, (prefix,))
+            for entry in self._delta[j:j + limit]:
+                if not entry[0].startswith(prefix):
+                    break
+                matches.append(entry)
+        matches.sort()
+        return [plat for _, plat, _ in matches[:limit]]
+
+
+_index = PlateIndex()
+
+
+def suggest(query, limit=DEFAULT_SUGGESTIONS):
+    """Plates starting with query, ignoring case, spaces and punctuation"""
+    return _index.suggest(query, max(1, min(limit, MAX_SUGGESTIONS)))
+
+
+if __name__ == '__main__':
+    from app_init import app
+
+    command = sys.argv[1] if len(sys.argv) > 1 else None
+    with app.app_context():
+        if command == 'merge-duplicates':
+            merged = merge_duplicates()
+            db.session.commit()
+            for plat, kept in merged:
+                print(f"Merged {plat} into {kept}")
+            print(f"Merged {len(merged)} duplicate plates")
+        else:
+            print("Please provide a command: 'merge-duplicates'.")
@@ -0,0 +1,212 @@
+"""Background re-grading of stored test results.
+
+When the limits change, existing hasil_uji rows are graded again against the
+new Config. Rows are walked in primary-key order in small chunks and each
+chunk commits its UPDATEs together with the job's cursor, so test entry never
+waits long on the SQLite write lock and an interrupted job resumes from the
+last committed chunk.
+"""
+import logging
+import time
+from datetime import datetime, timedelta
+
+from sqlalchemy import bindparam, func, select
+from sqlalchemy.exc import OperationalError
+
+import rollups
+from background import spawn
+from evaluate import Thresholds, READING_COLUMNS
+from extensions import db
+from models import Config, HasilUji, Kendaraan, RegradeJob
+
+logger = logging.getLogger(__name__)
+
+CHUNK_SIZE = 1000
+
+# Pause between chunks so interactive writers can take the lock
+PAUSE_SECONDS = 0.05
+
+# An active job that has not reported progress for this long is orphaned
+STALE_SECONDS = 60
+
+# Attempts per chunk when the database is locked by another writer
+MAX_RETRIES = 5
+
+ACTIVE_STATUSES = ('pending', 'running')
+
+
+def start_regrade(app, user_id=None):
+    """Supersede any active job and re-grade every stored result"""
+    now = datetime.utcnow()
+    RegradeJob.query.filter(RegradeJob.status.in_(ACTIVE_STATUSES)).update(
+        {'status': 'superseded', 'finished_at': now}, synchronize_session=False
+    )
+    max_id, total = db.session.query(func.max(HasilUji.id), func.count(HasilUji.id)).one()
+    job = RegradeJob(status='pending', user_id=user_id, max_id=max_id or 0, total=total)
+    db.session.add(job)
+    db.session.commit()
+    spawn(app, _run, job.id, name=f'regrade-{job.id}')
+    return job
+
+
+def resume_regrade(app):
+    """Restart an active job whose worker stopped, if there is one"""
+    cutoff = datetime.utcnow() - timedelta(seconds=STALE_SECONDS)
+    job = RegradeJob.query.filter(
+        RegradeJob.status.in_(ACTIVE_STATUSES),
+        RegradeJob.updated_at < cutoff
+    ).order_by(RegradeJob.id.desc()).first()
+    if job:
+        logger.info(f"Resuming regrade job {job.id} after row {job.last_id}")
+        spawn(app, _run, job.id, name=f'regrade-{job.id}')
+    return job
+
+
+def latest_job():
+    return RegradeJob.query.order_by(RegradeJob.id.desc()).first()
+
+
+def job_progress(job):
+    """Serialize a job with its completion percentage and ETA"""
+    percent = 100.0
+    if job.total:
+        percent = min(100.0, job.processed / job.total * 100)
+
+    eta_seconds = None
+    if job.status == 'running' and job.run_started_at and job.updated_at:
+        elapsed = (job.updated_at - job.run_started_at).total_seconds()
+        done = job.processed - job.run_processed
+        if done > 0 and elapsed > 0:
+            remaining = max(job.total - job.processed, 0)
+            eta_seconds = round(remaining / (done / elapsed))
+
+    return {
+        'id': job.id,
+        'status': job.status,
+        'total': job.total,
+        'processed': job.processed,
+        'changed': job.changed,
+        'percent': round(percent, 1),
+        'eta_seconds': eta_seconds,
+        'last_id': job.last_id,
+        'error': job.error,
+        'created_at': job.created_at.isoformat() if job.created_at else None,
+        'updated_at': job.updated_at.isoformat() if job.updated_at else None,
+        'finished_at': job.finished_at.isoformat() if job.finished_at else None
+    }
+
+
+def _claim(job_id):
+    """Mark the job running unless another worker holds it"""
+    table = RegradeJob.__table__
+    now = datetime.utcnow()
+    cutoff = now - timedelta(seconds=STALE_SECONDS)
+    claimed = db.session.execute(
+        table.update().where(
+            table.c.id == job_id,
+            (table.c.status == 'pending') |
+            ((table.c.status == 'running') & (table.c.updated_at < cutoff))
+        ).values(
+            status='running',
+            run_started_at=now,
+            run_processed=table.c.processed,
+            updated_at=now
+        )
+    ).rowcount
+    db.session.commit()
+    return claimed == 1
+
+
+def _chunk_query(after_id, max_id):
+    hasil = HasilUji.__table__
+    kendaraan = Kendaraan.__table__
+    return select(
+        hasil.c.id, hasil.c.lulus,
+        *[hasil.c[name] for name in READING_COLUMNS],
+        kendaraan.c.tahun, kendaraan.c.fuel_type, kendaraan.c.load_category
+    ).select_from(
+        hasil.join(kendaraan, hasil.c.kendaraan_id == kendaraan.c.id)
+    ).where(
+        hasil.c.id > after_id,
+        hasil.c.id <= max_id
+    ).order_by(hasil.c.id).limit(CHUNK_SIZE)
+
+
+def _regrade_chunk(job, thresholds):
+    """Grade and write one chunk; returns False once the job has no rows left"""
+    rows = db.session.execute(_chunk_query(job.last_id, job.max_id)).all()
+    if not rows:
+        return False
+
+    graded = thresholds.evaluate_batch(
+        tahun=[r.tahun for r in rows],
+        fuel_type=[r.fuel_type for r in rows],
+        load_category=[r.load_category for r in rows],
+        **{name: [getattr(r, name) for r in rows] for name in READING_COLUMNS}
+    )
+    changes = [
+        {'hasil_id': row.id, 'lulus': bool(lulus)}
+        for row, lulus in zip(rows, graded.lulus)
+        if bool(lulus) != row.lulus
+    ]
+    if changes:
+        changed_ids = [change['hasil_id'] for change in changes]
+        rollups.apply_results(changed_ids, -1)
+        table = HasilUji.__table__
+        db.session.execute(
+            table.update().where(table.c.id == bindparam('hasil_id')),
+            changes
+        )
+        rollups.apply_results(changed_ids)
+
+    job.last_id = rows[-1].id
+    job.processed += len(rows)
+    job.changed += len(changes)
+    return True
+
+
+def _run(job_id):
+    if not _claim(job_id):
+        return
+
+    thresholds = Thresholds.from_config(Config.get_config())
+    db.session.commit()
+    retries = 0
+    while True:
+        job = RegradeJob.query.get(job_id)
+        if job.status != 'running':
+            db.session.rollback()
+            return
+        try:
+            more = _regrade_chunk(job, thresholds)
+            db.session.flush()
+
+            # Once the chunk is flushed this transaction holds the write lock,
+            # so a new job cannot supersede this one between here and commit
+            status = db.session.query(RegradeJob.status).filter_by(id=job_id).scalar()
+            if status != 'running':
+                db.session.rollback()
+                return
+            if not more:
+                job.status = 'completed'
+                job.finished_at = datetime.utcnow()
+            db.session.commit()
+            retries = 0
+        except OperationalError as e:
+            db.session.rollback()
+            retries += 1
+            if retries > MAX_RETRIES:
+                RegradeJob.query.filter_by(id=job_id).update(
+                    {'status': 'failed', 'error': str(e), 'finished_at': datetime.utcnow()},
+                    synchronize_session=False
+                )
+                db.session.commit()
+                logger.error(f"Regrade job {job_id} failed: {str(e)}")
+                return
+            time.sleep(PAUSE_SECONDS * 2 ** retries)
+            continue
+
+        if not more:
+            logger.info(f"Regrade job {job_id} completed: {job.processed} rows, {job.changed} changed")
+            return
+        time.sleep(PAUSE_SECONDS)
@@ -0,0 +1,312 @@
+"""Rollups of test results.
+
+rekap_harian holds counts and reading sums per (day, fuel_type,
+load_category, jenis), and akumulator_emisi holds counts, sums and sums of
+squares per (fuel_type, load_category). Every write to hasil_uji applies its
+delta to both in the same transaction, so charts and averages read a handful
+of rows instead of scanning the full history. Both tables can be rebuilt
+from hasil_uji at any time:
+
+    python rollups.py rebuild
+    python rollups.py verify
+"""
+import math
+import sys
+
+from sqlalchemy import case, func, select
+from sqlalchemy.dialects.sqlite import insert as sqlite_insert
+
+from evaluate import READING_COLUMNS
+from extensions import db
+from models import AkumulatorEmisi, HasilUji, Kendaraan, RekapHarian
+
+KEY_COLUMNS = ('day', 'fuel_type', 'load_category', 'jenis')
+SUM_COLUMNS = tuple(f'sum_{name}' for name in READING_COLUMNS)
+MEASURES = ('tested', 'passed', 'failed') + SUM_COLUMNS
+
+ACCUMULATOR_KEY = ('fuel_type', 'load_category')
+SQUARE_COLUMNS = tuple(f'sumsq_{name}' for name in READING_COLUMNS)
+ACCUMULATOR_MEASURES = ('count',) + SUM_COLUMNS + SQUARE_COLUMNS
+
+GRANULARITIES = ('day', 'week', 'month', 'year')
+DIMENSIONS = ('fuel_type', 'load_category', 'jenis')
+
+# Keeps IN (...) lists under SQLite's bound-parameter limit
+IN_CHUNK = 500
+
+
+def _upsert(table, key_columns, measures, deltas, count_column):
+    """Add per-key deltas to a rollup table, dropping rows that reach zero"""
+    if not deltas:
+        return
+    stmt = sqlite_insert(table)
+    stmt = stmt.on_conflict_do_update(
+        index_elements=key_columns,
+        set_={name: table.c[name] + stmt.excluded[name] for name in measures}
+    )
+    db.session.execute(stmt, [
+        dict(zip(key_columns, key), **delta) for key, delta in deltas.items()
+    ])
+    if any(delta[count_column] < 0 for delta in deltas.values()):
+        db.session.execute(table.delete().where(table.c[count_column] <= 0))
+
+
+def apply_rows(rows, sign=1):
+    """Add (sign=1) or remove (sign=-1) result rows from the rollups.
+
+    Each row is a mapping with tanggal, valid, lulus, the READING_COLUMNS
+    and the vehicle's fuel_type, load_category and jenis. The caller commits.
+    """
+    daily = {}
+    accumulators = {}
+    for row in rows:
+        if not row['valid'] or row['tanggal'] is None:
+            continue
+        key = (row['tanggal'].date(), row['fuel_type'], row['load_category'], row['jenis'])
+        delta = daily.get(key)
+        if delta is None:
+            delta = daily[key] = dict.fromkeys(MEASURES, 0)
+        key = (row['fuel_type'], row['load_category'])
+        accumulator = accumulators.get(key)
+        if accumulator is None:
+            accumulator = accumulators[key] = dict.fromkeys(ACCUMULATOR_MEASURES, 0)
+
+        delta['tested'] += sign
+        delta['passed' if row['lulus'] else 'failed'] += sign
+        accumulator['count'] += sign
+        for name in READING_COLUMNS:
+            value = row[name] or 0
+            delta[f'sum_{name}'] += sign * value
+            accumulator[f'sum_{name}'] += sign * value
+            accumulator[f'sumsq_{name}'] += sign * value * value
+
+    _upsert(RekapHarian.__table__, KEY_COLUMNS, MEASURES, daily, 'tested')
+    _upsert(AkumulatorEmisi.__table__, ACCUMULATOR_KEY, ACCUMULATOR_MEASURES, accumulators, 'count')
+
+
+def _result_rows(condition, key=None):
+    """Result rows matching a condition, with their vehicle's rollup key.
+
+    ``key`` overrides the vehicle columns with (fuel_type, load_category,
+    jenis), for when the vehicle row is being changed in the same flush.
+    """
+    hasil = HasilUji.__table__
+    kendaraan = Kendaraan.__table__
+    columns = [hasil.c.tanggal, hasil.c.valid, hasil.c.lulus] + [hasil.c[name] for name in READING_COLUMNS]
+    if key is None:
+        query = select(*columns, kendaraan.c.fuel_type, kendaraan.c.load_category, kendaraan.c.jenis).select_from(
+            hasil.join(kendaraan, hasil.c.kendaraan_id == kendaraan.c.id)
+        )
+    else:
+        query = select(*columns)
+    rows = [dict(row._mapping) for row in db.session.execute(query.where(condition))]
+    if key is not None:
+        for row in rows:
+            row.update(zip(DIMENSIONS, key))
+    return rows
+
+
+def apply_results(hasil_ids, sign=1):
+    """Add or remove stored results by id"""
+    hasil_ids = list(hasil_ids)
+    for i in range(0, len(hasil_ids), IN_CHUNK):
+        apply_rows(_result_rows(HasilUji.__table__.c.id.in_(hasil_ids[i:i + IN_CHUNK])), sign)
+
+
+def apply_vehicle(kendaraan_id, sign=1, key=None):
+    """Add or remove every stored result of a vehicle"""
+    apply_rows(_result_rows(HasilUji.__table__.c.kendaraan_id == kendaraan_id, key), sign)
+
+
+def _aggregate_query():
+    hasil = HasilUji.__table__
+    kendaraan = Kendaraan.__table__
+    day = func.date(hasil.c.tanggal)
+    return select(
+        day.label('day'),
+        kendaraan.c.fuel_type,
+        kendaraan.c.load_category,
+        kendaraan.c.jenis,
+        func.count().label('tested'),
+        func.sum(case((hasil.c.lulus == True, 1), else_=0)).label('passed'),
+        func.sum(case((hasil.c.lulus == True, 0), else_=1)).label('failed'),
+        *[func.coalesce(func.sum(hasil.c[name]), 0).label(f'sum_{name}') for name in READING_COLUMNS]
+    ).select_from(
+        hasil.join(kendaraan, hasil.c.kendaraan_id == kendaraan.c.id)
+    ).where(
+        hasil.c.valid == True,
+        hasil.c.tanggal.isnot(None)
+    ).group_by(day, kendaraan.c.fuel_type, kendaraan.c.load_category, kendaraan.c.jenis)
+
+
+def _accumulator_query():
+    hasil = HasilUji.__table__
+    kendaraan = Kendaraan.__table__
+    return select(
+        kendaraan.c.fuel_type,
+        kendaraan.c.load_category,
+        func.count().label('count'),
+        *[func.coalesce(func.sum(hasil.c[name]), 0).label(f'sum_{name}') for name in READING_COLUMNS],
+        *[func.coalesce(func.sum(hasil.c[name] * hasil.c[name]), 0).label(f'sumsq_{name}') for name in READING_COLUMNS]
+    ).select_from(
+        hasil.join(kendaraan, hasil.c.kendaraan_id == kendaraan.c.id)
+    ).where(
+        hasil.c.valid == True,
+        hasil.c.tanggal.isnot(None)
+    ).group_by(kendaraan.c.fuel_type, kendaraan.c.load_category)
+
+
+def _rollup_tables():
+    """(table, key columns, measures, full recomputation) of each rollup"""
+    return (
+        (RekapHarian.__table__, KEY_COLUMNS, MEASURES, _aggregate_query()),
+        (AkumulatorEmisi.__table__, ACCUMULATOR_KEY, ACCUMULATOR_MEASURES, _accumulator_query()),
+    )
+
+
+def rebuild():
+    """Recompute every rollup table from hasil_uji; the caller commits.
+
+    Returns the number of rows written per table.
+    """
+    counts = {}
+    for table, keys, measures, query in _rollup_tables():
+        db.session.execute(table.delete())
+        db.session.execute(table.insert().from_select(keys + measures, query))
+        counts[table.name] = db.session.query(func.count()).select_from(table).scalar()
+    return counts
+
+
+def verify(rel_tol=1e-9, abs_tol=1e-6):
+    """Compare the rollups against hasil_uji; returns (table, key) mismatches"""
+    mismatches = []
+    for table, keys, measures, query in _rollup_tables():
+        expected = {
+            tuple(str(row[k]) for k in keys): row
+            for row in (r._mapping for r in db.session.execute(query))
+        }
+        actual = {
+            tuple(str(row[k]) for k in keys): row
+            for row in (r._mapping for r in db.session.execute(select(table)))
+        }
+        for key in sorted(set(expected) | set(actual)):
+            want, have = expected.get(key), actual.get(key)
+            if want is None or have is None or not all(
+                math.isclose(want[name] or 0, have[name] or 0, rel_tol=rel_tol, abs_tol=abs_tol)
+                for name in measures
+            ):
+                mismatches.append((table.name, key))
+    return mismatches
+
+
+def category_statistics():
+    """Count, mean and sample standard deviation of each reading per
+    (fuel_type, load_category), read from the accumulators"""
+    results = []
+    for row in AkumulatorEmisi.query.order_by(AkumulatorEmisi.fuel_type, AkumulatorEmisi.load_category):
+        stats = {'fuel_type': row.fuel_type, 'load_category': row.load_category, 'count': row.count}
+        for name in READING_COLUMNS:
+            total = getattr(row, f'sum_{name}')
+            squares = getattr(row, f'sumsq_{name}')
+            mean = total / row.count if row.count else None
+            std = None
+            if row.count > 1:
+                std = math.sqrt(max(squares - total * total / row.count, 0) / (row.count - 1))
+            stats[name] = {'mean': mean, 'std': std}
+        results.append(stats)
+    return results
+
+
+def _period(granularity):
+    day = RekapHarian.day
+    if granularity == 'week':
+        # Monday of the ISO week
+        return func.date(day, 'weekday 0', '-6 days')
+    if granularity == 'month':
+        return func.strftime('%Y-%m', day)
+    if granularity == 'year':
+        return func.strftime('%Y', day)
+    return func.date(day)
+
+
+def _average(total, count):
+    return round(total / count, 3) if count else None
+
+
+def series(granularity='month', start=None, end=None, filters=None, group_by=None):
+    """Counts and average readings per period from the rollup table.
+
+    ``start`` and ``end`` are inclusive dates, ``filters`` maps DIMENSIONS to
+    required values and ``group_by`` splits each period by one dimension.
+    """
+    if granularity not in GRANULARITIES:
+        raise ValueError(f'granularity must be one of: {", ".join(GRANULARITIES)}')
+    if group_by is not None and group_by not in DIMENSIONS:
+        raise ValueError(f'group_by must be one of: {", ".join(DIMENSIONS)}')
+
+    period = _period(granularity).label('period')
+    bensin = RekapHarian.fuel_type == 'bensin'
+    columns = [
+        period,
+        func.sum(RekapHarian.tested).label('tested'),
+        func.sum(RekapHarian.passed).label('passed'),
+        func.sum(RekapHarian.failed).label('failed'),
+        func.sum(case((bensin, RekapHarian.tested), else_=0)).label('bensin_tested'),
+        func.sum(case((bensin, 0), else_=RekapHarian.tested)).label('solar_tested'),
+        *[func.sum(getattr(RekapHarian, name)).label(name) for name in SUM_COLUMNS]
+    ]
+    groups = [period]
+    if group_by:
+        columns.insert(1, getattr(RekapHarian, group_by))
+        groups.append(getattr(RekapHarian, group_by))
+
+    query = db.session.query(*columns)
+    if start:
+        query = query.filter(RekapHarian.day >= start)
+    if end:
+        query = query.filter(RekapHarian.day <= end)
+    for name, value in (filters or {}).items():
+        if value:
+            query = query.filter(getattr(RekapHarian, name) == value)
+    rows = query.group_by(*groups).order_by(*groups).all()
+
+    points = []
+    for row in rows:
+        point = {
+            'period': row.period,
+            'tested': row.tested,
+            'passed': row.passed,
+            'failed': row.failed,
+            'pass_rate': round(row.passed / row.tested * 100, 1) if row.tested else 0,
+            'avg_co': _average(row.sum_co, row.bensin_tested),
+            'avg_co2': _average(row.sum_co2, row.bensin_tested),
+            'avg_hc': _average(row.sum_hc, row.bensin_tested),
+            'avg_o2': _average(row.sum_o2, row.bensin_tested),
+            'avg_lambda': _average(row.sum_lambda_val, row.bensin_tested),
+            'avg_opacity': _average(row.sum_opacity, row.solar_tested)
+        }
+        if group_by:
+            point[group_by] = getattr(row, group_by)
+        points.append(point)
+    return points
+
+
+if __name__ == '__main__':
+    from app_init import app
+
+    command = sys.argv[1] if len(sys.argv) > 1 else None
+    with app.app_context():
+        if command == 'rebuild':
+            for table, _, _, _ in _rollup_tables():
+                table.create(db.engine, checkfirst=True)
+            for name, rows in rebuild().items():
+                print(f"Rebuilt {name}: {rows} rows")
+            db.session.commit()
+        elif command == 'verify':
+            mismatches = verify()
+            for name, key in mismatches:
+                print(f"Mismatch in {name}: {' / '.join(key)}")
+            print(f"{len(mismatches)} mismatching rows")
+            sys.exit(1 if mismatches else 0)
+        else:
+            print("Please provide a command: 'rebuild' or 'verify'.")
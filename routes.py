@@ -5,11 +5,17 @@ import csv, tempfile
 from io import BytesIO, StringIO
 from extensions import db
 from models import Kendaraan, HasilUji, Config, User
+import exports
+import dictionaries
+import pagination
 from flask_login import login_user, logout_user, login_required, current_user
 from werkzeug.security import generate_password_hash
 
 routes = Blueprint('routes', __name__)
 
+# Rows fetched per round trip when streaming an export
+EXPORT_FETCH_SIZE = 2000
+
 @routes.route('/login', methods=['GET', 'POST'])
 def login():
     if request.method == 'POST':
@@ -103,7 +109,7 @@ def get_kendaraan_list():
 @login_required
 def get_kendaraan(plat_nomor):
     try:
-        kendaraan = Kendaraan.query.filter_by(plat_nomor=plat_nomor).first()
+        kendaraan = Kendaraan.with_plat(plat_nomor).first()
         if kendaraan:
             return jsonify({
                 'jenis': kendaraan.jenis,
@@ -197,7 +203,7 @@ def tested_plats():
 @routes.route('/api/hasil-uji/<string:plat_nomor>', methods=['GET', 'POST', 'DELETE'])
 @login_required
 def manage_hasil(plat_nomor):
-    kendaraan = Kendaraan.query.filter_by(plat_nomor=plat_nomor).first()
+    kendaraan = Kendaraan.with_plat(plat_nomor).first()
     if not kendaraan:
         return jsonify({'error': 'Kendaraan tidak ditemukan'}), 404
 
@@ -243,7 +249,7 @@ def manage_hasil(plat_nomor):
 def modify_kendaraan(plat_nomor):
     if request.method=='DELETE':
         try:
-            knd=Kendaraan.query.filter_by(plat_nomor=plat_nomor).first_or_404()
+            knd=Kendaraan.with_plat(plat_nomor).first_or_404()
             HasilUji.query.filter_by(kendaraan_id=knd.id).delete()
             db.session.delete(knd); db.session.commit()
             return jsonify({'success':True})
@@ -253,7 +259,7 @@ def modify_kendaraan(plat_nomor):
     # PUT update
     try:
         data=request.json or {}
-        knd=Kendaraan.query.filter_by(plat_nomor=plat_nomor).first_or_404()
+        knd=Kendaraan.with_plat(plat_nomor).first_or_404()
         for attr in ['merek','tipe','tahun','nama_instansi','fuel_type', 'load_category']:
             if attr in data: setattr(knd,attr,data[attr])
         db.session.commit(); return jsonify({'success':True})
@@ -261,60 +267,79 @@ def modify_kendaraan(plat_nomor):
         db.session.rollback(); current_app.logger.error(str(e))
         return jsonify({'error':'Update failed'}),500
 
+def export_row(row):
+    """Format one exported result row"""
+    # Map fuel type to Indonesian
+    fuel_type = 'Solar' if row.fuel_type == 'solar' else 'Bensin'
+    return [
+        row.jenis,
+        row.plat_nomor,
+        row.merek,
+        row.tipe,
+        row.tahun,
+        fuel_type,
+        row.nama_instansi or '-', 
+        row.co,
+        row.co2,
+        row.hc,
+        row.o2,
+        row.lambda_val,
+        f"{row.opacity:.1f}" if row.fuel_type == 'solar' and row.opacity is not None else 'N/A',
+        'Ya' if row.valid else 'Tidak',
+        'Lulus' if row.lulus else 'Tidak Lulus',
+        row.tanggal.strftime('%Y-%m-%d %H:%M:%S') if row.tanggal else '',
+        row.username if row.username else 'Unknown',
+        row.load_category
+    ]
+
 @routes.route('/export-csv')
 @login_required
 def export_csv():
     try:
-        # Query all kendaraan with their hasil uji and user
-        kendaraan_list = db.session.query(Kendaraan, HasilUji, User).join(
+        # Select only the exported columns and stream them in id order, a chunk at a time
+        query = db.session.query(
+            HasilUji.id,
+            Kendaraan.jenis,
+            Kendaraan.plat_nomor,
+            Kendaraan.merek,
+            Kendaraan.tipe,
+            Kendaraan.tahun,
+            Kendaraan.fuel_type,
+            Kendaraan.nama_instansi,
+            HasilUji.co,
+            HasilUji.co2,
+            HasilUji.hc,
+            HasilUji.o2,
+            HasilUji.lambda_val,
+            HasilUji.opacity,
+            HasilUji.valid,
+            HasilUji.lulus,
+            HasilUji.tanggal,
+            User.username,
+            Kendaraan.load_category
+        ).select_from(Kendaraan).join(
             HasilUji, Kendaraan.id == HasilUji.kendaraan_id
         ).join(
             User, HasilUji.user_id == User.id
-        ).all()
-        
-        # Create CSV file
-        output = StringIO()
-        writer = csv.writer(output)
-        
-        # Write header
-        writer.writerow(['Jenis', 'Plat Nomor', 'Merek', 'Tipe', 'Tahun', 'Jenis Bahan Bakar', 'Nama Instansi', 
-                        'CO', 'CO2', 'HC', 'O2', 'Lambda', 'Opasitas (%)', 'Valid', 'Lulus', 'Tanggal', 'Operator', 'Load Category'])
+        )
         
-        # Write data
-        for kendaraan, hasil, user in kendaraan_list:
-            # Map fuel type to Indonesian
-            fuel_type = 'Solar' if kendaraan.fuel_type == 'solar' else 'Bensin'
-            
-            # Format the row data
-            row = [
-                kendaraan.jenis,
-                kendaraan.plat_nomor,
-                kendaraan.merek,
-                kendaraan.tipe,
-                kendaraan.tahun,
-                fuel_type,
-                kendaraan.nama_instansi or '-', 
-                hasil.co,
-                hasil.co2,
-                hasil.hc,
-                hasil.o2,
-                hasil.lambda_val,
-                f"{hasil.opacity:.1f}" if kendaraan.fuel_type == 'solar' and hasil.opacity is not None else 'N/A',
-                'Ya' if hasil.valid else 'Tidak',
-                'Lulus' if hasil.lulus else 'Tidak Lulus',
-                hasil.tanggal.strftime('%Y-%m-%d %H:%M:%S') if hasil.tanggal else '',
-                user.username if user else 'Unknown',
-                kendaraan.load_category
-            ]
-            writer.writerow(row)
+        def chunks():
+            cursor = None
+            while True:
+                page = pagination.seek(
+                    query, [HasilUji.id], key=lambda row: (row.id,),
+                    cursor=cursor, per_page=EXPORT_FETCH_SIZE
+                )
+                yield [export_row(row) for row in page.items]
+                if not page.has_next:
+                    return
+                cursor = page.next_cursor
         
-        # Create response
-        output.seek(0)
-        return send_file(
-            BytesIO(output.getvalue().encode('utf-8')),
-            mimetype='text/csv',
-            as_attachment=True,
-            download_name='data_uji_emisi.csv'
+        header = ['Jenis', 'Plat Nomor', 'Merek', 'Tipe', 'Tahun', 'Jenis Bahan Bakar', 'Nama Instansi', 
+                  'CO', 'CO2', 'HC', 'O2', 'Lambda', 'Opasitas (%)', 'Valid', 'Lulus', 'Tanggal', 'Operator', 'Load Category']
+        return exports.csv_response(
+            header, chunks(), 'data_uji_emisi.csv',
+            compress=request.args.get('gzip') in ('1', 'true')
         )
     except Exception as e:
         current_app.logger.error(f'Error exporting CSV: {str(e)}')
@@ -325,9 +350,7 @@ def export_csv():
 @login_required
 def kendaraan_mereks():
     try:
-        results = db.session.query(Kendaraan.merek).distinct().all()
-        mereks = [r[0] for r in results]
-        return jsonify(mereks)
+        return jsonify(dictionaries.mereks())
     except exc.SQLAlchemyError as e:
         current_app.logger.error(str(e))
         return jsonify([])
@@ -401,9 +424,7 @@ def save_config():
 @login_required
 def kendaraan_tipes():
     try:
-        results = db.session.query(Kendaraan.tipe).distinct().all()
-        tipes = [r[0] for r in results]
-        return jsonify(tipes)
+        return jsonify(dictionaries.tipes(request.args.get('merek', '').strip()))
     except exc.SQLAlchemyError as e:
         current_app.logger.error(str(e))
         return jsonify([])
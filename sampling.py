@@ -0,0 +1,215 @@
+"""Analyzer sample streams for test sessions.
+
+A gas analyzer reports several samples per second while a vehicle is tested.
+Each posted batch is stored as one blob of packed float64 rows and folded into
+running per-channel statistics (Welford's algorithm, merged batch-wise with
+Chan's parallel update), so a session costs one row per batch instead of one
+per sample and its mean/variance never needs the raw samples again.
+"""
+import math
+import threading
+from collections import OrderedDict
+
+import numpy as np
+
+# Channels recorded per fuel type; 't' is seconds since the session opened
+SESSION_CHANNELS = {
+    'bensin': ('t', 'co', 'co2', 'hc', 'o2', 'lambda_val'),
+    'solar': ('t', 'opacity'),
+}
+
+SAMPLE_DTYPE = np.dtype('<f8')
+
+# Upper bound on samples accepted by one request
+MAX_SAMPLES_PER_REQUEST = 10000
+
+# Upper bound on the body of one sample request, checked before it is parsed;
+# several times the size of MAX_SAMPLES_PER_REQUEST samples of every channel
+MAX_REQUEST_BYTES = MAX_SAMPLES_PER_REQUEST * 512
+
+# Open sessions whose statistics this worker keeps in memory
+CACHE_SIZE = 256
+
+
+def session_channels(fuel_type):
+    """Channel order used to pack samples for a fuel type"""
+    return SESSION_CHANNELS['bensin' if fuel_type == 'bensin' else 'solar']
+
+
+class RunningStats:
+    """Count, mean, variance, min and max of a stream in constant memory"""
+    __slots__ = ('count', 'mean', 'm2', 'min', 'max')
+
+    def __init__(self, count=0, mean=0.0, m2=0.0, min=None, max=None):
+        self.count = count
+        self.mean = mean
+        self.m2 = m2
+        self.min = min
+        self.max = max
+
+    @classmethod
+    def from_dict(cls, data):
+        return cls(**{name: data.get(name) for name in cls.__slots__ if name in data})
+
+    def to_dict(self):
+        return {name: getattr(self, name) for name in self.__slots__}
+
+    def update(self, values):
+        """Fold an array of new values into the statistics"""
+        values = np.asarray(values, dtype=np.float64)
+        n = len(values)
+        if not n:
+            return self
+        mean = float(values.mean())
+        m2 = float(((values - mean) ** 2).sum())
+        total = self.count + n
+        delta = mean - self.mean
+        self.m2 += m2 + delta * delta * self.count * n / total
+        self.mean += delta * n / total
+        self.count = total
+        low, high = float(values.min()), float(values.max())
+        self.min = low if self.min is None else min(self.min, low)
+        self.max = high if self.max is None else max(self.max, high)
+        return self
+
+    @property
+    def variance(self):
+        """Sample variance, or None with fewer than two values"""
+        if self.count < 2:
+            return None
+        return self.m2 / (self.count - 1)
+
+    def summary(self):
+        variance = self.variance
+        return {
+            'count': self.count,
+            'mean': self.mean if self.count else None,
+            'min': self.min,
+            'max': self.max,
+            'variance': variance,
+            'stddev': math.sqrt(variance) if variance is not None else None
+        }
+
+
+def parse_samples(channels, samples, offset):
+    """Validate sample objects into an (n, len(channels)) float array.
+
+    Every measurement channel is required and must be a finite number. A
+    sample without ``t`` is stamped with ``offset``, the server-side seconds
+    since the session opened. Raises ValueError naming the first bad sample.
+    """
+    rows = []
+    for i, sample in enumerate(samples):
+        if not isinstance(sample, dict):
+            raise ValueError(f'sample {i} must be a JSON object')
+        row = []
+        for name in channels:
+            value = sample.get(name)
+            if value is None:
+                if name != 't':
+                    raise ValueError(f'sample {i} is missing {name}')
+                value = offset
+            try:
+                value = float(value)
+            except (TypeError, ValueError):
+                raise ValueError(f'sample {i}: {name} must be a number')
+            if not math.isfinite(value):
+                raise ValueError(f'sample {i}: {name} must be a finite number')
+            if value < 0 and name != 't':
+                raise ValueError(f'sample {i}: {name} must be non-negative')
+            row.append(value)
+        rows.append(row)
+    return np.array(rows, dtype=SAMPLE_DTYPE).reshape(len(rows), len(channels))
+
+
+def pack(samples):
+    return np.ascontiguousarray(samples, dtype=SAMPLE_DTYPE).tobytes()
+
+
+def unpack(data, channels):
+    return np.frombuffer(data, dtype=SAMPLE_DTYPE).reshape(-1, len(channels))
+
+
+def read_samples(blocks, channels):
+    """Every sample of a session as one array, in the order received"""
+    parts = [unpack(block.data, channels) for block in sorted(blocks, key=lambda b: b.seq)]
+    if not parts:
+        return np.empty((0, len(channels)), dtype=SAMPLE_DTYPE)
+    return np.concatenate(parts)
+
+
+def load_stats(statistik, channels):
+    """RunningStats per measurement channel from a stored statistik document"""
+    return {
+        name: RunningStats.from_dict((statistik or {}).get(name) or {})
+        for name in channels if name != 't'
+    }
+
+
+def merge_samples(stats, channels, samples):
+    """Fold a parsed sample array into the per-channel statistics"""
+    for c, name in enumerate(channels):
+        if name in stats:
+            stats[name].update(samples[:, c])
+    return stats
+
+
+def dump_stats(stats):
+    return {name: s.to_dict() for name, s in stats.items()}
+
+
+def window_means(blocks, channels, window_seconds):
+    """Mean of each channel over the last ``window_seconds`` of samples.
+
+    ``blocks`` must iterate newest first; the scan stops at the first block
+    that starts before the window, so with a lazily loaded query a long
+    session only fetches and decodes its tail.
+    """
+    t = channels.index('t')
+    parts = []
+    cutoff = None
+    for block in blocks:
+        samples = unpack(block.data, channels)
+        if not len(samples):
+            continue
+        if cutoff is None:
+            cutoff = samples[:, t].max() - window_seconds
+        parts.append(samples[samples[:, t] >= cutoff])
+        if samples[:, t].min() < cutoff:
+            break
+    if not parts:
+        return {}
+    window = np.concatenate(parts)
+    return {
+        name: float(window[:, c].mean())
+        for c, name in enumerate(channels) if name != 't'
+    }
+
+
+# Session id -> (sample_count, stats), least recently used first
+_cache = OrderedDict()
+_lock = threading.Lock()
+
+
+def cached_stats(sesi):
+    """Running statistics of a session, from memory when still current"""
+    channels = sesi.channels.split(',')
+    with _lock:
+        entry = _cache.get(sesi.id)
+        if entry is not None and entry[0] == sesi.sample_count:
+            _cache.move_to_end(sesi.id)
+            return {name: RunningStats(**s.to_dict()) for name, s in entry[1].items()}
+    return load_stats(sesi.statistik, channels)
+
+
+def remember_stats(sesi_id, sample_count, stats):
+    with _lock:
+        _cache[sesi_id] = (sample_count, stats)
+        _cache.move_to_end(sesi_id)
+        while len(_cache) > CACHE_SIZE:
+            _cache.popitem(last=False)
+
+
+def forget_stats(sesi_id):
+    with _lock:
+        _cache.pop(sesi_id, None)
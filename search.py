@@ -0,0 +1,138 @@
+"""Substring search over kendaraan.plat_nomor, merek and tipe.
+
+The filters are case-insensitive substring matches (``ilike('%...%')``),
+which SQLite can only answer by scanning the whole table. kendaraan_fts is an
+FTS5 table with the trigram tokenizer, kept in step with kendaraan by
+triggers; a LIKE on it is answered from the trigram index. contains() uses
+it to narrow the candidates and then applies the original ilike to them, so
+results are exactly the same as before.
+
+Terms shorter than a trigram or containing LIKE wildcards, and databases
+whose SQLite lacks the trigram tokenizer (before 3.34), fall back to the
+plain ilike. Bulk inserts inside changelog.bulk_inserts() pause the insert
+trigger and add their rows with index_inserted(). To refill the index:
+
+    python search.py rebuild
+"""
+import logging
+import sys
+
+from sqlalchemy import column, exc, select, table, text
+
+from extensions import db
+
+logger = logging.getLogger(__name__)
+
+INDEX_TABLE = 'kendaraan_fts'
+
+SEARCH_COLUMNS = ('plat_nomor', 'merek', 'tipe')
+
+# Shortest term the trigram index can answer
+MIN_TERM_LENGTH = 3
+
+_index = table(INDEX_TABLE, column('rowid'), *[column(name) for name in SEARCH_COLUMNS])
+
+# Whether kendaraan_fts exists in this database; looked up once per process
+_ready = None
+
+
+def trigger_statements():
+    """DROP/CREATE statements for the triggers keeping kendaraan_fts in sync"""
+    names = ', '.join(SEARCH_COLUMNS)
+    new = ', '.join(f'NEW.{name}' for name in SEARCH_COLUMNS)
+    old = ', '.join(f'OLD.{name}' for name in SEARCH_COLUMNS)
+    insert_new = f'INSERT INTO {INDEX_TABLE} (rowid, {names}) VALUES (NEW.id, {new});'
+    delete_old = (
+        f"INSERT INTO {INDEX_TABLE} ({INDEX_TABLE}, rowid, {names}) "
+        f"VALUES ('delete', OLD.id, {old});"
+    )
+    not_bulk = "NOT EXISTS (SELECT 1 FROM change_log_bulk WHERE table_name = 'kendaraan')"
+    triggers = (
+        ('insert', f'AFTER INSERT ON kendaraan WHEN {not_bulk}', insert_new),
+        ('delete', 'AFTER DELETE ON kendaraan', delete_old),
+        ('update', f'AFTER UPDATE OF {names} ON kendaraan', f'{delete_old} {insert_new}'),
+    )
+    statements = []
+    for operation, event, body in triggers:
+        name = f'{INDEX_TABLE}_{operation}'
+        statements.append(f'DROP TRIGGER IF EXISTS {name}')
+        statements.append(f'CREATE TRIGGER {name} {event} BEGIN {body} END')
+    return statements
+
+
+def install():
+    """Create kendaraan_fts and its triggers, filling it on first creation.
+
+    Returns False if SQLite has no trigram tokenizer; the caller commits.
+    """
+    global _ready
+    exists = db.session.execute(
+        text("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = :name"),
+        {'name': INDEX_TABLE}
+    ).first() is not None
+    try:
+        if not exists:
+            db.session.execute(text(
+                f"CREATE VIRTUAL TABLE {INDEX_TABLE} USING fts5("
+                f"{', '.join(SEARCH_COLUMNS)}, content='kendaraan', content_rowid='id', tokenize='trigram')"
+            ))
+        for statement in trigger_statements():
+            db.session.execute(text(statement))
+        if not exists:
+            db.session.execute(text(f"INSERT INTO {INDEX_TABLE} ({INDEX_TABLE}) VALUES ('rebuild')"))
+    except exc.OperationalError as e:
+        logger.warning(f"Substring search index not available, using table scans: {str(e)}")
+        _ready = False
+        return False
+    _ready = True
+    return True
+
+
+def index_inserted(after_id):
+    """Index the vehicles with ids above after_id in one statement"""
+    if not index_ready():
+        return
+    names = ', '.join(SEARCH_COLUMNS)
+    db.session.execute(text(
+        f"INSERT INTO {INDEX_TABLE} (rowid, {names}) "
+        f"SELECT id, {names} FROM kendaraan WHERE id > :after_id ORDER BY id"
+    ), {'after_id': after_id})
+
+
+def rebuild():
+    """Refill kendaraan_fts from kendaraan; the caller commits"""
+    db.session.execute(text(f"INSERT INTO {INDEX_TABLE} ({INDEX_TABLE}) VALUES ('rebuild')"))
+
+
+def index_ready():
+    global _ready
+    if _ready is None:
+        _ready = db.session.execute(
+            text("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = :name"),
+            {'name': INDEX_TABLE}
+        ).first() is not None
+    return _ready
+
+
+def contains(attribute, term):
+    """Case-insensitive substring filter on a Kendaraan search column"""
+    pattern = f'%{term}%'
+    condition = attribute.ilike(pattern)
+    # Wildcards break the term into pieces the index narrows down poorly
+    if len(term) < MIN_TERM_LENGTH or '%' in term or '_' in term or not index_ready():
+        return condition
+    matches = select(_index.c.rowid).where(_index.c[attribute.key].like(pattern))
+    return attribute.class_.id.in_(matches) & condition
+
+
+if __name__ == '__main__':
+    from app_init import app
+
+    command = sys.argv[1] if len(sys.argv) > 1 else None
+    with app.app_context():
+        if command == 'rebuild':
+            rebuild()
+            db.session.commit()
+            print(f"Rebuilt {INDEX_TABLE}")
+        else:
+            print("Please provide a command: 'rebuild'.")
@@ -0,0 +1,174 @@
+"""What-if evaluation of proposed limits over stored test results.
+
+Readings are loaded as column arrays straight from a Core SELECT, graded with
+the vectorized evaluator and counted with NumPy, so no ORM objects are built
+and nothing is written.
+"""
+import copy
+
+import numpy as np
+from sqlalchemy import extract, select
+
+from evaluate import (Thresholds, READING_COLUMNS, age_categories,
+                      parameter_documents, scalar_limits)
+from extensions import db
+from models import HasilUji, Kendaraan
+
+# Rows converted to arrays per fetch
+FETCH_SIZE = 50000
+
+
+def proposed_thresholds(document, config=None):
+    """Compile a proposed threshold document on top of the current limits.
+
+    The document may hold ``bensin_parameters`` and ``solar_parameters`` in
+    the same nested shape as Config, and ``limits`` with scalar fallbacks
+    (see evaluate.SCALAR_COLUMNS). Anything it leaves out keeps its current
+    value. Raises ValueError for unknown keys or non-numeric limits.
+    """
+    bensin, solar = (copy.deepcopy(doc) for doc in parameter_documents(config))
+    scalars = scalar_limits(config)
+
+    for key, current in (('bensin_parameters', bensin), ('solar_parameters', solar)):
+        proposed = document.get(key) or {}
+        if not isinstance(proposed, dict):
+            raise ValueError(f'{key} must be an object')
+        for load_category, by_age in proposed.items():
+            if not isinstance(by_age, dict):
+                raise ValueError(f'{key}.{load_category} must be an object')
+            for age, limits in by_age.items():
+                if not isinstance(limits, dict):
+                    raise ValueError(f'{key}.{load_category}.{age} must be an object')
+                target = current.setdefault(load_category, {}).setdefault(age, {})
+                for name, value in limits.items():
+                    target[name] = _limit_value(f'{key}.{load_category}.{age}.{name}', value)
+
+    for name, value in (document.get('limits') or {}).items():
+        if name not in scalars:
+            raise ValueError(f'Unknown limit: {name}')
+        scalars[name] = _limit_value(f'limits.{name}', value)
+
+    return Thresholds.compile(bensin, solar, scalars)
+
+
+def _limit_value(path, value):
+    try:
+        value = float(value)
+    except (TypeError, ValueError):
+        raise ValueError(f'{path} must be a number')
+    if value < 0:
+        raise ValueError(f'{path} must not be negative')
+    return value
+
+
+def load_readings(start=None, end=None):
+    """Load valid stored results as a dict of NumPy column arrays"""
+    hasil = HasilUji.__table__
+    kendaraan = Kendaraan.__table__
+    month = extract('year', hasil.c.tanggal) * 100 + extract('month', hasil.c.tanggal)
+    query = select(
+        *[hasil.c[name] for name in READING_COLUMNS],
+        hasil.c.lulus,
+        month.label('month'),
+        kendaraan.c.tahun, kendaraan.c.fuel_type, kendaraan.c.load_category
+    ).select_from(
+        hasil.join(kendaraan, hasil.c.kendaraan_id == kendaraan.c.id)
+    ).where(
+        hasil.c.valid == True,
+        hasil.c.tanggal.isnot(None)
+    )
+    if start:
+        query = query.where(hasil.c.tanggal >= start)
+    if end:
+        query = query.where(hasil.c.tanggal <= end)
+
+    names = list(READING_COLUMNS) + ['lulus', 'month', 'tahun', 'fuel_type', 'load_category']
+    dtypes = [np.float64] * len(READING_COLUMNS) + [bool, np.int64, np.int64, object, object]
+    parts = {name: [] for name in names}
+    result = db.session.execute(query.execution_options(stream_results=True))
+    for rows in result.partitions(FETCH_SIZE):
+        for name, dtype, values in zip(names, dtypes, zip(*rows)):
+            parts[name].append(np.array(values, dtype=dtype))
+    return {
+        name: np.concatenate(parts[name]) if parts[name] else np.array([], dtype=dtype)
+        for name, dtype in zip(names, dtypes)
+    }
+
+
+def _rates(passed, total):
+    return round(passed / total * 100, 1) if total else 0.0
+
+
+def _breakdown(fields, proposed, current):
+    """Count rows per distinct combination of the given column arrays"""
+    names = list(fields)
+    if not len(proposed):
+        return []
+    keys = np.rec.fromarrays([fields[name] for name in names], names=names)
+    groups, inverse = np.unique(keys, return_inverse=True)
+    totals = np.bincount(inverse, minlength=len(groups))
+    proposed_passed = np.bincount(inverse, weights=proposed, minlength=len(groups))
+    current_passed = np.bincount(inverse, weights=current, minlength=len(groups))
+    rows = []
+    for i, group in enumerate(groups):
+        total = int(totals[i])
+        passed = int(proposed_passed[i])
+        row = {name: group[name].item() for name in names}
+        row.update({
+            'total': total,
+            'passed': passed,
+            'failed': total - passed,
+            'pass_rate': _rates(passed, total),
+            'current_passed': int(current_passed[i]),
+            'current_pass_rate': _rates(int(current_passed[i]), total)
+        })
+        rows.append(row)
+    return rows
+
+
+def simulate(thresholds, start=None, end=None):
+    """Pass/fail counts for stored results under the given thresholds"""
+    readings = load_readings(start, end)
+    total = len(readings['lulus'])
+    current = readings['lulus']
+    if total:
+        graded = thresholds.evaluate_batch(**{
+            name: readings[name]
+            for name in list(READING_COLUMNS) + ['tahun', 'fuel_type', 'load_category']
+        })
+        proposed, age_index = graded.lulus, graded.age_index
+    else:
+        proposed, age_index = np.array([], dtype=bool), np.array([], dtype=np.int64)
+
+    fuel_type = np.where(readings['fuel_type'] == 'bensin', 'bensin', 'solar')
+    load_category = readings['load_category'].astype(str)
+
+    by_age = _breakdown({'fuel_type': fuel_type, 'age_category': age_index}, proposed, current)
+    for row in by_age:
+        row['age_category'] = age_categories(row['fuel_type'])[row['age_category']]
+    by_month = _breakdown({'month': readings['month']}, proposed, current)
+    for row in by_month:
+        row['month'] = f"{row['month'] // 100:04d}-{row['month'] % 100:02d}"
+
+    passed = int(proposed.sum())
+    current_passed = int(current.sum())
+    return {
+        'total': total,
+        'proposed': {
+            'passed': passed,
+            'failed': total - passed,
+            'pass_rate': _rates(passed, total)
+        },
+        'current': {
+            'passed': current_passed,
+            'failed': total - current_passed,
+            'pass_rate': _rates(current_passed, total)
+        },
+        'changed': int((proposed != current).sum()),
+        'by_fuel_type': _breakdown({'fuel_type': fuel_type}, proposed, current),
+        'by_load_category': _breakdown(
+            {'fuel_type': fuel_type, 'load_category': load_category}, proposed, current
+        ),
+        'by_age_category': by_age,
+        'by_month': by_month
+    }
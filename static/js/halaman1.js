@@ -240,6 +240,96 @@ document.addEventListener('DOMContentLoaded', function() {
     const batchResult = document.getElementById('batchResult');
     const batchSummary = document.getElementById('batchSummary');
     const batchErrors = document.getElementById('batchErrors');
+    const batchPartial = document.getElementById('batchPartial');
+    
+    const batchCancelBtn = document.getElementById('batchCancelBtn');
+    const batchResumeBtn = document.getElementById('batchResumeBtn');
+    let uploadJob = null;
+    
+    function showUploadError(message) {
+        batchResult.classList.remove('hidden');
+        batchSummary.textContent = message;
+        batchSummary.className = 'text-sm bg-red-100 p-2 rounded';
+        batchErrors.classList.add('hidden');
+        showToast(message, 'error');
+    }
+    
+    function renderUploadErrors(result) {
+        if (!result.errors || !result.errors.length) {
+            batchErrors.classList.add('hidden');
+            return;
+        }
+        
+        // Show detailed error list
+        batchErrors.classList.remove('hidden');
+        batchErrors.innerHTML = '<div class="font-semibold mb-2">Detail Kesalahan:</div>';
+        
+        result.errors.forEach(error => {
+            const errorItem = document.createElement('div');
+            errorItem.className = 'text-sm text-red-700 mb-1 p-1 border-b border-red-200';
+            errorItem.textContent = `Baris ${error.row}: ${error.error}`;
+            batchErrors.appendChild(errorItem);
+        });
+        
+        if (result.rejected > result.errors.length) {
+            const moreItem = document.createElement('div');
+            moreItem.className = 'text-sm text-red-700 p-1';
+            moreItem.textContent = `... dan ${result.rejected - result.errors.length} kesalahan lainnya`;
+            batchErrors.appendChild(moreItem);
+        }
+    }
+    
+    function renderUploadJob(job) {
+        batchResult.classList.remove('hidden');
+        renderUploadErrors(job);
+        batchCancelBtn.classList.toggle('hidden', !['pending', 'running'].includes(job.status));
+        batchResumeBtn.classList.toggle('hidden', !['cancelled', 'failed'].includes(job.status));
+        
+        if (job.status === 'pending' || job.status === 'running') {
+            const step = job.phase === 'validate' ? 'Memvalidasi' : 'Menyimpan';
+            const rows = job.total_rows ? `${job.processed} / ${job.total_rows} baris` : 'menghitung baris';
+            batchSummary.textContent = `${step}: ${rows} (${job.percent}%)`;
+            batchSummary.className = 'text-sm bg-blue-100 p-2 rounded';
+            return;
+        }
+        
+        let summaryMsg = `Berhasil: ${job.successes} kendaraan`;
+        if (job.rejected) {
+            summaryMsg += `; ${job.rejected} kendaraan gagal`;
+            if (job.mode === 'all') {
+                summaryMsg += ' (tidak ada data yang disimpan)';
+            }
+        }
+        
+        if (job.status === 'completed') {
+            batchSummary.textContent = summaryMsg;
+            batchSummary.className = 'text-sm bg-green-100 p-2 rounded';
+            showToast(summaryMsg, 'success');
+            batchFileInput.value = '';
+        } else if (job.status === 'cancelled') {
+            batchSummary.textContent = `Upload dibatalkan. ${summaryMsg}`;
+            batchSummary.className = 'text-sm bg-yellow-100 p-2 rounded';
+        } else {
+            batchSummary.textContent = `Upload gagal: ${job.error || job.status}. ${summaryMsg}`;
+            batchSummary.className = 'text-sm bg-red-100 p-2 rounded';
+        }
+    }
+    
+    async function followUploadJob(job) {
+        uploadJob = job;
+        uploadBtn.disabled = true;
+        while (uploadJob && ['pending', 'running'].includes(uploadJob.status)) {
+            renderUploadJob(uploadJob);
+            await new Promise(resolve => setTimeout(resolve, 1000));
+            const res = await fetch(uploadJob.status_url);
+            if (!res.ok) {
+                throw new Error('Gagal membaca progres upload');
+            }
+            uploadJob = await res.json();
+        }
+        renderUploadJob(uploadJob);
+        uploadBtn.disabled = false;
+    }
     
     if (uploadBtn) {
         uploadBtn.addEventListener('click', async function() {
@@ -257,8 +347,11 @@ document.addEventListener('DOMContentLoaded', function() {
             // Hide previous results
             batchResult.classList.add('hidden');
             
+            // The file is imported by a background job; progress is polled below
             const formData = new FormData();
             formData.append('file', file);
+            formData.append('mode', batchPartial && batchPartial.checked ? 'partial' : 'all');
+            formData.append('background', '1');
             
             try {
                 const res = await fetch('/api/kendaraan/batch-upload', { 
@@ -267,56 +360,16 @@ document.addEventListener('DOMContentLoaded', function() {
                 });
                 
                 const result = await res.json();
-                
-                // Show result area
-                batchResult.classList.remove('hidden');
+                uploadBtn.innerHTML = originalBtnText;
                 
                 if (res.ok) {
-                    let summaryMsg = `Berhasil: ${result.successes} kendaraan`;
-                    
-                    if (result.errors && result.errors.length) {
-                        summaryMsg += `; ${result.errors.length} kendaraan gagal`;
-                        
-                        // Show detailed error list
-                        batchErrors.classList.remove('hidden');
-                        batchErrors.innerHTML = '<div class="font-semibold mb-2">Detail Kesalahan:</div>';
-                        
-                        result.errors.forEach(error => {
-                            const errorItem = document.createElement('div');
-                            errorItem.className = 'text-sm text-red-700 mb-1 p-1 border-b border-red-200';
-                            errorItem.textContent = `Baris ${error.row}: ${error.error}`;
-                            batchErrors.appendChild(errorItem);
-                        });
-                    } else {
-                        batchErrors.classList.add('hidden');
-                    }
-                    
-                    batchSummary.textContent = summaryMsg;
-                    batchSummary.className = 'text-sm bg-green-100 p-2 rounded';
-                    
-                    // Also show toast notification for successful uploads
-                    showToast(summaryMsg, 'success');
-                    
-                    // Reset file input
-                    batchFileInput.value = '';
+                    await followUploadJob(result);
                 } else {
-                    const errorMsg = result.error || 'Gagal upload CSV.';
-                    batchSummary.textContent = errorMsg;
-                    batchSummary.className = 'text-sm bg-red-100 p-2 rounded';
-                    batchErrors.classList.add('hidden');
-                    
-                    // Show toast notification for error
-                    showToast(errorMsg, 'error');
+                    showUploadError(result.error || 'Gagal upload CSV.');
                 }
             } catch (e) {
                 console.error(e);
-                batchResult.classList.remove('hidden');
-                batchSummary.textContent = 'Terjadi kesalahan saat upload.';
-                batchSummary.className = 'text-sm bg-red-100 p-2 rounded';
-                batchErrors.classList.add('hidden');
-                
-                // Show toast notification for error
-                showToast('Terjadi kesalahan saat upload.', 'error');
+                showUploadError('Terjadi kesalahan saat upload.');
             } finally {
                 // Re-enable button
                 uploadBtn.disabled = false;
@@ -324,4 +377,40 @@ document.addEventListener('DOMContentLoaded', function() {
             }
         });
     }
+    
+    if (batchCancelBtn) {
+        batchCancelBtn.addEventListener('click', async function() {
+            if (!uploadJob) return;
+            try {
+                const res = await fetch(`/api/v1/uploads/${uploadJob.id}/cancel`, { method: 'POST' });
+                const result = await res.json();
+                if (res.ok) {
+                    uploadJob = result;
+                } else {
+                    showToast(result.error || 'Gagal membatalkan upload.', 'error');
+                }
+            } catch (e) {
+                console.error(e);
+                showToast('Gagal membatalkan upload.', 'error');
+            }
+        });
+    }
+    
+    if (batchResumeBtn) {
+        batchResumeBtn.addEventListener('click', async function() {
+            if (!uploadJob) return;
+            try {
+                const res = await fetch(`/api/v1/uploads/${uploadJob.id}/resume`, { method: 'POST' });
+                const result = await res.json();
+                if (res.ok) {
+                    await followUploadJob(result);
+                } else {
+                    showToast(result.error || 'Gagal melanjutkan upload.', 'error');
+                }
+            } catch (e) {
+                console.error(e);
+                showUploadError('Gagal melanjutkan upload.');
+            }
+        });
+    }
 }); 
\ No newline at end of file
@@ -1,10 +1,9 @@
 (function() {
   let vehicles = [];
-  let testedPlats = [];
   let filteredVehicles = []; // Store filtered results for better performance
+  let suggestedPlats = []; // Latest typeahead matches for the plate filter
   const pageSize = 10;
-  let offset = 0;
-  let totalVehicles = 0;
+  let nextCursor = null;
   let isLoading = false; // Track loading state
   let debugMode = true; // Enable for console logging
 
@@ -106,45 +105,64 @@
   }
 
   /**
-   * Fetch vehicles that have been tested
-   * @returns {Promise} Promise that resolves when data is fetched
+   * Fetch vehicles with their latest result and limits in one request
+   * @param {string[]} plats - Plates to look up
+   * @returns {Promise<Object>} Lookup entries keyed by plate
    */
-  async function fetchTestedPlats() {
-    try {
-      const res = await fetch('/api/hasil-uji/tested-plats');
-      if (!res.ok) {
-        throw new Error(`Failed to fetch tested plates: ${res.status} ${res.statusText}`);
-      }
-      testedPlats = await res.json();
-      debug('Tested plates loaded:', testedPlats.length);
-      return testedPlats;
-    } catch (e) {
-      console.error('Error fetching tested plates:', e);
-      showToast('Gagal memuat data kendaraan yang sudah diuji', 'error');
-      return [];
+  async function lookupVehicles(plats) {
+    const params = new URLSearchParams();
+    plats.forEach(plat => params.append('plat', plat));
+    const res = await fetch(`/api/hasil-uji/lookup?${params}`);
+    if (!res.ok) {
+      throw new Error(`Failed to look up vehicles: ${res.status} ${res.statusText}`);
+    }
+    const data = await res.json();
+    const entries = {};
+    data.items.forEach(item => {
+      entries[item.kendaraan.plat_nomor] = item;
+      setTested(item.kendaraan.plat_nomor, item.hasil_terakhir);
+    });
+    return entries;
+  }
+
+  /**
+   * Update the tested flag of a loaded vehicle
+   * @param {string} plat - License plate number
+   * @param {Object|null} hasil - Its latest result summary, or null
+   */
+  function setTested(plat, hasil) {
+    const vehicle = vehicles.find(v => v.plat_nomor === plat);
+    if (vehicle) {
+      vehicle.tested = Boolean(hasil);
+      vehicle.hasil_terakhir = hasil || null;
     }
   }
 
   /**
    * Load vehicles with pagination
-   * @param {number} off - Offset for pagination
+   * @param {string|null} cursor - Cursor of the next page, or null for the first page
    * @returns {Promise} Promise that resolves when data is fetched
    */
-  async function loadVehicles(off = 0) {
-    if (isLoading && off > 0) return;
+  async function loadVehicles(cursor = null) {
+    if (isLoading && cursor) return;
     
     setLoading(true);
     try {
-      debug('Loading vehicles, offset:', off);
-      const res = await fetch(`/api/kendaraan-list?offset=${off}&limit=${pageSize}`);
+      debug('Loading vehicles, cursor:', cursor);
+      const params = new URLSearchParams({ per_page: pageSize });
+      if (cursor) params.set('cursor', cursor);
+      // Tested/untested is filtered on the server, so every page is full
+      const testedFilter = document.getElementById('filterTested').value;
+      if (testedFilter) params.set('tested', testedFilter === 'tested' ? 'yes' : 'no');
+      const res = await fetch(`/api/kendaraan-list?${params}`);
       if (!res.ok) {
         throw new Error(`Failed to load vehicles: ${res.status} ${res.statusText}`);
       }
       
       const data = await res.json();
-      debug('Vehicles loaded:', data.items.length, 'total:', data.total);
+      debug('Vehicles loaded:', data.items.length, 'next:', data.next_cursor);
       
-      if (off === 0) {
+      if (!cursor) {
         // Reset for new search
         vehicles = data.items;
       } else {
@@ -152,7 +170,7 @@
         vehicles = vehicles.concat(data.items);
       }
       
-      totalVehicles = data.total;
+      nextCursor = data.next_cursor;
       
       // Apply current filters and render
       applyFiltersAndRender();
@@ -182,7 +200,7 @@
     
     // Apply filters
     filteredVehicles = vehicles.filter(v => {
-      const isTested = testedPlats.includes(v.plat_nomor);
+      const isTested = v.tested;
       
       if (platFilter && !v.plat_nomor.toLowerCase().includes(platFilter)) return false;
       if (merekFilter && v.merek !== merekFilter) return false;
@@ -227,7 +245,7 @@
     
     // Add cards
     filteredVehicles.forEach(v => {
-      const isTested = testedPlats.includes(v.plat_nomor);
+      const isTested = v.tested;
       const card = document.createElement('div');
       card.className = 'bg-white rounded-lg overflow-hidden shadow-sm hover:shadow-md transition-all duration-300 transform hover:-translate-y-1';
       card.innerHTML = `
@@ -266,7 +284,7 @@
     // Show/hide load more button
     const loadMoreContainer = document.getElementById('loadMoreContainer');
     if (loadMoreContainer) {
-      if (vehicles.length < totalVehicles) {
+      if (nextCursor) {
         loadMoreContainer.classList.remove('hidden');
       } else {
         loadMoreContainer.classList.add('hidden');
@@ -313,7 +331,7 @@
           if (!res.ok) throw new Error(`Failed to delete test data: ${res.status}`);
           
           showToast('Data uji berhasil dihapus', 'success'); 
-          await fetchTestedPlats();
+          await lookupVehicles([plat]);
           applyFiltersAndRender();
           modal.classList.add('hidden');
         } catch (error) {
@@ -327,11 +345,11 @@
     };
     
     try {
-      // Get vehicle details to check fuel type
-      const vehicleRes = await fetch(`/api/kendaraan/${plat}`);
-      if (!vehicleRes.ok) throw new Error(`Failed to fetch vehicle: ${vehicleRes.status}`);
+      // Vehicle details and the latest result in one request
+      const [entry] = Object.values(await lookupVehicles([plat]));
+      if (!entry) throw new Error(`Vehicle not found: ${plat}`);
       
-      const vehicle = await vehicleRes.json();
+      const vehicle = entry.kendaraan;
       const isSolar = vehicle.fuel_type === 'solar';
       
       // Show/hide fields based on fuel type
@@ -352,16 +370,15 @@
         <strong>${plat}</strong> - ${vehicle.merek} ${vehicle.tipe} (${vehicle.tahun}) - 
         ${vehicle.fuel_type === 'solar' ? 'Solar' : 'Bensin'}`;
       
-      // Try to load existing test results
-      const resultsRes = await fetch(`/api/hasil-uji/${plat}`);
-      if (resultsRes.ok) {
-        const data = await resultsRes.json();
-        
+      // Show the latest test result, if any
+      const data = entry.hasil_terakhir;
+      if (data) {
         // Populate form with existing data
-        ['co', 'co2', 'hc', 'o2', 'lambda', 'opacity'].forEach(id => {
+        const fields = { co: 'co', co2: 'co2', hc: 'hc', o2: 'o2', lambda: 'lambda_val', opacity: 'opacity' };
+        Object.entries(fields).forEach(([id, key]) => {
           const element = document.getElementById(id);
-          if (element && data[id] !== undefined) {
-            element.value = data[id] !== null ? data[id] : '';
+          if (element && data[key] !== undefined) {
+            element.value = data[key] !== null ? data[key] : '';
           }
         });
         
@@ -464,7 +481,7 @@
             }
             
             showToast(`Data berhasil disimpan – ${status.join(', ')}`, 'success');
-            await fetchTestedPlats();
+            setTested(plat, { lulus: result.lulus });
             applyFiltersAndRender();
             modal.classList.add('hidden');
           } else {
@@ -507,8 +524,7 @@
             if (!res.ok) throw new Error(`Failed to delete vehicle: ${res.status}`);
             
             // Refresh data
-            await fetchTestedPlats();
-            await loadVehicles(0); // Reset to first page
+            await loadVehicles(); // Reset to first page
             showToast('Kendaraan berhasil dihapus', 'success');
           } catch (error) {
             console.error('Error deleting vehicle:', error);
@@ -527,15 +543,88 @@
     });
   }
 
+  /**
+   * Fill the plate datalist with server-side typeahead matches
+   * @param {string} query - Plate prefix typed so far
+   */
+  async function suggestPlates(query) {
+    const datalist = document.getElementById('platSuggestions');
+    if (!datalist) return;
+    if (!query.trim()) {
+      datalist.innerHTML = '';
+      return;
+    }
+    
+    try {
+      const res = await fetch(`/api/kendaraan/suggest?${new URLSearchParams({ q: query })}`);
+      if (!res.ok) {
+        throw new Error(`Failed to fetch plate suggestions: ${res.status}`);
+      }
+      const data = await res.json();
+      suggestedPlats = data.items;
+      
+      datalist.innerHTML = '';
+      data.items.forEach(plat => {
+        const opt = document.createElement('option');
+        opt.value = plat;
+        datalist.appendChild(opt);
+      });
+    } catch (e) {
+      debug('Error fetching plate suggestions:', e);
+    }
+  }
+
+  /**
+   * Refill the tipe filter, keeping the selection if it is still offered.
+   * The response carries an ETag, so the browser revalidates its copy.
+   * @param {string} merek - Only list tipes of this merek, or all if empty
+   */
+  async function loadTipeOptions(merek = '') {
+    const tipeSelect = document.getElementById('filterTipe');
+    const params = merek ? `?${new URLSearchParams({ merek })}` : '';
+    const res = await fetch(`/api/kendaraan-tipes${params}`);
+    if (!res.ok) throw new Error(`Error fetching tipes: ${res.status}`);
+    const tipes = await res.json();
+    if (!tipeSelect) return tipes;
+
+    const selected = tipeSelect.value;
+    tipeSelect.length = 1; // keep "All Tipes"
+    tipes.forEach(tipe => {
+      const opt = document.createElement('option');
+      opt.value = tipe;
+      opt.textContent = tipe;
+      tipeSelect.appendChild(opt);
+    });
+    tipeSelect.value = tipes.includes(selected) ? selected : '';
+    return tipes;
+  }
+
   /**
    * Initialize form fields for debounce
    */
   function initializeFormFields() {
     // Add debounce to search input for better performance
     let searchTimeout = null;
+    let suggestTimeout = null;
     const filterPlat = document.getElementById('filterPlat');
     if (filterPlat) {
+      let previousPlat = filterPlat.value;
       filterPlat.addEventListener('input', (e) => {
+        // A plate picked from the suggestions opens its test form directly.
+        // A pick replaces the whole value (Chrome reports insertReplacementText,
+        // Firefox sends a plain Event), while typing or deleting the last
+        // character of a suggested plate must not open it.
+        const picked = !e.inputType || e.inputType === 'insertReplacementText';
+        if (picked && filterPlat.value !== previousPlat && suggestedPlats.includes(filterPlat.value)) {
+          showForm(filterPlat.value);
+        }
+        previousPlat = filterPlat.value;
+
+        clearTimeout(suggestTimeout);
+        suggestTimeout = setTimeout(() => {
+          suggestPlates(filterPlat.value);
+        }, 150); // 150ms debounce
+        
         clearTimeout(searchTimeout);
         searchTimeout = setTimeout(() => {
           applyFiltersAndRender();
@@ -543,8 +632,27 @@
       });
     }
     
+    // Only offer the tipes of the selected merek
+    const filterMerek = document.getElementById('filterMerek');
+    if (filterMerek) {
+      filterMerek.addEventListener('change', async () => {
+        try {
+          await loadTipeOptions(filterMerek.value);
+        } catch (error) {
+          debug('Error loading tipe options:', error);
+        }
+        applyFiltersAndRender();
+      });
+    }
+    
+    // Tested/untested is a server-side filter: reload from the first page
+    const filterTested = document.getElementById('filterTested');
+    if (filterTested) {
+      filterTested.addEventListener('change', () => loadVehicles());
+    }
+    
     // Add event listeners to other filters
-    ['filterMerek', 'filterTipe', 'filterJenis', 'filterTested'].forEach(id => {
+    ['filterTipe', 'filterJenis'].forEach(id => {
       const element = document.getElementById(id);
       if (element) {
         element.addEventListener('change', applyFiltersAndRender);
@@ -586,8 +694,7 @@
       const loadMoreBtn = document.getElementById('loadMoreBtn');
       if (loadMoreBtn) {
         loadMoreBtn.onclick = () => {
-          offset += pageSize;
-          loadVehicles(offset);
+          if (nextCursor) loadVehicles(nextCursor);
         };
       }
       
@@ -610,17 +717,11 @@
         return res.json();
       });
       
-      const tipePromise = fetch('/api/kendaraan-tipes').then(res => {
-        if (!res.ok) throw new Error(`Error fetching tipes: ${res.status}`);
-        return res.json();
-      });
-      
-      // Load initial data
-      debug('Fetching tested plates...');
-      await fetchTestedPlats();
+      const tipePromise = loadTipeOptions();
       
+      // Load initial data; tested flags come with each page
       debug('Fetching vehicles...');
-      const vehiclesData = await loadVehicles(0);
+      const vehiclesData = await loadVehicles();
       
       if (!vehiclesData || !vehiclesData.items || vehiclesData.items.length === 0) {
         debug('No vehicles returned from API');
@@ -629,7 +730,7 @@
       
       // Populate dropdown menus
       try {
-        const [mereks, tipes] = await Promise.all([merekPromise, tipePromise]);
+        const [mereks] = await Promise.all([merekPromise, tipePromise]);
         
         const merekSelect = document.getElementById('filterMerek');
         if (merekSelect && mereks && mereks.length) {
@@ -640,16 +741,6 @@
             merekSelect.appendChild(opt);
           });
         }
-        
-        const tipeSelect = document.getElementById('filterTipe');
-        if (tipeSelect && tipes && tipes.length) {
-          tipes.forEach(tipe => {
-            const opt = document.createElement('option');
-            opt.value = tipe;
-            opt.textContent = tipe;
-            tipeSelect.appendChild(opt);
-          });
-        }
       } catch (error) {
         debug('Error loading dropdown data:', error);
         showToast('Error loading filter options', 'warning');
@@ -15,6 +15,9 @@ document.addEventListener('DOMContentLoaded', function() {
     // Initialize table container scroll behavior
     initTableScroll();
 
+    // Build exports in the background instead of holding the request open
+    initExportLinks();
+
     // Add debug info
     console.log('Halaman3.js loaded successfully');
 });
@@ -193,6 +196,50 @@ function initTableScroll() {
     }
 }
 
+// Queue an export job for the current filters, poll its progress and download the file when ready
+function initExportLinks() {
+    document.querySelectorAll('.export-link[data-export-kind]').forEach(link => {
+        link.addEventListener('click', async function(e) {
+            e.preventDefault();
+            if (link.dataset.busy) return;
+            link.dataset.busy = '1';
+            const label = link.innerHTML;
+            
+            const params = Object.fromEntries(new URLSearchParams(window.location.search));
+            params.kind = link.dataset.exportKind;
+            
+            try {
+                let res = await fetch('/api/v1/exports', {
+                    method: 'POST',
+                    headers: { 'Content-Type': 'application/json' },
+                    body: JSON.stringify(params)
+                });
+                let job = await res.json();
+                if (!res.ok) throw new Error(job.error || 'Export gagal');
+                
+                while (job.status === 'pending' || job.status === 'running') {
+                    link.innerHTML = `<i class="fas fa-spinner fa-spin mr-2"></i> ${job.percent}%`;
+                    await new Promise(resolve => setTimeout(resolve, 1000));
+                    res = await fetch(job.status_url);
+                    job = await res.json();
+                    if (!res.ok) throw new Error(job.error || 'Export gagal');
+                }
+                
+                if (job.status !== 'completed') {
+                    throw new Error(job.error || 'Export gagal');
+                }
+                window.location = job.download_url;
+            } catch (error) {
+                console.error('Export failed:', error);
+                showToast(`Gagal membuat file export: ${error.message}`, 'error');
+            } finally {
+                link.innerHTML = label;
+                delete link.dataset.busy;
+            }
+        });
+    });
+}
+
 // Function to show toast/notification messages - removed as we now use the central toast.js
 // This was previously defined as:
 // function showToast(message, type = 'success') {
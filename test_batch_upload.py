@@ -0,0 +1,70 @@
+import io
+import time
+
+import batch_upload
+from extensions import db
+from models import Kendaraan, MerekKendaraan
+
+HEADER = 'jenis,plat_nomor,merek,tipe,tahun,fuel_type,load_category\n'
+
+
+def csv_file(rows=1500, bad_row=None):
+    """A vehicle CSV spanning more than one chunk, optionally with one invalid year"""
+    lines = [HEADER]
+    for i in range(rows):
+        tahun = 'abc' if i == bad_row else '2015'
+        lines.append(f'umum,B {i} UP,Toyota,Avanza,{tahun},bensin,kendaraan_penumpang\n')
+    return io.BytesIO(''.join(lines).encode('utf-8'))
+
+
+def upload(client, mode, rows=1500, bad_row=None, background=False):
+    data = {'file': (csv_file(rows, bad_row), 'kendaraan.csv'), 'mode': mode}
+    if background:
+        data['background'] = '1'
+    return client.post('/api/kendaraan/batch-upload', data=data, content_type='multipart/form-data')
+
+
+def wait_for_upload(client, job_id, timeout=30):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        job = client.get(f'/api/v1/uploads/{job_id}').get_json()
+        if job['status'] not in batch_upload.ACTIVE_STATUSES:
+            return job
+        time.sleep(0.05)
+    raise AssertionError('upload job did not finish')
+
+
+def test_mode_all_keeps_nothing_when_one_row_is_bad(client):
+    # The bad row sits in the second chunk, after the first one was inserted
+    summary = upload(client, 'all', bad_row=batch_upload.CHUNK_SIZE + 100).get_json()
+    assert summary['successes'] == 0
+    assert summary['rejected'] == 1
+    assert summary['errors'][0]['row'] == batch_upload.CHUNK_SIZE + 102
+    db.session.rollback()
+    assert Kendaraan.query.count() == 0
+    assert MerekKendaraan.query.count() == 0
+
+
+def test_mode_all_inserts_a_clean_file(client):
+    summary = upload(client, 'all').get_json()
+    assert summary['successes'] == 1500
+    assert Kendaraan.query.count() == 1500
+    assert MerekKendaraan.query.get('Toyota').jumlah == 1500
+
+
+def test_mode_partial_keeps_the_valid_rows(client):
+    summary = upload(client, 'partial', bad_row=batch_upload.CHUNK_SIZE + 100).get_json()
+    assert summary['successes'] == 1499
+    assert summary['rejected'] == 1
+    assert Kendaraan.query.count() == 1499
+
+
+def test_background_mode_all_keeps_nothing_when_one_row_is_bad(client):
+    response = upload(client, 'all', bad_row=batch_upload.CHUNK_SIZE + 100, background=True)
+    assert response.status_code == 202
+    job = wait_for_upload(client, response.get_json()['id'])
+    assert job['status'] == 'completed'
+    assert job['successes'] == 0
+    assert job['rejected'] == 1
+    db.session.rollback()
+    assert Kendaraan.query.count() == 0
@@ -0,0 +1,52 @@
+from datetime import datetime, timedelta
+
+import changelog
+import pagination
+from extensions import db
+
+
+def changes(client, since=''):
+    response = client.get(f'/api/v1/changes?since={since}')
+    return response.status_code, response.get_json()
+
+
+def test_changes_follow_inserts_updates_and_deletes(client, add_vehicle, add_result):
+    add_vehicle('B 1 AA')
+    status, first = changes(client)
+    assert status == 200
+    assert [(c['table'], c['operation']) for c in first['changes']] == [('kendaraan', 'insert')]
+
+    add_result('B 1 AA')
+    assert client.delete('/api/kendaraan/B 1 AA').status_code == 200
+    status, second = changes(client, first['next_cursor'])
+    assert status == 200
+    operations = {(c['table'], c['operation']) for c in second['changes']}
+    assert ('hasil_uji', 'insert') in operations
+    assert ('kendaraan', 'delete') in operations
+    assert all(c['id'] > first['changes'][-1]['id'] for c in second['changes'])
+
+
+def test_cursor_older_than_horizon_is_gone(client, add_vehicle):
+    add_vehicle('B 1 AA')
+    _, before = changes(client)
+    stale_cursor = pagination.encode_cursor([before['changes'][0]['id']])
+    add_vehicle('B 2 BB')
+    assert client.delete('/api/kendaraan/B 2 BB').status_code == 200
+
+    # Purge the delete as if its retention ran out
+    changelog.compact(now=datetime.utcnow() + changelog.DELETE_RETENTION + timedelta(days=1))
+    db.session.commit()
+    assert changelog.horizon() > before['changes'][0]['id']
+
+    status, gone = changes(client, stale_cursor)
+    assert status == 410
+    status, resumed = changes(client, gone['resync_cursor'])
+    assert status == 200
+    assert resumed['changes'] == []
+
+
+def test_malformed_since_is_rejected(client):
+    status, body = changes(client, 'not-a-cursor')
+    assert status == 400
+    status, body = changes(client, pagination.encode_cursor(['x']))
+    assert status == 400
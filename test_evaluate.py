@@ -0,0 +1,56 @@
+import math
+import random
+
+from evaluate import AGE_BOUNDARIES, LOAD_CATEGORIES, Thresholds, parameter_documents, scalar_limits
+
+
+def default_thresholds():
+    return Thresholds.compile(*parameter_documents(), scalar_limits())
+
+
+def random_readings(count, seed=7):
+    """Readings scattered around the default limits, with exact boundaries and NaNs mixed in"""
+    rng = random.Random(seed)
+    thresholds = default_thresholds()
+    rows = []
+    for _ in range(count):
+        fuel_type = rng.choice(('bensin', 'solar'))
+        first, last = AGE_BOUNDARIES[fuel_type]
+        row = {
+            'fuel_type': fuel_type,
+            'load_category': rng.choice(LOAD_CATEGORIES[fuel_type] + ('unknown',)),
+            'tahun': rng.choice((first - 1, first, last, last + 1, rng.randint(1970, 2030))),
+        }
+        _, limits = thresholds.limits(row['fuel_type'], row['load_category'], row['tahun'])
+        if fuel_type == 'bensin':
+            for name, limit in (('co', 'co_max'), ('hc', 'hc_max'), ('co2', 'co2_min'), ('o2', 'o2_max')):
+                row[name] = rng.choice((limits[limit], limits[limit] * rng.uniform(0.5, 1.5), math.nan))
+            row['lambda_val'] = rng.choice((limits['lambda_min'], limits['lambda_max'], rng.uniform(0.8, 1.2)))
+            row['opacity'] = None
+        else:
+            for name in ('co', 'co2', 'hc', 'o2', 'lambda_val'):
+                row[name] = 0
+            row['opacity'] = rng.choice((limits['opacity_max'], rng.uniform(0, 100), None))
+        rows.append(row)
+    return rows
+
+
+def test_evaluate_batch_matches_evaluate():
+    thresholds = default_thresholds()
+    rows = random_readings(5000)
+    graded = thresholds.evaluate_batch(**{name: [row[name] for row in rows] for name in rows[0]})
+    for i, row in enumerate(rows):
+        expected = thresholds.evaluate(**row)
+        assert bool(graded.lulus[i]) == expected.lulus, row
+
+
+def test_evaluate_batch_age_index():
+    thresholds = default_thresholds()
+    first, last = AGE_BOUNDARIES['bensin']
+    graded = thresholds.evaluate_batch(
+        co=[0] * 3, co2=[0] * 3, hc=[0] * 3, o2=[0] * 3, lambda_val=[1] * 3, opacity=[None] * 3,
+        tahun=[first - 1, first, last + 1],
+        fuel_type=['bensin'] * 3,
+        load_category=['kendaraan_penumpang'] * 3
+    )
+    assert list(graded.age_index) == [0, 1, 2]
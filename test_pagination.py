@@ -0,0 +1,79 @@
+from datetime import datetime
+
+import pytest
+
+import pagination
+from extensions import db
+from models import HasilUji, Kendaraan
+
+
+@pytest.fixture
+def tied_results(app, add_vehicle):
+    """17 results sharing a handful of timestamps, one of them without a date"""
+    add_vehicle('B 1 AA')
+    kendaraan = Kendaraan.with_plat('B 1 AA').one()
+    stamps = [
+        datetime(2024, 1, 1, 8, 0, 0, 123456),
+        datetime(2024, 1, 1, 8, 0, 0, 123456),
+        datetime(2024, 1, 2),
+        datetime(1900, 1, 1),
+    ]
+    for i in range(17):
+        db.session.add(HasilUji(kendaraan_id=kendaraan.id, tanggal=stamps[i % len(stamps)]))
+    db.session.flush()
+
+    # The column default fills in a None tanggal, so clear it afterwards
+    HasilUji.query.filter(HasilUji.tanggal == stamps[-1]).update({'tanggal': None}, synchronize_session=False)
+    db.session.commit()
+
+
+def walk(descending, per_page):
+    """Every page forward from the first one, then back again from the last"""
+    query = HasilUji.query
+    columns = [HasilUji.tanggal, HasilUji.id]
+
+    def key(row):
+        return (row.tanggal, row.id)
+
+    forward = [pagination.seek(query, columns, key, per_page=per_page, descending=descending)]
+    while forward[-1].has_next:
+        forward.append(pagination.seek(
+            query, columns, key, cursor=forward[-1].next_cursor, per_page=per_page, descending=descending
+        ))
+    backward = [forward[-1]]
+    while backward[-1].has_prev:
+        backward.append(pagination.seek(
+            query, columns, key, cursor=backward[-1].prev_cursor, per_page=per_page, descending=descending
+        ))
+    return forward, backward
+
+
+def expected_order(descending):
+    rows = HasilUji.query.all()
+    rows.sort(key=lambda r: (r.tanggal is not None, r.tanggal or datetime.min, r.id), reverse=descending)
+    return [row.id for row in rows]
+
+
+@pytest.mark.parametrize('descending', [True, False])
+@pytest.mark.parametrize('per_page', [1, 3, 4, 17])
+def test_seek_pages_cover_ties_once(tied_results, descending, per_page):
+    forward, backward = walk(descending, per_page)
+    ids = [row.id for page in forward for row in page.items]
+    assert ids == expected_order(descending)
+    assert [[row.id for row in page.items] for page in reversed(backward)] == \
+        [[row.id for row in page.items] for page in forward]
+    assert not forward[0].has_prev
+
+
+def test_cursor_round_trip_keeps_microseconds():
+    key = (datetime(2024, 1, 1, 8, 0, 0, 123456), 42)
+    values, backward = pagination.decode_cursor(pagination.encode_cursor(key, backward=True), 2)
+    assert tuple(values) == key
+    assert backward
+
+
+def test_malformed_cursor_is_rejected():
+    with pytest.raises(ValueError):
+        pagination.decode_cursor('not-a-cursor', 2)
+    with pytest.raises(ValueError):
+        pagination.decode_cursor(pagination.encode_cursor([1]), 2)
@@ -0,0 +1,63 @@
+import time
+
+import rollups
+from extensions import db
+from models import RegradeJob
+
+
+def wait_for_regrade(timeout=10):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        db.session.rollback()
+        job = RegradeJob.query.order_by(RegradeJob.id.desc()).first()
+        if job and job.status not in ('pending', 'running'):
+            return job
+        time.sleep(0.05)
+    raise AssertionError('regrade job did not finish')
+
+
+def test_rollups_follow_inserts(add_vehicle, add_result):
+    add_vehicle('B 1 AA')
+    add_vehicle('B 2 BB', fuel_type='solar', load_category='<3.5ton')
+    add_result('B 1 AA')
+    add_result('B 1 AA', co=3.0)
+    add_result('B 2 BB', opacity=40)
+    assert rollups.verify() == []
+
+
+def test_rollups_follow_vehicle_updates(client, add_vehicle, add_result):
+    add_vehicle('B 1 AA')
+    add_result('B 1 AA')
+    response = client.put('/api/kendaraan/B 1 AA', json={'load_category': 'kendaraan_muatan', 'jenis': 'dinas'})
+    assert response.status_code == 200
+    assert rollups.verify() == []
+
+
+def test_rollups_follow_deletes(client, add_vehicle, add_result):
+    add_vehicle('B 1 AA')
+    add_vehicle('B 2 BB')
+    for _ in range(3):
+        add_result('B 1 AA')
+        add_result('B 2 BB')
+    assert client.delete('/api/hasil-uji/B 1 AA').status_code == 200
+    assert rollups.verify() == []
+    assert client.delete('/api/hasil-uji/B 1 AA?all=1').status_code == 200
+    assert rollups.verify() == []
+    assert client.delete('/api/kendaraan/B 2 BB').status_code == 200
+    assert rollups.verify() == []
+
+
+def test_rollups_follow_regrade(client, add_vehicle, add_result):
+    add_vehicle('B 1 AA')
+    add_vehicle('B 2 BB')
+    add_result('B 1 AA', o2=0.5)
+    add_result('B 2 BB', o2=0.9)
+    assert all(row.passed for row in db.session.query(rollups.RekapHarian))
+
+    # Tightening the limit fails both stored results in the background
+    client.post('/api/v1/config', data={'o2_max': '0.1'})
+    job = wait_for_regrade()
+    assert job.status == 'completed'
+    assert job.changed == 2
+    assert rollups.verify() == []
+    assert not any(row.passed for row in db.session.query(rollups.RekapHarian))